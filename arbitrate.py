@@ -0,0 +1,423 @@
+#!/usr/bin/env python3
+
+# Teal Dulcet and Daniel Connelly
+# Assigns disjoint sets of whole CPU cores and priorities to the Mlucas runs, Prime95/MPrime, the BOINC client and
+# the Folding@home client (FAHClient) on a shared computer, instead of each of them assuming that it owns every core.
+# The cores are read from the topology in /sys, like the RUNS of the Mlucas script. It prints the plan and, with
+# --apply, applies it with taskset and renice (or cgroup cpusets), the Mlucas “mlucas_cpu.txt” files, the
+# Prime95/MPrime “local.txt” file and the BOINC and FAHClient configuration.
+# Use --root to plan against a copy or a fake /sys and /proc/cpuinfo.
+# ./arbitrate.py [options]
+# ./arbitrate.py --mlucas mlucas --mprime mprime --boinc --folding
+# ./arbitrate.py --cores mlucas=8 --cores boinc=2 --apply
+# ./arbitrate.py --root /tmp/fake --mlucas mlucas --boinc
+
+import sys
+import os
+import re
+import glob
+import signal
+import shutil
+import optparse
+import subprocess
+import xml.etree.ElementTree as ET
+
+CLIENTS = ("mlucas", "mprime", "boinc", "folding")
+NAMES = {"mlucas": "Mlucas", "mprime": "Prime95/MPrime", "boinc": "BOINC", "folding": "Folding@home"}
+# The process names (argv[0]) of each client, their children are included
+PROCESSES = {"mlucas": ("Mlucas",), "mprime": ("mprime",), "boinc": ("boinc", "boinc_client"), "folding": ("FAHClient",)}
+# The GIMPS programs run with nice like in the scripts, BOINC and Folding@home at the lowest priority
+NICE = {"mlucas": 10, "mprime": 10, "boinc": 19, "folding": 19}
+
+
+def read_file(filename):
+    try:
+        with open(filename) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def parse_cpu_list(cpus):
+    '''Expands a Linux (“0-3,8”) or Mlucas (“0:3,8”) CPU list'''
+    result = []
+    for part in cpus.split(","):
+        bounds = [int(x) for x in re.split(r"[-:]", part.strip())]
+        result.extend(range(bounds[0], bounds[-1] + 1) if len(bounds) > 1 else bounds)
+    return result
+
+
+def format_cpu_list(cpus, sep="-"):
+    '''Formats CPUs as a Linux (sep="-") or Mlucas (sep=":") CPU list'''
+    ranges = []
+    for cpu in sorted(cpus):
+        if ranges and cpu == ranges[-1][1] + 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ",".join(str(lo) if lo == hi else "{0}{1}{2}".format(lo, sep, hi) for lo, hi in ranges)
+
+
+def cpu_topology(root):
+    '''The CPU threads of each physical core, ordered by their package and first CPU'''
+    cores = {}
+    for filename in glob.glob(os.path.join(root, "sys/devices/system/cpu/cpu[0-9]*/topology/thread_siblings_list")):
+        siblings = read_file(filename)
+        if siblings:
+            package = read_file(os.path.join(os.path.dirname(filename), "physical_package_id"))
+            core = tuple(sorted(parse_cpu_list(siblings)))
+            cores[core] = int(package) if package and package.lstrip("-").isdigit() else 0
+    return sorted(cores, key=lambda core: (cores[core], core))
+
+
+def cpu_model(root):
+    '''The CPU model name from /proc/cpuinfo'''
+    cpuinfo = read_file(os.path.join(root, "proc/cpuinfo")) or ""
+    res = re.search(r'^model name\s*:\s*(.+)$', cpuinfo, re.M)
+    return res.group(1).strip() if res else ""
+
+
+def run_width(model):
+    '''The number of cores of each Mlucas run, like the RUNS of the Mlucas script'''
+    return 1 if re.search(r'intel|amd', model, re.I) else 4
+
+
+def mlucas_runs(directory):
+    '''The “run<N>” directories of the Mlucas script, in order'''
+    runs = [d for d in glob.glob(os.path.join(directory, "run[0-9]*")) if os.path.isdir(d)]
+    return sorted(runs, key=lambda d: int(re.search(r'(\d+)$', d).group(1)))
+
+
+def plan(cores, clients, counts, width):
+    '''Divides the cores between the clients
+    Parameters:
+    cores (list): the CPU threads of each core
+    clients (dict): client to the number of Mlucas runs for Mlucas, else None
+    counts (dict): client to the number of cores given with --cores
+    width (int): the number of cores of each Mlucas run
+    Returns:
+    A dictionary of client to its list of cores, in the order of CLIENTS
+    '''
+    demand = dict(counts)
+    if "mlucas" in clients and "mlucas" not in demand:
+        demand["mlucas"] = clients["mlucas"] * width
+    others = [client for client in clients if client not in counts and client != "mlucas"]
+    fixed = sum(demand.values())
+    if "mlucas" in demand and "mlucas" not in counts:
+        # Leave at least one core for each of the other clients
+        demand["mlucas"] = max(min(demand["mlucas"], len(cores) - fixed + demand["mlucas"] - len(others)), 1)
+        fixed = sum(demand.values())
+    if fixed + len(others) > len(cores):
+        raise ValueError("There are only {0:n} cores, but {1:n} are needed{2}".format(
+            len(cores), fixed, " plus one for each of the other {0:n} clients".format(len(others)) if others else ""))
+    free = len(cores) - fixed
+    for i, client in enumerate(others):
+        demand[client] = free // len(others) + (1 if i < free % len(others) else 0)
+    result = {}
+    start = 0
+    for client in CLIENTS:
+        if client in demand:
+            result[client] = cores[start:start + demand[client]]
+            start += demand[client]
+    return result
+
+
+def split_runs(cores, runs):
+    '''Divides the cores of Mlucas between its runs, as evenly as possible'''
+    if len(cores) < runs:
+        raise ValueError("There are only {0:n} cores for {1:n} Mlucas runs".format(len(cores), runs))
+    result = []
+    start = 0
+    for i in range(runs):
+        num = len(cores) // runs + (1 if i < len(cores) % runs else 0)
+        result.append([cpu for core in cores[start:start + num] for cpu in core])
+        start += num
+    return result
+
+
+def processes():
+    '''The PID, parent PID, name (argv[0]) and working directory of each process'''
+    result = []
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit():
+            continue
+        try:
+            with open(os.path.join("/proc", pid, "stat")) as f:
+                stat = f.read()
+            with open(os.path.join("/proc", pid, "cmdline"), "rb") as f:
+                args = f.read().split(b"\0")
+            try:
+                cwd = os.readlink(os.path.join("/proc", pid, "cwd"))
+            except OSError:
+                cwd = None
+        except OSError:
+            continue
+        # The command name in parentheses may contain spaces
+        ppid = int(stat[stat.rindex(")") + 2:].split()[1])
+        result.append((int(pid), ppid, os.path.basename(args[0].decode("utf-8", "replace")), cwd))
+    return result
+
+
+def find_pids(procs, names, cwd=None):
+    '''The PIDs of the processes with one of the names (and working directory) and all their children'''
+    pids = set(pid for pid, _, name, pcwd in procs if name in names and (cwd is None or pcwd == cwd))
+    added = True
+    while added:
+        children = set(pid for pid, ppid, _, _ in procs if ppid in pids) - pids
+        pids |= children
+        added = bool(children)
+    return sorted(pids)
+
+
+def run(args, dry_run):
+    print("  " + " ".join(args))
+    if not dry_run:
+        if subprocess.run(args).returncode:
+            sys.stderr.write("Error: “{0}” failed\n".format(" ".join(args)))
+
+
+def write_file(filename, text, dry_run):
+    print("  Write “{0}”: {1}".format(filename, text.strip().replace("\n", " ")))
+    if not dry_run:
+        with open(filename + ".tmp", "w") as f:
+            f.write(text)
+        os.replace(filename + ".tmp", filename)
+
+
+def write_cgroup(filename, value, dry_run):
+    '''Writes a cgroup control file directly, it cannot be replaced'''
+    print("  echo {0} > {1}".format(value, filename))
+    if not dry_run:
+        with open(filename, "w") as f:
+            f.write(value)
+
+
+def limit(client, pids, cpus, options, dry_run):
+    '''Restricts the processes to the CPUs, with a cgroup cpuset or taskset, and sets their priority'''
+    cpu_list = format_cpu_list(cpus)
+    if options.cgroup:
+        group = os.path.join(options.root, "sys/fs/cgroup", "gimps-" + client)
+        print("  mkdir -p {0}".format(group))
+        if not dry_run:
+            os.makedirs(group, exist_ok=True)
+        write_cgroup(os.path.join(options.root, "sys/fs/cgroup", "cgroup.subtree_control"), "+cpuset", dry_run)
+        write_cgroup(os.path.join(group, "cpuset.cpus"), cpu_list, dry_run)
+        # One PID for each write
+        for pid in pids:
+            write_cgroup(os.path.join(group, "cgroup.procs"), str(pid), dry_run)
+    else:
+        for pid in pids:
+            run(["taskset", "-a", "-p", "-c", cpu_list, str(pid)], dry_run)
+    if pids:
+        run(["renice", "-n", str(NICE[client]), "-p"] + [str(pid) for pid in pids], dry_run)
+
+
+def apply_mlucas(runs, run_cpus, procs, options, dry_run):
+    for directory, cpus in zip(runs, run_cpus):
+        arg = format_cpu_list(cpus, ":")
+        filename = os.path.join(directory, "mlucas_cpu.txt")
+        if read_file(filename) == arg:
+            continue
+        # Read by the worker each time it starts, idle.py restarts it. Mlucas writes its save files when it gets SIGTERM.
+        write_file(filename, arg + "\n", dry_run)
+        for pid in find_pids(procs, PROCESSES["mlucas"], os.path.realpath(directory))[:1]:
+            print("  Restart Mlucas (PID {0}) with “-cpu {1}”".format(pid, arg))
+            if not dry_run:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                    os.kill(pid, signal.SIGCONT)
+                except OSError as e:
+                    sys.stderr.write("Error: Unable to restart Mlucas: {0}\n".format(e))
+
+
+def apply_mprime(cores, pids, options, dry_run):
+    '''Sets the number of workers and the cores of each worker in the Prime95/MPrime local.txt (see
+    mprime-python-port/config.py), keeping its other settings. The number of workers is kept if it divides the
+    cores, otherwise it is reduced until it does, so that all of them are used.'''
+    if options.mprime is None:
+        sys.stderr.write("Error: The directory of Prime95/MPrime is unknown, use --mprime DIR\n")
+        return
+    filename = os.path.join(options.mprime, "local.txt")
+    text = read_file(filename)
+    lines = text.splitlines() if text else []
+    # The global section is before the first [Worker #N] section
+    end = next((i for i, line in enumerate(lines) if line.startswith("[")), len(lines))
+    values = dict(line.split("=", 1) for line in lines[:end] if "=" in line)
+    try:
+        workers = int(values.get("WorkerThreads", 1))
+    except ValueError:
+        workers = 1
+    workers = min(max(workers, 1), cores)
+    while cores % workers:
+        workers -= 1
+    settings = {"WorkerThreads": workers, "CoresPerTest": cores // workers}
+    new_lines = []
+    for i, line in enumerate(lines):
+        key = line.split("=", 1)[0]
+        # CoresPerTest may also be set for each worker
+        if key in settings and (i < end or key == "CoresPerTest"):
+            line = "{0}={1}".format(key, settings[key])
+        new_lines.append(line)
+    missing = ["{0}={1}".format(key, value) for key, value in settings.items() if key not in values]
+    while end and not new_lines[end - 1].strip():
+        end -= 1
+    new_lines[end:end] = missing
+    if new_lines == lines:
+        return
+    write_file(filename, "\n".join(new_lines) + "\n", dry_run)
+    # It only reads local.txt when it starts, the crontab of the Prime95/MPrime script restarts it
+    for pid in pids[:1]:
+        print("  Restart Prime95/MPrime (PID {0}) with {1:n} worker(s) of {2:n} core(s)".format(
+            pid, workers, settings["CoresPerTest"]))
+        if not dry_run:
+            try:
+                os.kill(pid, signal.SIGTERM)
+                os.kill(pid, signal.SIGCONT)
+            except OSError as e:
+                sys.stderr.write("Error: Unable to restart Prime95/MPrime: {0}\n".format(e))
+
+
+def apply_boinc(cpus, total, options, dry_run):
+    '''Sets the percent of the CPUs BOINC may use in its global preferences override'''
+    filename = os.path.join(options.boinc_dir, "global_prefs_override.xml")
+    try:
+        tree = ET.parse(filename)
+        prefs = tree.getroot()
+    except (OSError, ET.ParseError):
+        prefs = ET.Element("global_preferences")
+        tree = ET.ElementTree(prefs)
+    element = prefs.find("max_ncpus_pct")
+    if element is None:
+        element = ET.SubElement(prefs, "max_ncpus_pct")
+    element.text = "{0:.6f}".format(100 * len(cpus) / total)
+    write_file(filename, ET.tostring(prefs, encoding="unicode") + "\n", dry_run)
+    if shutil.which("boinccmd"):
+        run(["boinccmd", "--read_global_prefs_override"], dry_run)
+
+
+def apply_folding(cpus, options, dry_run):
+    '''Sets the number of CPU threads of the CPU slots in the FAHClient configuration'''
+    try:
+        tree = ET.parse(options.folding_config)
+    except (OSError, ET.ParseError) as e:
+        sys.stderr.write("Error: Unable to read “{0}”: {1}\n".format(options.folding_config, e))
+        return
+    slots = [slot for slot in tree.getroot().iter("slot") if slot.get("type", "").upper() == "CPU"] or [tree.getroot()]
+    for slot in slots:
+        element = slot.find("cpus")
+        if element is None:
+            element = ET.SubElement(slot, "cpus")
+        element.set("v", str(len(cpus) // len(slots) or 1))
+    write_file(options.folding_config, ET.tostring(tree.getroot(), encoding="unicode") + "\n", dry_run)
+    print("  FAHClient uses the new number of threads with its next work unit")
+
+
+def cores_callback(option, opt_str, value, parser):
+    res = re.match(r'^(\w+)=(\d+)$', value)
+    if not res or res.group(1) not in CLIENTS or not int(res.group(2)):
+        raise optparse.OptionValueError("{0} must be CLIENT=N, where CLIENT is one of {1} and N > 0".format(
+            opt_str, ", ".join(CLIENTS)))
+    getattr(parser.values, option.dest)[res.group(1)] = int(res.group(2))
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options]",
+                                   description="Assigns disjoint sets of whole CPU cores and priorities to the Mlucas runs, Prime95/MPrime, the BOINC client and the Folding@home client on a shared computer. Prints the plan and applies it with --apply.")
+    parser.add_option("--mlucas", dest="mlucas", metavar="DIR",
+                      help="Directory of the Mlucas script, with its run<N> directories, Default: “mlucas” if it exists")
+    parser.add_option("--mprime", dest="mprime", metavar="DIR",
+                      help="Directory of the Prime95/MPrime script, Default: “mprime” if it exists")
+    parser.add_option("--boinc", action="store_true", dest="boinc",
+                      help="Include the BOINC client, Default: if boinccmd is installed")
+    parser.add_option("--folding", action="store_true", dest="folding",
+                      help="Include the Folding@home client, Default: if FAHClient is installed")
+    parser.add_option("--cores", type="string", dest="cores", default={}, action="callback", callback=cores_callback,
+                      metavar="CLIENT=N", help="Number of cores for a client (mlucas, mprime, boinc or folding), can be given more than once. By default, Mlucas gets the cores of its runs (like the Mlucas script) and the other clients divide the rest.")
+    parser.add_option("-r", "--root", dest="root", default="/",
+                      help="Read the CPU topology from this copy of /sys and /proc/cpuinfo (e.g. a fake one), Default: %default")
+    parser.add_option("--boinc-dir", dest="boinc_dir", default="/var/lib/boinc-client",
+                      help="BOINC data directory, Default: %default")
+    parser.add_option("--folding-config", dest="folding_config", default="/etc/fahclient/config.xml",
+                      help="FAHClient configuration file, Default: %default")
+    parser.add_option("--cgroup", action="store_true", dest="cgroup", default=False,
+                      help="Use cgroup v2 cpusets instead of taskset, so that new child processes stay on their cores (requires root)")
+    parser.add_option("--apply", action="store_true", dest="apply", default=False,
+                      help="Apply the plan, instead of only printing it and the commands")
+    options, args = parser.parse_args()
+    if args:
+        parser.error("Unexpected arguments")
+
+    if options.mlucas is None and os.path.isdir("mlucas"):
+        options.mlucas = "mlucas"
+    if options.mprime is None and os.path.isdir("mprime"):
+        options.mprime = "mprime"
+    if "mprime" in options.cores and options.mprime is None:
+        parser.error("--cores mprime=N requires --mprime DIR")
+    if options.boinc is None:
+        options.boinc = bool(shutil.which("boinccmd"))
+    if options.folding is None:
+        options.folding = bool(shutil.which("FAHClient")) or os.path.exists(options.folding_config)
+
+    cores = cpu_topology(options.root)
+    if not cores:
+        parser.error("Unable to read the CPU topology from “{0}”".format(os.path.join(options.root, "sys")))
+    model = cpu_model(options.root)
+    runs = mlucas_runs(options.mlucas) if options.mlucas else []
+    if options.mlucas and not runs:
+        parser.error("“{0}” does not have any Mlucas run<N> directories".format(options.mlucas))
+    clients = {}
+    if runs:
+        clients["mlucas"] = len(runs)
+    for client in CLIENTS[1:]:
+        if getattr(options, client) or client in options.cores:
+            clients[client] = None
+    for client in options.cores:
+        if client not in clients:
+            parser.error("--cores {0}: {1} was not found".format(client, NAMES[client]))
+    if not clients:
+        parser.error("No clients were found, use --mlucas, --mprime, --boinc or --folding")
+    total = sum(len(core) for core in cores)
+    print("CPU: {0}, {1:n} cores, {2:n} threads".format(model or "unknown", len(cores), total))
+    try:
+        assigned = plan(cores, clients, options.cores, run_width(model))
+        run_cpus = split_runs(assigned["mlucas"], len(runs)) if runs else []
+    except ValueError as e:
+        parser.error(str(e))
+
+    print("\n{0:<16} {1:>5} {2:>7}  {3:<16} {4}".format("Client", "Cores", "Threads", "CPUs", "Nice"))
+    for client, client_cores in assigned.items():
+        cpus = [cpu for core in client_cores for cpu in core]
+        print("{0:<16} {1:5n} {2:7n}  {3:<16} {4}".format(NAMES[client], len(client_cores), len(cpus),
+                                                          format_cpu_list(cpus), NICE[client]))
+        if client == "mlucas":
+            for directory, cpus in zip(runs, run_cpus):
+                print("  {0:<14} {1:>5} {2:7n}  -cpu {3}".format(os.path.basename(directory), "", len(cpus),
+                                                                format_cpu_list(cpus, ":")))
+
+    dry_run = not options.apply
+    print("\n{0}:".format("Applying the plan" if options.apply else "Commands (run with --apply to apply them)"))
+    procs = processes() if os.path.isdir("/proc") else []
+    for client, client_cores in assigned.items():
+        cpus = [cpu for core in client_cores for cpu in core]
+        print("{0}:".format(NAMES[client]))
+        if client == "mlucas":
+            # Mlucas sets its own affinity from “-cpu”
+            apply_mlucas(runs, run_cpus, procs, options, dry_run)
+            pids = [pid for directory in runs for pid in find_pids(procs, PROCESSES[client], os.path.realpath(directory))]
+            if pids:
+                run(["renice", "-n", str(NICE[client]), "-p"] + [str(pid) for pid in pids], dry_run)
+            continue
+        pids = find_pids(procs, PROCESSES[client], os.path.realpath(options.mprime) if client == "mprime" else None)
+        if not pids:
+            print("  {0} is not running, only its configuration is changed".format(NAMES[client]))
+        limit(client, pids, cpus, options, dry_run)
+        if client == "mprime":
+            apply_mprime(len(client_cores), pids, options, dry_run)
+        elif client == "boinc":
+            apply_boinc(cpus, total, options, dry_run)
+        elif client == "folding":
+            apply_folding(cpus, options, dry_run)
+
+
+if __name__ == "__main__":
+    main()
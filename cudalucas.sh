@@ -72,6 +72,11 @@ if [[ -e ../primenet.py ]]; then
 else
 	wget https://raw.github.com/tdulcet/Distributed-Computing-Scripts/master/primenet.py -nv
 fi
+if [[ -e ../idle.py ]]; then
+	cp ../idle.py .
+else
+	wget https://raw.github.com/tdulcet/Distributed-Computing-Scripts/master/idle.py -nv
+fi
 if command -v pip3 >/dev/null; then
 	echo -e "Installing the Requests library\n"
 	pip3 install requests
@@ -137,20 +142,14 @@ if command -v nvidia-smi >/dev/null && nvidia-smi >/dev/null; then
 		ARGS+=( -m "${TOTAL_GPU_MEM[0]}" )
 	fi
 fi
-python3 primenet.py -d -t 0 -T "$TYPE" -u "$USERID" -i "worktodo.txt" -g "cudalucas.out" -H "$COMPUTER" "${ARGS[@]}"
-echo -e "\nStarting PrimeNet\n"
-nohup python3 primenet.py -d &
-sleep 1
+# Set GIMPS_GATEWAY to the URL of a PrimeNet gateway (primenet.py --gateway) to share it with the other GIMPS programs
+python3 primenet.py -d -t 0 -T "$TYPE" -u "$USERID" -i "worktodo.txt" -g "cudalucas.out" -H "$COMPUTER" "${ARGS[@]}" ${GIMPS_GATEWAY:+--server "$GIMPS_GATEWAY"}
 echo -e "\nOptimizing CUDALucas for your computer and GPU\nThis may take awhile…\n"
 ./CUDALucas -cufftbench 1024 8192 5
 ./CUDALucas -threadbench 1024 8192 5 0
 # echo -e "\nRunning self tests\nThis will take awhile…\n"
 # ./CUDALucas -r 1
 # ./CUDALucas 6972593
-echo -e "\nStarting CUDALucas\n"
-nohup nice ./CUDALucas >> "cudalucas.out" &
-sleep 1
-echo -e "\nSetting it to start if the computer has not been used in the specified idle time and stop it when someone uses the computer\n"
-#crontab -l | { cat; echo "cd \"$DIR\" && nohup nice ./CUDALucas >> \"cudalucas.out\" &"; } | crontab -
-#crontab -l | { cat; echo "cd \"$DIR\" && nohup python3 primenet.py -d &"; } | crontab -
-crontab -l | { cat; echo "* * * * * if who -s | awk '{ print \$2 }' | (cd /dev && xargs -r stat -c '\%U \%X') | awk '{if ('\"\${EPOCHSECONDS:-\$(date +\%s)}\"'-\$2<$TIME) { print \$1\"\t\"'\"\${EPOCHSECONDS:-\$(date +\%s)}\"'-\$2; ++count }} END{if (count>0) { exit 1 }}' >/dev/null; then pgrep CUDALucas >/dev/null || (cd \"$DIR\" && nohup nice ./CUDALucas >> \"cudalucas.out\" &); pgrep -f '^python3 primenet\.py' >/dev/null || (cd \"$DIR\" && nohup python3 primenet.py -d &); else pgrep CUDALucas >/dev/null && killall CUDALucas; fi"; } | crontab -
+echo -e "\nStarting PrimeNet and setting CUDALucas to start if the computer has not been used in the specified idle time and pause it when someone uses the computer\n"
+nohup python3 idle.py -t "$TIME" --service "$DIR" "python3 primenet.py -d" --worker "$DIR" "nice ./CUDALucas >> cudalucas.out" >> idle.out &
+crontab -l | { cat; echo "@reboot cd \"$DIR\" && nohup python3 idle.py -t $TIME --service \"$DIR\" 'python3 primenet.py -d' --worker \"$DIR\" 'nice ./CUDALucas >> cudalucas.out' >> idle.out &"; } | crontab -
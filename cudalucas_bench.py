@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+
+# Teal Dulcet and Daniel Connelly
+# Runs the CUDALucas FFT length and threads benchmarks and merges their results into the
+# “<device> fft.txt” and “<device> threads.txt” tables of the google-colab/gpu_optimizations directory,
+# keeping the faster ms/iter for each FFT length.
+# Use --no-bench to only merge existing (e.g. recorded) result files, without a GPU.
+# ./cudalucas_bench.py [options] [CUDALucas directory]
+# ./cudalucas_bench.py cudalucas
+# ./cudalucas_bench.py --no-bench -o /tmp/tables "tests/fixtures/cudalucas/Tesla T4 fft.txt" "tests/fixtures/cudalucas/Tesla T4 threads.txt"
+
+import sys
+import os
+import re
+import glob
+import time
+import optparse
+import subprocess
+
+TABLES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "google-colab", "gpu_optimizations")
+FFT_HEADER = "  fft    max exp  ms/iter"
+
+
+def parse_fft(text):
+    '''Parses the output file of “CUDALucas -cufftbench”
+    Returns:
+    The header lines (e.g. “Device  Tesla T4”) and a dictionary of FFT length (K) to (max exponent, ms/iter)
+    '''
+    header = []
+    rows = {}
+    for line in text.splitlines():
+        res = re.match(r'^\s*(\d+)\s+(\d+)\s+(\d+\.\d+)\s*$', line)
+        if res:
+            rows[int(res.group(1))] = (int(res.group(2)), float(res.group(3)))
+        elif line.strip() and not rows and line.rstrip() != FFT_HEADER:
+            header.append(line.rstrip())
+    return header, rows
+
+
+def parse_threads(text):
+    '''Parses the output file of “CUDALucas -threadbench”
+    Returns:
+    A dictionary of FFT length (K) to (FFT threads, square threads, ms/iter)
+    '''
+    rows = {}
+    for line in text.splitlines():
+        res = re.match(r'^\s*(\d+)\s+(\d+)\s+(\d+)\s+(\d+\.\d+)\s*$', line)
+        if res:
+            rows[int(res.group(1))] = (int(res.group(2)), int(res.group(3)), float(res.group(4)))
+    return rows
+
+
+def device_name(header):
+    '''The device name from the header of a FFT table, which is used in the filenames'''
+    for line in header:
+        res = re.match(r'^Device\s+(.+)$', line)
+        if res:
+            return res.group(1).strip()
+    return None
+
+
+def merge(old, new):
+    '''Merges two tables of FFT length to tuples ending with the ms/iter, keeping the faster one'''
+    merged = dict(old)
+    for fft, row in new.items():
+        if fft not in merged or row[-1] < merged[fft][-1]:
+            merged[fft] = row
+    return merged
+
+
+def format_fft(header, rows):
+    return "\n".join(header + ["", FFT_HEADER] + ["{0:5d} {1:10d} {2:8.4f}".format(
+        fft, maxexp, ms) for fft, (maxexp, ms) in sorted(rows.items())]) + "\n"
+
+
+def format_threads(rows):
+    return "".join("{0:5d} {1:4d} {2:4d} {3:10.5f}\n".format(
+        fft, fft_threads, square_threads, ms) for fft, (fft_threads, square_threads, ms) in sorted(rows.items()))
+
+
+def read_file(filename):
+    try:
+        with open(filename) as f:
+            return f.read()
+    except OSError:
+        return ""
+
+
+def write_file(filename, text):
+    with open(filename + ".tmp", "w") as f:
+        f.write(text)
+    os.replace(filename + ".tmp", filename)
+
+
+def merge_results(fft_file, threads_file, tables):
+    '''Merges the benchmark result files into the tables directory
+    Returns:
+    The device name, or None if the FFT file has no device
+    '''
+    header, fft_rows = parse_fft(read_file(fft_file))
+    device = device_name(header)
+    if device is None:
+        sys.stderr.write("Error: “{0}” does not have a device name\n".format(fft_file))
+        return None
+    table = os.path.join(tables, device + " fft.txt")
+    old_header, old_rows = parse_fft(read_file(table))
+    rows = merge(old_rows, fft_rows)
+    write_file(table, format_fft(old_header or header, rows))
+    print("“{0}”: {1:n} FFT lengths, {2:n} new or faster".format(
+        table, len(rows), sum(1 for fft in rows if rows[fft] != old_rows.get(fft))))
+    if threads_file:
+        table = os.path.join(tables, device + " threads.txt")
+        old_rows = parse_threads(read_file(table))
+        rows = merge(old_rows, parse_threads(read_file(threads_file)))
+        write_file(table, format_threads(rows))
+        print("“{0}”: {1:n} FFT lengths, {2:n} new or faster".format(
+            table, len(rows), sum(1 for fft in rows if rows[fft] != old_rows.get(fft))))
+    return device
+
+
+def run_benchmarks(directory, fft_min, fft_max, passes):
+    '''Runs the CUDALucas benchmarks, which write the “<device> fft.txt” and “<device> threads.txt” files
+    Returns:
+    The FFT and threads result files
+    '''
+    start = time.time()
+    for args in (["-cufftbench", fft_min, fft_max, passes], ["-threadbench", fft_min, fft_max, passes, "0"]):
+        print("Running “./CUDALucas {0}”".format(" ".join(args)))
+        if subprocess.run(["./CUDALucas"] + args, cwd=directory).returncode:
+            sys.stderr.write("Error: CUDALucas {0} failed\n".format(args[0]))
+            sys.exit(1)
+    # The newest files, in case there are others from copied tables
+    files = [f for f in glob.glob(os.path.join(directory, "* fft.txt")) if os.path.getmtime(f) >= start]
+    if not files:
+        sys.stderr.write("Error: CUDALucas did not write a “<device> fft.txt” file\n")
+        sys.exit(1)
+    fft_file = max(files, key=os.path.getmtime)
+    threads_file = fft_file[:-len("fft.txt")] + "threads.txt"
+    return fft_file, threads_file if os.path.exists(threads_file) else None
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options] [CUDALucas directory | FFT file [threads file]]",
+                                   description="Runs the CUDALucas “-cufftbench” and “-threadbench” benchmarks and merges their results into the “<device> fft.txt” and “<device> threads.txt” tables, keeping the faster ms/iter for each FFT length.")
+    parser.add_option("-o", "--tables", dest="tables", default=TABLES,
+                      help="Directory of the tables, Default: %default")
+    parser.add_option("--no-bench", action="store_false", dest="bench", default=True,
+                      help="Do not run CUDALucas, only merge the given FFT and threads result files")
+    parser.add_option("--min", dest="min", default="1024", help="Minimum FFT length (K), Default: %default")
+    parser.add_option("--max", dest="max", default="8192", help="Maximum FFT length (K), Default: %default")
+    parser.add_option("--passes", dest="passes", default="5", help="Number of passes, Default: %default")
+    options, args = parser.parse_args()
+    if options.bench:
+        if len(args) > 1:
+            parser.error("Only one CUDALucas directory can be given")
+        fft_file, threads_file = run_benchmarks(args[0] if args else ".", options.min, options.max, options.passes)
+    else:
+        if not 1 <= len(args) <= 2:
+            parser.error("An FFT file and optionally a threads file are required with --no-bench")
+        fft_file, threads_file = args[0], args[1] if len(args) > 1 else None
+    if not os.path.isdir(options.tables):
+        os.makedirs(options.tables)
+    if merge_results(fft_file, threads_file, options.tables) is None:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
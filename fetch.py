@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+
+# Teal Dulcet and Daniel Connelly
+# Downloads files, checking their hash while they are streamed, resuming
+# partial downloads and keeping a local cache of the verified files
+# ./fetch.py [options] <URL> <Hash> [<URL> <Hash>]...
+# ./fetch.py https://www.mersenneforum.org/mayer/src/mlucas_v19.txz 10906d3f1f4206ae93ebdb045f36535c
+# ./fetch.py -c ~/.cache/gimps -m http://mirror.local/gimps https://www.mersenne.org/ftp_root/gimps/p95v303b6.linux64.tar.gz EE54B56062FEB05C9F80963A4E3AE8555D0E59CA60DDBCBA65CE05225C9B9A79
+
+import sys
+import os
+import shutil
+import hashlib
+import optparse
+import urllib.request
+import urllib.error
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+
+CHUNK = 128 * 1024
+# The hash algorithm is selected by the length of the hex digest
+ALGORITHMS = {32: "md5", 40: "sha1", 64: "sha256", 128: "sha512"}
+
+
+def new_hash(checksum):
+    '''Returns a new hash object for the algorithm of the hex digest checksum'''
+    if len(checksum) not in ALGORITHMS:
+        raise ValueError("Unknown hash algorithm for: " + checksum)
+    return hashlib.new(ALGORITHMS[len(checksum)])
+
+
+def hash_file(filename, h):
+    '''Updates the hash object h with the contents of filename
+    Returns:
+    The number of bytes read
+    '''
+    size = 0
+    b = bytearray(CHUNK)
+    mv = memoryview(b)
+    with open(filename, 'rb', buffering=0) as f:
+        for n in iter(lambda: f.readinto(mv), 0):
+            h.update(mv[:n])
+            size += n
+    return size
+
+
+def check_file(filename, checksum):
+    '''Checks if filename exists and has the hash checksum'''
+    if not os.path.isfile(filename):
+        return False
+    h = new_hash(checksum)
+    hash_file(filename, h)
+    return h.hexdigest() == checksum.lower()
+
+
+def cache_path(cache, checksum):
+    '''Path of a file in the local cache, which is keyed by its hash'''
+    return os.path.join(cache, ALGORITHMS[len(checksum)] + "-" + checksum.lower())
+
+
+def copy_file(src, dst):
+    '''Copies src to dst atomically, so a partial copy is never used'''
+    shutil.copyfile(src, dst + ".tmp")
+    os.replace(dst + ".tmp", dst)
+
+
+def download(url, filename, checksum, timeout=60):
+    '''Downloads url to filename, hashing it while it is streamed. A partial
+    “.part” file from a previous attempt is resumed with an HTTP Range request.
+    Returns:
+    True if the hash matches
+    '''
+    part = filename + ".part"
+    h = new_hash(checksum)
+    size = hash_file(part, h) if os.path.isfile(part) else 0
+    request = urllib.request.Request(url)
+    if size:
+        request.add_header("Range", "bytes={0}-".format(size))
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as r:
+            if size and r.status != 206:
+                # The server does not support resuming, start over
+                print("Server does not support resuming, downloading all of “" + url + "”")
+                h = new_hash(checksum)
+                size = 0
+            with open(part, "ab" if size else "wb") as f:
+                for chunk in iter(lambda: r.read(CHUNK), b""):
+                    h.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+    except urllib.error.HTTPError as e:
+        # Range not satisfiable, the partial file may already be complete
+        if e.code != 416:
+            sys.stderr.write("Error downloading “{0}”: {1}\n".format(url, e))
+            return False
+    except (urllib.error.URLError, OSError) as e:
+        sys.stderr.write("Error downloading “{0}”: {1}\n".format(url, e))
+        return False
+    if h.hexdigest() != checksum.lower():
+        sys.stderr.write("Error: {0}sum of “{1}” does not match\n".format(
+            ALGORITHMS[len(checksum)], url))
+        os.remove(part)
+        return False
+    os.replace(part, filename)
+    print("Downloaded “{0}” ({1:n} bytes)".format(url, size))
+    return True
+
+
+def fetch(url, checksum, filename=None, cache=None, mirror=None, retries=3):
+    '''Downloads url to filename, unless it is already in the cache or mirror
+    Parameters:
+    url (string): URL of the file
+    checksum (string): MD5, SHA-1, SHA-256 or SHA-512 hex digest of the file
+    filename (string): output file, default is the last component of the URL
+    cache (string): local directory of files keyed by their hash
+    mirror (string): URL or local directory with the same filenames, tried first
+    retries (int): number of times each download is attempted
+    Returns:
+    True if the file was fetched and its hash matches
+    '''
+    name = os.path.basename(urlparse(url).path)
+    if cache:
+        cache = os.path.expanduser(cache)
+    if filename is None:
+        filename = name
+    urls = [url]
+    fetched = False
+    if check_file(filename, checksum):
+        print("“" + filename + "” is already downloaded")
+        fetched = True
+    elif cache and check_file(cache_path(cache, checksum), checksum):
+        print("Copying “" + filename + "” from the cache")
+        copy_file(cache_path(cache, checksum), filename)
+        return True
+    elif mirror and os.path.isdir(mirror):
+        if check_file(os.path.join(mirror, name), checksum):
+            print("Copying “" + filename + "” from the mirror")
+            copy_file(os.path.join(mirror, name), filename)
+            fetched = True
+    elif mirror:
+        urls.insert(0, mirror.rstrip("/") + "/" + name)
+    if not fetched:
+        fetched = any(download(aurl, filename, checksum)
+                      for aurl in urls for _ in range(retries))
+    if not fetched:
+        return False
+    if cache and not check_file(cache_path(cache, checksum), checksum):
+        if not os.path.isdir(cache):
+            os.makedirs(cache)
+        copy_file(filename, cache_path(cache, checksum))
+    return True
+
+
+def fetch_all(files, cache=None, mirror=None):
+    '''Fetches the (url, checksum) pairs in files in parallel
+    Returns:
+    True if all the files were fetched
+    '''
+    with ThreadPoolExecutor(max_workers=max(len(files), 1)) as executor:
+        results = executor.map(lambda file: fetch(
+            file[0], file[1], cache=cache, mirror=mirror), files)
+        return all(list(results))
+
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser(usage="%prog [options] <URL> <Hash> [<URL> <Hash>]...",
+                                   description="Downloads the files in parallel, checking their MD5, SHA-1, SHA-256 or SHA-512 hash while they are streamed, resuming any partial downloads.")
+    parser.add_option("-c", "--cache", dest="cache", default=os.environ.get("GIMPS_CACHE"),
+                      help="Local cache directory of the verified files, keyed by their hash, Default: $GIMPS_CACHE")
+    parser.add_option("-m", "--mirror", dest="mirror", default=os.environ.get("GIMPS_MIRROR"),
+                      help="URL or local directory of a mirror with the same filenames, which is tried first, Default: $GIMPS_MIRROR")
+    options, args = parser.parse_args()
+    if not args or len(args) % 2:
+        parser.error("Each URL requires a hash")
+    sys.exit(0 if fetch_all(list(zip(args[::2], args[1::2])),
+                            options.cache, options.mirror) else 1)
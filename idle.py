@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+
+# Teal Dulcet and Daniel Connelly
+# Runs the GIMPS programs only when the computer has not been used in the specified idle time.
+# The workers are paused with SIGSTOP when someone uses the computer and resumed with SIGCONT,
+# instead of being killed, so no work is lost.
+# ./idle.py [options]
+# ./idle.py -t 600 --worker "$DIR" "./mprime -d"
+# ./idle.py -t 600 --worker "$DIR/run0" "nice ../Mlucas -cpu 0" --service "$DIR/run0" "python3 ../../primenet.py -d -c 0"
+
+import sys
+import os
+import glob
+import time
+import signal
+import optparse
+import subprocess
+
+# Touched in the directory of a worker whenever it is started or resumed, so
+# that the watchdog of the PrimeNet script does not count the time it was
+# paused as a stall
+RESUMED_FILE = "idle_resumed.txt"
+
+
+def user_idle_time():
+    '''Seconds since a terminal was last used, read directly from the access
+    times of the /dev tty devices (like “who -s” and “stat -c %X”)
+    Returns:
+    None if there are no terminals
+    '''
+    now = time.time()
+    atimes = []
+    for tty in glob.glob("/dev/pts/[0-9]*") + glob.glob("/dev/tty[0-9]*"):
+        try:
+            atimes.append(os.stat(tty).st_atime)
+        except OSError:
+            pass
+    if not atimes:
+        return None
+    return max(now - max(atimes), 0)
+
+
+def read_uptime():
+    '''Returns the uptime and the total idle time of all CPU threads in seconds from /proc/uptime'''
+    with open("/proc/uptime") as f:
+        uptime, idle = f.read().split()[:2]
+    return float(uptime), float(idle)
+
+
+def cpu_idle(last, uptime):
+    '''Fraction of the time that the CPU threads were idle between two readings of /proc/uptime
+    Returns:
+    None if there is no previous reading
+    '''
+    if last is None:
+        return None
+    return (uptime[1] - last[1]) / max((uptime[0] - last[0]) * os.cpu_count(), 1)
+
+
+class Worker:
+    '''A command run in its own process group in a directory, so that it and
+    all its children (e.g. from nice or a redirection) can be paused together'''
+
+    def __init__(self, directory, command, output="nohup.out"):
+        self.directory = directory
+        self.command = command
+        self.output = output
+        self.process = None
+        self.paused = False
+
+    def running(self):
+        return self.process is not None and self.process.poll() is None
+
+    def start(self):
+        print("Starting “{0}” in “{1}”".format(self.command, self.directory))
+        with open(os.path.join(self.directory, self.output), "ab") as out:
+            self.process = subprocess.Popen(self.command, shell=True, cwd=self.directory,
+                                            stdin=subprocess.DEVNULL, stdout=out, stderr=subprocess.STDOUT, start_new_session=True)
+        self.paused = False
+
+    def signal(self, sig):
+        try:
+            os.killpg(self.process.pid, sig)
+        except OSError:
+            pass
+
+    def pause(self):
+        if self.running() and not self.paused:
+            print("Pausing “{0}”".format(self.command))
+            self.signal(signal.SIGSTOP)
+            self.paused = True
+
+    def resume(self):
+        if not self.running():
+            self.start()
+        elif self.paused:
+            print("Resuming “{0}”".format(self.command))
+            self.signal(signal.SIGCONT)
+            self.paused = False
+        else:
+            return
+        with open(os.path.join(self.directory, RESUMED_FILE), "w") as f:
+            f.write("{0:.0f}\n".format(time.time()))
+
+
+def main():
+    parser = optparse.OptionParser(description="Runs the workers only when the computer has not been used in the specified idle time, pausing them with SIGSTOP when someone uses it and resuming them with SIGCONT. The services are kept running all the time.")
+    parser.add_option("-t", "--time", dest="time", type="float", default=10 * 60,
+                      help="Idle time to run in seconds, Default: %default seconds")
+    parser.add_option("-c", "--cpu_idle", dest="cpu_idle", type="float", default=0.5,
+                      help="Minimum fraction of the CPU that must have been idle since the last check to start or resume the workers, so that they do not compete with other programs, Default: %default")
+    parser.add_option("-i", "--interval", dest="interval", type="float", default=60,
+                      help="Seconds between checks, Default: %default seconds")
+    parser.add_option("--worker", dest="workers", nargs=2, action="append", default=[], metavar="DIR COMMAND",
+                      help="Directory and shell command of a worker to run only when the computer is idle. Can be given multiple times.")
+    parser.add_option("--service", dest="services", nargs=2, action="append", default=[], metavar="DIR COMMAND",
+                      help="Directory and shell command of a program to keep running, such as the PrimeNet script. Can be given multiple times.")
+    parser.add_option("-d", "--debug", action="store_true", dest="debug", default=False,
+                      help="Display the idle time on every check")
+    options, args = parser.parse_args()
+    if args or not options.workers:
+        parser.error("At least one --worker is required")
+
+    workers = [Worker(os.path.abspath(directory), command)
+               for directory, command in options.workers]
+    services = [Worker(os.path.abspath(directory), command)
+                for directory, command in options.services]
+
+    def stop(signum, frame):
+        # Do not leave the workers paused, but do not start the ones that are
+        # not running either
+        for worker in workers:
+            if worker.running() and worker.paused:
+                worker.signal(signal.SIGCONT)
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    last = None
+    while True:
+        idle = user_idle_time()
+        uptime = read_uptime()
+        cpu = cpu_idle(last, uptime)
+        last = uptime
+        if options.debug:
+            print("User idle time: {0}, CPU idle: {1}".format(
+                "no terminals" if idle is None else "{0:.0f} seconds".format(idle),
+                "unknown" if cpu is None else "{0:.1%}".format(cpu)))
+        if idle is not None and idle < options.time:
+            run = False
+        elif any(worker.running() and not worker.paused for worker in workers):
+            # The workers use the CPU themselves, so it is only checked
+            # while they are paused or stopped
+            run = True
+        else:
+            run = cpu is None or cpu >= options.cpu_idle
+        for worker in workers:
+            if run:
+                worker.resume()
+            else:
+                worker.pause()
+        for service in services:
+            if not service.running():
+                service.start()
+        sys.stdout.flush()
+        time.sleep(options.interval)
+
+
+if __name__ == "__main__":
+    main()
@@ -106,11 +106,19 @@ if [[ -n "$GPU" ]]; then
 fi
 
 echo -e "\nDownloading Mlucas\n"
-wget https://www.mersenneforum.org/mayer/src/$FILE2
-if [[ ! "$(md5sum $FILE2 | head -c 32)" == "$SUM" ]]; then
-	echo "Error: md5sum does not match" >&2
-	echo "Please run \"rm -r '$PWD'\" and try running this script again" >&2
-	exit 1
+# Set GIMPS_CACHE and/or GIMPS_MIRROR to reuse a verified copy instead of downloading it
+if [[ -e fetch.py ]]; then
+	if ! python3 fetch.py https://www.mersenneforum.org/mayer/src/$FILE2 "$SUM"; then
+		echo "Please run \"rm -r '$PWD'\" and try running this script again" >&2
+		exit 1
+	fi
+else
+	wget https://www.mersenneforum.org/mayer/src/$FILE2
+	if [[ ! "$(md5sum $FILE2 | head -c 32)" == "$SUM" ]]; then
+		echo "Error: md5sum does not match" >&2
+		echo "Please run \"rm -r '$PWD'\" and try running this script again" >&2
+		exit 1
+	fi
 fi
 echo -e "\nDecompressing the files\n"
 tar -xvf $FILE2
@@ -121,6 +129,11 @@ if [[ -e ../primenet.py ]]; then
 else
 	wget https://raw.github.com/tdulcet/Distributed-Computing-Scripts/master/primenet.py -nv
 fi
+if [[ -e ../idle.py ]]; then
+	cp ../idle.py .
+else
+	wget https://raw.github.com/tdulcet/Distributed-Computing-Scripts/master/idle.py -nv
+fi
 if command -v pip3 >/dev/null; then
 	echo -e "Installing the Requests library\n"
 	pip3 install requests
@@ -164,10 +177,33 @@ Mlucas: \$(OBJS)
 clean:
 	rm -f *.o
 EOF
-make -j "$CPU_THREADS"
-make clean
+# The binary is the same on identical computers, so it is cached by the Mlucas source, compiler flags (SIMD mode), compiler version and target microarchitecture
+# Set GIMPS_CACHE to a local directory and/or GIMPS_MIRROR to a directory or URL with the "Mlucas-<hash>" files to reuse it instead of compiling
+BIN="Mlucas-$({ echo "$SUM"; cat Makefile; gcc --version | head -n 1; gcc -march=native -Q --help=target 2>/dev/null; } | md5sum | head -c 32)"
+echo -e "Build cache file:\t$BIN\n"
+for src in ${GIMPS_CACHE:+"$GIMPS_CACHE/$BIN"} ${GIMPS_MIRROR:+"${GIMPS_MIRROR%/}/$BIN"}; do
+	if [[ -f "$src" ]]; then
+		cp "$src" Mlucas
+	elif [[ $src == *://* ]]; then
+		wget -q "$src" -O Mlucas || rm -f Mlucas
+	fi
+	if [[ -s Mlucas ]] && chmod +x Mlucas && ./Mlucas -fftlen 192 -iters 100 -radset 0 >/dev/null 2>&1; then
+		echo -e "Using the Mlucas binary from \"$src\"\n"
+		break
+	fi
+	rm -f Mlucas
+done
+if [[ ! -e Mlucas ]]; then
+	make -j "$CPU_THREADS"
+	make clean
+	if [[ -n "$GIMPS_CACHE" && -x Mlucas ]]; then
+		mkdir -p "$GIMPS_CACHE"
+		cp Mlucas "$GIMPS_CACHE/$BIN.tmp" && mv "$GIMPS_CACHE/$BIN.tmp" "$GIMPS_CACHE/$BIN"
+	fi
+fi
 echo -e "\nTesting Mlucas\n"
 ./Mlucas -fftlen 192 -iters 100 -radset 0
+SIMD=${ARGS[*]}
 ARGS=()
 echo -e "\nOptimizing Mlucas for your computer\nThis may take awhile…\n"
 if echo "${CPU[0]}" | grep -iq 'intel'; then
@@ -184,7 +220,29 @@ elif echo "${CPU[0]}" | grep -iq 'amd'; then
 else
 	ARGS+=( -cpu "0:$(( CPU_CORES - 1 ))" )
 fi
-./Mlucas -s m "${ARGS[@]}"
+# The self-test results are the same on identical computers, so they are cached by the Mlucas version, CPU model, SIMD mode and cores/threads
+# Set GIMPS_CACHE to a local directory and/or GIMPS_MIRROR to a directory or URL with the "mlucas-<hash>.cfg" files to reuse them
+CFG="mlucas-$(echo "$DIR2 ${CPU[0]} $SIMD $CPU_CORES/$CPU_THREADS ${ARGS[*]}" | md5sum | head -c 32).cfg"
+echo -e "Self-test cache file:\t$CFG\n"
+for src in ${GIMPS_CACHE:+"$GIMPS_CACHE/$CFG"} ${GIMPS_MIRROR:+"${GIMPS_MIRROR%/}/$CFG"}; do
+	if [[ -f "$src" ]]; then
+		cp "$src" mlucas.cfg
+	elif [[ $src == *://* ]]; then
+		wget -q "$src" -O mlucas.cfg || rm -f mlucas.cfg
+	fi
+	if grep -q 'msec/iter' mlucas.cfg 2>/dev/null; then
+		echo -e "Using the self-test results from \"$src\"\n"
+		break
+	fi
+	rm -f mlucas.cfg
+done
+if [[ ! -e mlucas.cfg ]]; then
+	./Mlucas -s m "${ARGS[@]}"
+	if [[ -n "$GIMPS_CACHE" ]] && grep -q 'msec/iter' mlucas.cfg 2>/dev/null; then
+		mkdir -p "$GIMPS_CACHE"
+		cp mlucas.cfg "$GIMPS_CACHE/$CFG.tmp" && mv "$GIMPS_CACHE/$CFG.tmp" "$GIMPS_CACHE/$CFG"
+	fi
+fi
 RUNS=()
 if echo "${CPU[0]}" | grep -iq 'intel'; then
 	echo -e "The CPU is Intel."
@@ -215,31 +273,29 @@ else
 	done
 fi
 echo -e "Registering computer with PrimeNet\n"
-python3 ../primenet.py -d -t 0 -T "$TYPE" -u "$USERID" --num_workers "${#RUNS[@]}" -H "$COMPUTER" --cpu_model="${CPU[0]}" --frequency="$(printf "%.0f" "$CPU_FREQ")" -m "$((TOTAL_PHYSICAL_MEM / 1024))" --np="$CPU_CORES" --hp="$HP"
+# Set GIMPS_GATEWAY to the URL of a PrimeNet gateway (primenet.py --gateway) to share it with the other GIMPS programs
+python3 ../primenet.py -d -t 0 -T "$TYPE" -u "$USERID" --num_workers "${#RUNS[@]}" -H "$COMPUTER" --cpu_model="${CPU[0]}" --frequency="$(printf "%.0f" "$CPU_FREQ")" -m "$((TOTAL_PHYSICAL_MEM / 1024))" --np="$CPU_CORES" --hp="$HP" ${GIMPS_GATEWAY:+--server "$GIMPS_GATEWAY"}
+ARGS=()
 for i in "${!RUNS[@]}"; do
 	echo -e "\nCPU Core $i:"
 	mkdir "run$i"
 	pushd "run$i" >/dev/null
 	ln -s ../mlucas.cfg .
-	echo -e "\tStarting PrimeNet\n"
 	ln -s ../local.ini .
-	nohup python3 ../../primenet.py -d -c "$i" &
-	sleep 1
-	echo -e "\n\tStarting Mlucas\n"
-	nohup nice ../Mlucas -cpu "${RUNS[i]}" &
-	sleep 1
+	# Read by the worker each time it starts, so that primenet.py --rebalance can change it
+	echo "${RUNS[i]}" > mlucas_cpu.txt
+	ARGS+=( --service "$DIR/run$i" "python3 ../../primenet.py -d -c $i" --worker "$DIR/run$i" 'nice ../Mlucas -cpu "$(cat mlucas_cpu.txt)"' )
 	popd >/dev/null
 done
-echo -e "\nSetting it to start if the computer has not been used in the specified idle time and stop it when someone uses the computer\n"
-#crontab -l | { cat; echo "$(for i in "${!RUNS[@]}"; do echo -n "(cd \"$DIR/run$i\" && nohup nice ../Mlucas -cpu \"${RUNS[i]}\" &); "; done)"; } | crontab -
-#crontab -l | { cat; echo "$(for i in "${!RUNS[@]}"; do echo -n "(cd \"$DIR/run$i\" && nohup python3 ../../primenet.py -d -c $i &); "; done)"; } | crontab -
+echo -e "\nStarting PrimeNet and setting Mlucas to start if the computer has not been used in the specified idle time and pause it when someone uses the computer\n"
 cat << EOF > Mlucas.sh
 #!/bin/bash
 
-# Start Mlucas
+# Start PrimeNet and Mlucas
 # Run: $DIR/Mlucas.sh
 
-if who -s | awk '{ print \$2 }' | (cd /dev && xargs -r stat -c '%U %X') | awk '{if ('"\${EPOCHSECONDS:-\$(date +%s)}"'-\$2<$TIME) { print \$1"\t"'"\${EPOCHSECONDS:-\$(date +%s)}"'-\$2; ++count }} END{if (count>0) { exit 1 }}' >/dev/null; then pgrep Mlucas >/dev/null || { $(for i in "${!RUNS[@]}"; do echo -n "(cd \"$DIR/run$i\" && nohup nice ../Mlucas -cpu \"${RUNS[i]}\" &); "; done) }; pgrep -f '^python3 \.\./\.\./primenet\.py' >/dev/null || { $(for i in "${!RUNS[@]}"; do echo -n "(cd \"$DIR/run$i\" && nohup python3 ../../primenet.py -d -c $i &); "; done) }; else pgrep Mlucas >/dev/null && killall Mlucas; fi
+cd "$DIR" && { pgrep -f '^python3 \.\./idle\.py' >/dev/null || nohup python3 ../idle.py -t $TIME $(printf '%q ' "${ARGS[@]}")>> idle.out & }
 EOF
 chmod +x Mlucas.sh
-crontab -l | { cat; echo "* * * * * \"$DIR\"/Mlucas.sh"; } | crontab -
+nohup ./Mlucas.sh &
+crontab -l | { cat; echo "@reboot \"$DIR\"/Mlucas.sh"; } | crontab -
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+
+# Daniel Connelly
+# Writes the Prime95/MPrime prime.txt and local.txt configuration files directly, instead of answering the
+# interactive questions of './mprime -m', and then contacts PrimeNet once to get work.
+# Python3 config.py <User ID> <Computer name> <Type of work> [Worker threads]
+
+import sys
+import subprocess
+
+
+def write_config(filename, options, workers=None):
+    '''Writes a Prime95 configuration file
+    Parameters:
+    filename (string): prime.txt or local.txt
+    options (list): (key, value) pairs of the global section
+    workers (list): list of (key, value) pairs lists, one for each [Worker #N] section
+    Returns:
+    None
+    '''
+    with open(filename, "w") as f:
+        for key, value in options:
+            f.write("{0}={1}\n".format(key, value))
+        for i, worker in enumerate(workers or []):
+            f.write("\n[Worker #{0}]\n".format(i + 1))
+            for key, value in worker:
+                f.write("{0}={1}\n".format(key, value))
+
+
+def configure(userid, computer, worktype, workers=1, use_primenet=True):
+    '''Writes prime.txt and local.txt in the current directory
+    Parameters:
+    userid (string): PrimeNet User ID
+    computer (string): Computer name
+    worktype (string): Type of work, the PrimeNet work preference
+    workers (int): Number of worker threads
+    use_primenet (bool): Let MPrime communicate with PrimeNet itself
+    Returns:
+    None
+    '''
+    write_config("prime.txt", [("V24OptionsConverted", 1), ("WGUID_version", 2), ("StressTester", 0),
+                               ("UsePrimenet", int(use_primenet)), ("DialUp", 0), ("V5UserID", userid),
+                               ("WorkPreference", worktype)],
+                 [[("WorkPreference", worktype)] for _ in range(workers)])
+    write_config("local.txt", [("ComputerID", computer), ("WorkerThreads", workers)])
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 4 or len(sys.argv) > 5:
+        sys.stderr.write("Usage: " + sys.argv[0] + " <User ID> <Computer name> <Type of work> [Worker threads]\n")
+        sys.exit(1)
+    USERID, COMPUTER, TYPE = sys.argv[1], sys.argv[2], sys.argv[3]
+    WORKERS = int(sys.argv[4]) if len(sys.argv) > 4 else 1
+    configure(USERID, COMPUTER, TYPE, WORKERS)
+    print("Wrote prime.txt and local.txt")
+    # Register the computer and get work, then exit
+    sys.exit(subprocess.run(["./mprime", "-c"]).returncode)
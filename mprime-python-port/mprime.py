@@ -9,8 +9,13 @@ import sys
 import subprocess
 import os
 import socket
+import shlex
 import re # regular expression matching
-import hashlib # sha256
+
+# fetch.py is shared with the Bash scripts in the parent directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from fetch import fetch
+from config import configure
 
 DIR = "mprime"
 FILE = "p95v303b6.linux64.tar.gz"
@@ -34,23 +39,6 @@ def misc_check(condition, err):
         sys.stderr.write(err)
         sys.exit(1)
 
-# Source: https://stackoverflow.com/questions/22058048/hashing-a-file-in-python
-# There is no sha256sum in the hashlib library normally
-def sha256sum(filename):
-    '''Completes a checksum of the folder
-    Parameters:
-    filename (string): directory to be checked
-    Returns:
-    The hash sum string in hexidecimal digits
-    '''
-    h  = hashlib.sha256()
-    b  = bytearray(128*1024)
-    mv = memoryview(b)
-    with open(filename, 'rb', buffering=0) as f:
-        for n in iter(lambda : f.readinto(mv), 0):
-            h.update(mv[:n])
-    return h.hexdigest()
-
 # Main script
 USERID = sys.argv[1] if len(sys.argv) > 1 else os.environ["USER"]
 COMPUTER = sys.argv[2] if len(sys.argv) > 2 else socket.gethostname()
@@ -66,15 +54,6 @@ print("Idle time to run:\t"+ str(int(TIME)//60) + " minutes\n")
 #---Dependencies/Downloads---#
 print("Asserting Python version is >= Python3.6")
 assert sys.version_info >= (3, 0)
-
-try:
-    import wget
-except ImportError as error:
-    print("Installing wget dependency")
-    p = subprocess.run('pip install wget', shell=True)
-    import wget
-except Exception as error:
-    misc_check(true, "Unexpected error occured when installing Python dependency:\n\n" + error)
 #----------------------------#
 
 #---Command Line Checks------#
@@ -93,34 +72,39 @@ os.chdir(DIR)
 os.environ["DIR"] = os.getcwd()
 
 print("\nDownloading Prime95\n")
-wget.download('https://www.mersenne.org/ftp_root/gimps/'+FILE)
-misc_check(sha256sum(FILE) == SUM, "Error: sha256sum does not match. Please run \"rm -r " + DIR + "\" and try running this script again")
+# Set GIMPS_CACHE and/or GIMPS_MIRROR to reuse a verified copy instead of downloading it
+misc_check(not fetch('https://www.mersenne.org/ftp_root/gimps/'+FILE, SUM, cache=os.environ.get("GIMPS_CACHE"), mirror=os.environ.get("GIMPS_MIRROR")),
+  "Error: sha256sum does not match. Please run \"rm -r " + DIR + "\" and try running this script again")
 
 print("\nDecompressing the files")
 subprocess.run(['tar', '-xzvf', FILE])
 #---------------------------------------#
 
 #---Configuration---#
-args = [USERID, COMPUTER, TYPE]
-
 print("Setting up Prime95.")
-p = subprocess.Popen(['python3', "../exp.py"] + args,
-  stdout=subprocess.PIPE,
-  universal_newlines=True,
-  bufsize=0)
-
-# This code block reads the output from the pexpect script p
-for line in p.stdout:
-    line=line[:-1]
-    print(line)
+# Write prime.txt and local.txt directly instead of answering the questions of './mprime -m'
+# Our PrimeNet script communicates with PrimeNet instead of MPrime (UsePrimenet=0)
+configure(USERID, COMPUTER, TYPE, use_primenet=False)
+PRIMENET = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir, "primenet.py"))
+# Set GIMPS_GATEWAY to the URL of a PrimeNet gateway (primenet.py --gateway) to share it with the other GIMPS programs
+SERVER = ["--server", os.environ["GIMPS_GATEWAY"]] if os.environ.get("GIMPS_GATEWAY") else []
+print("Registering with PrimeNet and getting work")
+misc_check(subprocess.run(["python3", PRIMENET, "-d", "-t", "0", "--prime95", "-T", TYPE, "-u", USERID, "-H", COMPUTER] + SERVER).returncode,
+  "Error: Failed to contact PrimeNet\n")
 #---------------------------------------#
 
 #---Starting Program---#
 print("Starting up Prime95.")
-subprocess.Popen("./mprime") # daemon process
-
-print("\nSetting it to start if the computer has not been used in the specified idle time and stop it when someone uses the computer\n")
-
-os.environ["TIME"] = TIME
-subprocess.Popen("crontab -l | { cat; echo \"* * * * * if who -s | awk \'{ print \\$2 }\' | (cd /dev && xargs -r stat -c \'\\%U \\%X\') | awk \'{if (\'\\\"\\${EPOCHSECONDS:-\\$(date +\\%s)}\\\"\'-\\$2<$TIME) { print \\$1\\\"\\t\\\"\'\\\"\\${EPOCHSECONDS:-\\$(date +\\%s)}\\\"\'-\\$2; ++count }} END{if (count>0) { exit 1 }}\' >/dev/null; then pgrep mprime >/dev/null || (cd \\\"$DIR\\\" && nohup ./mprime &); else pgrep mprime >/dev/null && killall mprime; fi\"; } | crontab -", shell=True)
+print("\nSetting it to start if the computer has not been used in the specified idle time and pause it when someone uses the computer\n")
+
+# idle.py pauses mprime with SIGSTOP instead of killing it, so no work is lost
+# With -d, mprime writes its progress to nohup.out, which the PrimeNet script reads
+IDLE = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir, "idle.py"))
+args = ["python3", IDLE, "-t", TIME, "--worker", os.environ["DIR"], "./mprime -d",
+        "--service", os.environ["DIR"], "python3 " + shlex.quote(PRIMENET) + " -d --prime95"]
+with open("idle.out", "ab") as out:
+  subprocess.Popen(args, stdout=out, stderr=subprocess.STDOUT, start_new_session=True) # daemon process
+
+os.environ["IDLE"] = " ".join(shlex.quote(arg) for arg in args)
+subprocess.Popen("crontab -l | { cat; echo \"@reboot cd \\\"$DIR\\\" && nohup $IDLE >> idle.out &\"; } | crontab -", shell=True)
 #----------------------#
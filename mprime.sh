@@ -54,11 +54,19 @@ fi
 cd "$DIR"
 DIR=$PWD
 echo -e "Downloading Prime95\n"
-wget https://www.mersenne.org/ftp_root/gimps/$FILE
-if [[ ! "$(sha256sum $FILE | head -c 64 | tr 'a-z' 'A-Z')" == "$SUM" ]]; then
-	echo "Error: sha256sum does not match" >&2
-	echo "Please run \"rm -r '$DIR'\" and try running this script again" >&2
-	exit 1
+# Set GIMPS_CACHE and/or GIMPS_MIRROR to reuse a verified copy instead of downloading it
+if [[ -e ../fetch.py ]]; then
+	if ! python3 ../fetch.py https://www.mersenne.org/ftp_root/gimps/$FILE "$SUM"; then
+		echo "Please run \"rm -r '$DIR'\" and try running this script again" >&2
+		exit 1
+	fi
+else
+	wget https://www.mersenne.org/ftp_root/gimps/$FILE
+	if [[ ! "$(sha256sum $FILE | head -c 64 | tr 'a-z' 'A-Z')" == "$SUM" ]]; then
+		echo "Error: sha256sum does not match" >&2
+		echo "Please run \"rm -r '$DIR'\" and try running this script again" >&2
+		exit 1
+	fi
 fi
 echo -e "\nDecompressing the files\n"
 tar -xzvf $FILE
@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 '''
-Automatic assignment handler for Mlucas and CUDALucas.
+Automatic assignment handler for Mlucas, CUDALucas and Prime95/MPrime.
 
 [*] Revised by Teal Dulcet and Daniel Connelly for CUDALucas (2020)
     Original Authorship(s):
@@ -46,6 +46,7 @@ import subprocess
 import random
 import uuid
 from collections import namedtuple
+from contextlib import contextmanager
 import sys
 import os.path
 import re
@@ -57,7 +58,19 @@ import json
 import platform
 import logging
 import csv
+import multiprocessing
+import mmap
+import glob
+import tarfile
+import io
+import signal
+import threading
+import cProfile
+import pstats
+import timeit
 import math
+import struct
+import hmac
 from decimal import Decimal
 import locale
 
@@ -81,6 +94,35 @@ except ImportError:
     from urllib2 import HTTPError
 
 
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+
+try:
+    # Python3
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qsl
+except ImportError:
+    # Python2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qsl
+
+try:
+    import sqlite3
+except ImportError:
+    # Python built without SQLite, the progress history is not recorded
+    sqlite3 = None
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2, the allocations are not profiled
+    tracemalloc = None
+
 try:
     from configparser import ConfigParser, Error as ConfigParserError
 except ImportError:
@@ -109,6 +151,23 @@ except ImportError:
         return math.log(x, 2)
 
 s = requests.Session()  # session that maintains our cookies
+session_local = threading.local()
+
+
+def session():
+    # A requests session is not thread-safe, so each thread of a cycle (and
+    # of the gateway) uses its own, sharing the cookies and headers of “s”.
+    # The simulated server of simulate() is shared.
+    result = getattr(session_local, "session", None)
+    if result is None:
+        if threading.current_thread().name == "MainThread" or not isinstance(s, requests.Session):
+            result = s
+        else:
+            result = requests.Session()
+            result.cookies = s.cookies
+            result.headers.update(s.headers)
+        session_local.session = result
+    return result
 
 # [***] Daniel Connelly's functions
 
@@ -127,29 +186,27 @@ def ra(n):
 
 
 # TODO -- have people set their own program options for commented out portions
-def program_options(guid, first_time, retry_count=0):
+def send_program_options(guid, cpu, worktype, days_work, retry_count=0):
     if retry_count > 5:
-        return
+        return None
     args = primenet_v5_bargs.copy()
     args["t"] = "po"
     args["g"] = guid
     # no value updates all cpu threads with given worktype
-    args["c"] = options.cpu
-    args["w"] = options.worktype if first_time \
-        or hasattr(opts_no_defaults, "worktype") else ""
+    args["c"] = cpu
+    args["w"] = worktype
     args["nw"] = options.nw
     # args["Priority"] = 1
-    args["DaysOfWork"] = options.days_work if first_time \
-        or hasattr(opts_no_defaults, "days_work") else ""
+    args["DaysOfWork"] = days_work
     # args["DayMemory"] = 8
     # args["NightMemory"] = 8
     # args["DayStartTime"] = 0
     # args["NightStartTime"] = 0
     # args["RunOnBattery"] = 1
     retry = False
-    debug_print("Exchanging program options with server")
+    debug_print("Exchanging program options with server for {0}".format(
+        "CPU core or GPU " + str(cpu) if cpu != "" else "all workers"))
     result = send_request(guid, args)
-    config_updated = False
     if result is None:
         parser.error("Error while setting program options on mersenne.org")
     else:
@@ -167,20 +224,60 @@ def program_options(guid, first_time, retry_count=0):
                 register_instance(guid)
                 retry = True
             if retry:
-                return program_options(guid, first_time, retry_count + 1)
+                return send_program_options(get_guid(config), cpu, worktype,
+                                            days_work, retry_count + 1)
             parser.error("Error while setting program options on mersenne.org")
-    if "w" in result:
-        config.set("primenet", "worktype", result["w"])
-        config_updated = True
-    if "DaysOfWork" in result:
-        config.set("primenet", "days_work", result["DaysOfWork"])
-        config_updated = True
-    if not config.has_option("primenet", "first_time"):
-        config.set("primenet", "first_time", "false")
-        config_updated = True
-    if "w" in result or "DaysOfWork" in result:
+    return result
+
+
+def program_options(guid, first_time):
+    # Exchange the options of all the workers at once, while holding the lock
+    # on the shared local.ini file, instead of each worker process sending its
+    # own transaction and racing the others to write the result.
+    with config_lock():
+        config_reload(config)
+        # Also take the options of this worker from the file, so that a
+        # worktype written by another process (e.g. --plan) is not reverted
+        merge_config_and_options(config, options)
+        pending = OrderedDict()
+        for cpu in range(options.nw):
+            section = worker_section(cpu)
+            worktype = config_get(config, section, "worktype")
+            days_work = config_get(config, section, "days_work")
+            if worktype is None:
+                worktype = options.worktype
+            if days_work is None:
+                days_work = options.days_work
+            sent = "{0},{1},{2}".format(worktype, days_work, options.nw)
+            if first_time or not config.has_option(section, "program_options") \
+                    or config.get(section, "program_options") != sent:
+                pending[cpu] = (str(worktype), str(days_work))
+        if not pending:
+            debug_print("Program options are already up to date on the server")
+            return
+        if len(pending) == options.nw and len(set(pending.values())) == 1:
+            # no cpu value updates all the workers in one transaction
+            exchanges = [("", list(pending), list(pending.values())[0])]
+        else:
+            exchanges = [(cpu, [cpu], values)
+                         for cpu, values in pending.items()]
+        for cpu, cpus, (worktype, days_work) in exchanges:
+            result = send_program_options(
+                get_guid(config) or guid, cpu, worktype, days_work)
+            if result is None:
+                return
+            for acpu in cpus:
+                section = worker_section(acpu)
+                if not config.has_section(section):
+                    config.add_section(section)
+                config.set(section, "worktype", result.get("w", worktype))
+                config.set(section, "days_work",
+                           result.get("DaysOfWork", days_work))
+                config.set(section, "program_options", "{0},{1},{2}".format(config.get(
+                    section, "worktype"), config.get(section, "days_work"), options.nw))
+        if not config.has_option("primenet", "first_time"):
+            config.set("primenet", "first_time", "false")
         merge_config_and_options(config, options)
-    if config_updated:
         config_write(config)
 
 
@@ -206,7 +303,7 @@ def unreserve(assignment, retry_count=0):
     else:
         rc = int(result["pnErrorResult"])
         if rc == primenet_api.ERROR_OK:
-            pass
+            dead_tasks[assignment.uid] = "Unreserved"
         else:
             debug_print("ERROR while releasing assignment on mersenne.org: assignment_id={0}".format(
                 assignment.uid), file=sys.stderr)
@@ -215,22 +312,134 @@ def unreserve(assignment, retry_count=0):
                     "UNREGISTERED CPU ERROR: pick a new GUID and register again")
                 register_instance(None)
                 retry = True
+            elif rc is primenet_api.ERROR_INVALID_ASSIGNMENT_KEY:
+                dead_tasks[assignment.uid] = errors[rc]
     if retry:
         return unreserve(assignment, retry_count + 1)
 
 
 def unreserve_all():
-    tasks = readonly_list_file(workfile)
+    tasks = read_workfile()
     if not len(tasks):
         return
     for task in tasks:
         assignment = parse_assignment(task)
         unreserve(assignment)
-        # TODO: Delete task from workfile
-    # os.remove(workfile)
+    compact_workfile()
     debug_print("Successfully quit GIMPS.")
 
 
+def checkpoint_files(p):
+    # The save files of the GIMPS program for the exponent p
+    if options.gpu:  # CUDALucas
+        patterns = ["c{0}", "t{0}"]
+    elif options.prime95:
+        patterns = ["[pP]{0}", "[pP]{0}.*", "[pP]{0}_*"]
+    else:  # Mlucas
+        patterns = ["p{0}", "q{0}", "p{0}.*", "q{0}.*"]
+    files = set()
+    for pattern in patterns:
+        files.update(glob.glob(os.path.join(workdir, pattern.format(p))))
+    return sorted(os.path.basename(file) for file in files)
+
+
+def drain(bundle):
+    # Unreserve the assignments that have not started and move the others,
+    # with their save files, to a bundle that can be imported on another
+    # computer with --import_bundle, so that no iterations are lost.
+    # The GIMPS program must be stopped first.
+    drained = []
+    for task in read_workfile():
+        assignment = parse_assignment(task)
+        if not assignment or not workpattern.search(task):
+            continue
+        if options.prime95:
+            iteration = 0
+        elif not options.gpu:
+            iteration, _, _ = parse_stat_file(assignment.n)
+        else:
+            iteration, _, _ = parse_stat_file_cuda(assignment.n)
+        files = checkpoint_files(assignment.n)
+        if iteration or files:
+            drained.append({"task": task, "exponent": assignment.n, "iteration": iteration,
+                            "remaining": assignment.n - iteration, "files": files})
+        else:
+            debug_print("Exponent {0} has not started, unreserving it".format(
+                assignment.n))
+            unreserve(assignment)
+    # Closest to done first
+    drained.sort(key=lambda entry: entry["remaining"])
+    if drained:
+        manifest = {"program": program, "hostname": options.hostname,
+                    "created": time.strftime('%Y-%m-%d %H:%M:%S'), "tasks": drained}
+        filename = os.path.abspath(bundle)
+        with tarfile.open(filename + ".tmp", "w:gz") as tar:
+            data = json.dumps(manifest, indent=4).encode("utf-8")
+            info = tarfile.TarInfo("manifest.json")
+            info.size = len(data)
+            info.mtime = time.time()
+            tar.addfile(info, io.BytesIO(data))
+            added = set()
+            for entry in drained:
+                for file in entry["files"]:
+                    if file not in added:
+                        tar.add(os.path.join(workdir, file), arcname=file)
+                        added.add(file)
+        replace_file(filename + ".tmp", filename)
+        for entry in drained:
+            debug_print("Exponent {0} is {1:.4%} done ({2:n} iterations remaining), added it to “{3}” with: {4}".format(
+                entry["exponent"], entry["iteration"] / entry["exponent"], entry["remaining"], bundle, ", ".join(entry["files"]) or "no save files"))
+            dead_tasks[workpattern.search(entry["task"]).group(2)] = "Drained to “" + bundle + "”"
+    compact_workfile()
+    debug_print("Drained {0:n} assignment(s) to “{1}”".format(len(drained), bundle))
+
+
+def import_bundle(bundle):
+    # Add the assignments and save files of a bundle from --drain
+    with tarfile.open(bundle, "r:gz") as tar:
+        names = set(tar.getnames())
+        if "manifest.json" not in names:
+            debug_print("ERROR: “{0}” is not a bundle from --drain, it does not have a manifest".format(
+                bundle), file=sys.stderr)
+            return
+        manifest = json.loads(tar.extractfile("manifest.json").read().decode("utf-8"))
+        if manifest["program"] != program:
+            debug_print("ERROR: “{0}” is from {1}, not {2}".format(
+                bundle, manifest["program"], program), file=sys.stderr)
+            return
+        # Refuse the whole bundle before changing anything
+        missing = [file for entry in manifest["tasks"]
+                   for file in entry["files"] if file not in names]
+        if missing:
+            debug_print("ERROR: “{0}” is incomplete, it does not have: {1}".format(
+                bundle, ", ".join(missing)), file=sys.stderr)
+            return
+        tasks = read_workfile()
+        new_tasks = []
+        for entry in manifest["tasks"]:
+            if entry["task"] in tasks:
+                debug_print("Exponent {0} is already in “{1}”".format(
+                    entry["exponent"], workfile))
+                continue
+            for file in entry["files"]:
+                # Only plain filenames, never paths outside workdir
+                if os.path.basename(file) != file or file.startswith("."):
+                    continue
+                if os.path.exists(os.path.join(workdir, file)):
+                    debug_print("ERROR: “{0}” already exists, not overwriting it".format(
+                        file), file=sys.stderr)
+                    continue
+                if hasattr(tarfile, "data_filter"):
+                    tar.extract(file, workdir, filter="data")
+                else:
+                    tar.extract(file, workdir)
+            debug_print("Imported exponent {0} from {1} at iteration {2:n}".format(
+                entry["exponent"], manifest["hostname"], entry["iteration"]))
+            new_tasks.append(entry["task"])
+    add_tasks(new_tasks)
+    output_status()
+
+
 def get_cpu_signature():
     output = ""
     if platform.system() == "Windows":
@@ -256,6 +465,22 @@ def get_cpu_name(signature):
     return search.group(0) if search else ""
 
 
+def get_physical_memory():
+    '''Total physical memory (RAM) in MiB, 0 if unknown'''
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * \
+            os.sysconf('SC_PHYS_PAGES') // (1024 * 1024)
+    except (AttributeError, ValueError, OSError):
+        return 0
+
+
+def get_cpu_threads():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 0
+
+
 cpu_signature = get_cpu_signature()
 cpu_brand = get_cpu_name(cpu_signature)
 
@@ -364,7 +589,16 @@ errors = {
     primenet_api.ERROR_NO_ASSIGNMENT: "No assignment",
     primenet_api.ERROR_INVALID_ASSIGNMENT_KEY: "Invalid assignment key",
     primenet_api.ERROR_INVALID_ASSIGNMENT_TYPE: "Invalid assignment type",
-    primenet_api.ERROR_INVALID_RESULT_TYPE: "Invalid result type"}
+    primenet_api.ERROR_INVALID_RESULT_TYPE: "Invalid result type",
+    primenet_api.ERROR_INVALID_WORK_TYPE: "Invalid work type",
+    primenet_api.ERROR_WORK_NO_LONGER_NEEDED: "Work no longer needed"}
+
+# Assignments to remove from the workfile, with the reason
+dead_tasks = OrderedDict()
+# Serializes the changes to the workfile, dead_tasks and progress_sent
+# between the threads of a cycle
+work_mutex = threading.RLock()
+workfile_lock_depth = 0  # only changed while holding work_mutex
 
 
 def debug_print(*args, **kwargs):
@@ -399,6 +633,147 @@ def readonly_list_file(filename, mode="r"):
         return []
 
 
+@contextmanager
+def mapped_file(filename):
+    # Map the file read-only, so that the byte regexes can run directly over
+    # the buffer without reading it into lines. Yields an empty buffer if the
+    # file does not exist or is empty (which cannot be mapped).
+    try:
+        with open(filename, "rb") as File:
+            if os.fstat(File.fileno()).st_size:
+                buf = mmap.mmap(File.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                buf = b""
+    except (IOError, OSError):
+        buf = b""
+    try:
+        yield buf
+    finally:
+        if buf:
+            buf.close()
+
+
+def line_spans(buf, reverse=False):
+    # Yields the (start, end) offsets of each line in the buffer, without the
+    # newline, from the last line if reverse
+    size = len(buf)
+    if size and buf[size - 1:size] == b"\n":
+        size -= 1
+    if not reverse:
+        start = 0
+        while start < size:
+            end = buf.find(b"\n", start, size)
+            if end == -1:
+                end = size
+            yield start, end
+            start = end + 1
+    else:
+        end = size
+        while end > 0:
+            start = buf.rfind(b"\n", 0, end) + 1
+            yield start, end
+            end = start - 1
+
+
+def decode_span(buf, start, end):
+    line = buf[start:end].rstrip()
+    return line if str is bytes else line.decode("utf-8", "replace")
+
+
+def scan_lines(filename, pattern):
+    # Returns the lines of the file with a match for the byte regex. Only the
+    # matching lines are decoded, each one once.
+    lines = []
+    with mapped_file(filename) as buf:
+        last = -1
+        for res in pattern.finditer(buf):
+            if res.start() < last:
+                continue  # another match on a line that was already added
+            start = buf.rfind(b"\n", 0, res.start()) + 1
+            end = buf.find(b"\n", res.end())
+            if end == -1:
+                end = len(buf)
+            lines.append(decode_span(buf, start, end))
+            last = end
+    return lines
+
+
+workerpattern = re.compile(r'^\[Worker #(\d+)\]$')
+
+
+def read_workfile():
+    # Prime95/MPrime share one workfile between all the workers, with a
+    # [Worker #N] section for each one. Only return the tasks of this worker.
+    tasks = readonly_list_file(workfile)
+    if not any(workerpattern.match(task) for task in tasks):
+        return tasks
+    worker = 1
+    mytasks = []
+    for task in tasks:
+        res = workerpattern.match(task)
+        if res:
+            worker = int(res.group(1))
+        elif worker == options.cpu + 1:
+            mytasks.append(task)
+    return mytasks
+
+
+@contextmanager
+def workfile_lock():
+    # Like config_lock(), for the workfile, so that the other instances of
+    # the script on it (e.g. --drain and --import_bundle) wait for a change
+    global workfile_lock_depth
+    with work_mutex:
+        with open(os.path.realpath(workfile) + ".lock", "a") as lockfile:
+            if fcntl and not workfile_lock_depth:
+                fcntl.flock(lockfile, fcntl.LOCK_EX)
+            workfile_lock_depth += 1
+            try:
+                yield
+            finally:
+                workfile_lock_depth -= 1
+                if fcntl and not workfile_lock_depth:
+                    fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+
+def replace_workfile(tasks, new_tasks):
+    # Mlucas does not lock the workfile and rewrites it itself when it
+    # finishes an assignment, so it is only replaced if it still has the tasks
+    # it was read with. Otherwise an assignment that Mlucas just removed would
+    # be brought back.
+    filename = os.path.realpath(workfile)
+    with open(filename + ".tmp", "w") as File:
+        File.writelines(task + "\n" for task in new_tasks)
+    if readonly_list_file(workfile) != tasks:
+        os.remove(filename + ".tmp")
+        return False
+    replace_file(filename + ".tmp", filename)
+    return True
+
+
+def add_tasks(new_tasks):
+    # Append the tasks to the workfile, at the end of the [Worker #N] section
+    # of this worker if there are sections
+    with workfile_lock():
+        while True:
+            tasks = readonly_list_file(workfile)
+            if not new_tasks or not any(workerpattern.match(task) for task in tasks):
+                write_list_file(workfile, new_tasks, "a")
+                return
+            header = "[Worker #{0}]".format(options.cpu + 1)
+            new = list(tasks)
+            if header not in new:
+                new += [header] + new_tasks
+            else:
+                i = new.index(header) + 1
+                while i < len(new) and not workerpattern.match(new[i]):
+                    i += 1
+                new[i:i] = new_tasks
+            if replace_workfile(tasks, new):
+                return
+            debug_print("“{0}” changed while adding the assignments, trying again".format(workfile))
+
+
 def write_list_file(filename, line, mode="w"):
     # A "null append" is meaningful, as we can call this to clear the
     # lockfile. In this case the main file need not be touched.
@@ -420,15 +795,16 @@ def isPrime(n):
 
 
 def output_status():
-    tasks = readonly_list_file(workfile)
+    tasks = read_workfile()
     debug_print(
         "Below is a report on the work you have queued and any expected completion dates.")
     if not len(tasks):
         debug_print("No work queued up.")
         return
     msec_per_iter = None
-    if config.has_option("primenet", "usec_per_iter"):
-        msec_per_iter = float(config.get("primenet", "usec_per_iter"))
+    section = worker_section(options.cpu)
+    if config.has_option(section, "usec_per_iter"):
+        msec_per_iter = float(config.get(section, "usec_per_iter"))
     cur_time_left = 0
     ll_and_prp_cnt = 0
     prob = 0.0
@@ -501,6 +877,116 @@ def output_status():
                 ll_and_prp_cnt, "Mersenne " if mersennes else "", int(1.0 / prob), prob))
 
 
+# Approximate exponents currently assigned for each worktype, used by --plan
+# until the server has given this computer an assignment of that worktype.
+# The exponent of the last one is saved as “plan_exponent_<worktype>” in the
+# “primenet” section of the local.ini file, where it can also be set.
+PLAN_EXPONENTS = {
+    primenet_api.PRIMENET_WP_LL_FIRST: 120000000,
+    primenet_api.PRIMENET_WP_LL_DBLCHK: 70000000,
+    primenet_api.PRIMENET_WP_LL_WORLD_RECORD: 140000000,
+    primenet_api.PRIMENET_WP_LL_100M: 333000000,
+    primenet_api.PRIMENET_WP_PRP_FIRST: 120000000,
+    primenet_api.PRIMENET_WP_PRP_DBLCHK: 100000000,
+    primenet_api.PRIMENET_WP_PRP_WORLD_RECORD: 140000000,
+    primenet_api.PRIMENET_WP_PRP_100M: 333000000}
+# The work left to verify an exponent after a PRP test with a proof: the
+# certificate, about 1% of the test
+PLAN_CERT_COST = 0.01
+# How many verified exponents a new Mersenne prime is worth to --plan, so
+# that both terms of its objective are about the same size at the current
+# exponents (the chance of a new prime is about 1 in a million per test)
+PLAN_PRIME_VALUE = 10**6
+
+
+def fft_words(p):
+    # Approximate FFT length needed for the exponent p, the bits per word
+    # decrease slowly with the FFT length (about 18.6 at 1M, 17.3 at 32M)
+    words = p / 18.6
+    for _ in range(4):
+        words = p / (18.6 - 0.26 * log2(max(words / 2**20, 1)))
+    return words
+
+
+def estimate_test(p, worktype, msec_per_iter, fftlen):
+    # The estimated days for one test of the exponent p, from the measured
+    # speed at the FFT length fftlen, assuming O(n log n) scaling, and the
+    # chance it finds a new Mersenne prime, like in output_status()
+    words = fft_words(p)
+    msec = msec_per_iter * (words / fftlen) * log2(words) / log2(fftlen)
+    ll = worktype < primenet_api.PRIMENET_WP_PRP_FIRST
+    double_check = worktype in (primenet_api.PRIMENET_WP_LL_DBLCHK, primenet_api.PRIMENET_WP_PRP_DBLCHK)
+    error_rate = ERROR_RATE if ll else PRP_ERROR_RATE
+    # A bad result has to be done again
+    days = p * msec * (1 + error_rate) / 1000 / (24 * 60 * 60)
+    # About the current trial factoring depth (e.g. 76 bits at 120M)
+    bits = int(2 * log2(p) + 23)
+    prob = (bits - 1) * 1.733 * (error_rate if double_check else 1.0) / p
+    return days, prob
+
+
+def verified_share(worktype):
+    # The share of the verification of an exponent that one test does: a
+    # first-time LL test needs a double-check, as does a PRP test without a
+    # proof, while with a proof (Prime95/MPrime) only the certificate is left
+    if worktype in (primenet_api.PRIMENET_WP_LL_DBLCHK, primenet_api.PRIMENET_WP_PRP_DBLCHK):
+        return 0.5
+    if worktype >= primenet_api.PRIMENET_WP_PRP_FIRST and options.prime95:
+        return 1 - PLAN_CERT_COST
+    return 0.5
+
+
+def plan_exponent(worktype):
+    # The exponent of the last assignment of the worktype from the server
+    option = "plan_exponent_{0}".format(worktype)
+    if config.has_option("primenet", option):
+        return int(config.get("primenet", option))
+    return PLAN_EXPONENTS[worktype]
+
+
+def plan(guid):
+    # Choose the worktype with the most useful throughput on this worker, the
+    # exponents verified per day plus the expected new primes per day (worth
+    # PLAN_PRIME_VALUE exponents each), among those where one test finishes
+    # within --days_work days
+    section = worker_section(options.cpu)
+    if not config.has_option(section, "usec_per_iter") or not config.has_option(section, "fftlen"):
+        parser.error("The speed of this worker is not known yet, run the GIMPS program for a while first")
+    msec_per_iter = float(config.get(section, "usec_per_iter"))
+    fftlen = int(config.get(section, "fftlen"))
+    names = dict((value, name) for name, value in option_dict.items())
+    best = None
+    debug_print("Worktype            Exponent  FFT length  Days/test  Chance/test  Verified/year  Primes/year      Score")
+    for worktype in sorted(supported):
+        p = plan_exponent(worktype)
+        days, prob = estimate_test(p, worktype, msec_per_iter, fftlen)
+        verified = verified_share(worktype) / days
+        primes = prob / days
+        score = verified + PLAN_PRIME_VALUE * primes
+        feasible = days <= options.days_work
+        debug_print("{0:<18} {1:>9n}  {2:>9n}K  {3:>9.1f}  {4:>11.3g}  {5:>13.2f}  {6:>11.3g}  {7:>9.4f}{8}".format(
+            names.get(worktype, worktype), p, int(fft_words(p) / 1024), days, prob, verified * 365, primes * 365, score,
+            "" if feasible else " (longer than {0:n} days)".format(options.days_work)))
+        if feasible and (best is None or score > best[1]):
+            best = (worktype, score)
+    if best is None:
+        # Nothing fits, do the shortest tests
+        best = (min(supported, key=plan_exponent), 0)
+    worktype = str(best[0])
+    debug_print("Best worktype: {0} ({1})".format(names.get(best[0], worktype), worktype))
+    if worktype == str(options.worktype):
+        debug_print("The worktype is already {0}".format(worktype))
+        return
+    options.worktype = worktype
+    with config_lock():
+        config_reload(config)
+        config.set(section, "worktype", worktype)
+        config_write(config)
+        if guid is not None and not options.password:
+            # Sends the new worktype to PrimeNet
+            program_options(guid, False)
+
+
 def primenet_fetch(num_to_get, retry_count=0):
     if options.password and not primenet_login:
         return []
@@ -543,7 +1029,7 @@ def primenet_fetch(num_to_get, retry_count=0):
             ))
             # debug_print("Fetching work via URL = " +
             # openurl + urlencode(assignment))
-            r = s.post(
+            r = session().post(
                 primenet_baseurl +
                 "manual_assignment/?",
                 data=assignment)
@@ -658,6 +1144,10 @@ def primenet_fetch(num_to_get, retry_count=0):
                 tests.append(test)
                 debug_print(
                     "Got assignment {0}: {1} {2}".format(r['k'], work_type_str, r['n']))
+                if w != primenet_api.PRIMENET_WORK_TYPE_CERT:
+                    # The current range of the worktype, for --plan
+                    with config_mutex:
+                        config.set("primenet", "plan_exponent_{0}".format(options.worktype), r['n'])
 
             return tests
     except ConnectionError:
@@ -665,8 +1155,60 @@ def primenet_fetch(num_to_get, retry_count=0):
         return []
 
 
+aidpattern = re.compile(br'"aid"\s*:\s*"([0-9A-F]{32})"|\bAID: ([0-9A-F]{32})\b')
+# Only the final LL and PRP results finish an assignment. A P-1 result, done
+# before the test, has the same assignment ID as the test that is running.
+finalpattern = re.compile(
+    br'"worktype"\s*:\s*"(?:LL|PRP)[^"]*"|\bis (?:not )?(?:a probable )?prime\b')
+
+
+def compact_workfile():
+    # Atomically rewrite the workfile without the assignments that are
+    # finished or that the server does not want any more, so that they are not
+    # counted toward num_cache or sent progress again
+    with workfile_lock():
+        tasks = readonly_list_file(workfile)
+        if not tasks:
+            return 0
+        finished = set()
+        with mapped_file(resultsfile) as buf:
+            for res in aidpattern.finditer(buf):
+                start = buf.rfind(b"\n", 0, res.start()) + 1
+                end = buf.find(b"\n", res.end())
+                if finalpattern.search(buf, start, end if end != -1 else len(buf)):
+                    finished.add((res.group(1) or res.group(2)).decode("ascii"))
+        kept = []
+        removed = []
+        for task in tasks:
+            found = workpattern.search(task)
+            uid = found.group(2) if found else None
+            reason = dead_tasks.get(uid)
+            if reason is None and uid in finished:
+                reason = "Result found in “" + resultsfile + "”"
+            if reason is None:
+                kept.append(task)
+            else:
+                removed.append((task, reason))
+        if not removed:
+            return 0
+        if not replace_workfile(tasks, kept):
+            # Compacted with the next cycle
+            debug_print("“{0}” changed while compacting it".format(workfile))
+            return 0
+        now = time.strftime('%c')
+        write_list_file(removedfile, ["{0}\t{1}\t{2}".format(
+            now, reason, task) for task, reason in removed], "a")
+        for task, reason in removed:
+            debug_print("Removed “{0}” from “{1}”: {2}".format(
+                task, workfile, reason))
+            dead_tasks.pop(workpattern.search(task).group(2), None)
+        return len(removed)
+
+
 def get_assignment(progress):
-    tasks = readonly_list_file(workfile)
+    compact_workfile()
+    # Only count the valid assignments toward num_cache
+    tasks = greplike(workpattern, read_workfile())
     (percent, time_left) = None, None
     if progress is not None and isinstance(
             progress, tuple) and len(progress) == 2:
@@ -688,13 +1230,16 @@ def get_assignment(progress):
         debug_print(
             "“" + workfile + "” already has {0:n} >= {1:n} entries, not getting new work".format(
                 len(tasks), num_cache))
-        return 0
+        return []
     debug_print(
         "“" + workfile + "” has {0:n} < {1:n} entries".format(
             len(tasks), num_cache))
     debug_print("Fetching {0:n} assignments".format(num_to_get))
 
     new_tasks = primenet_fetch(num_to_get)
+    if new_tasks and not options.password:
+        # Saves the exponents for --plan
+        config_write(config)
     num_fetched = len(new_tasks)
     if num_fetched > 0:
         debug_print("Fetched {0:n} assignments:".format(num_fetched))
@@ -703,22 +1248,128 @@ def get_assignment(progress):
                 debug_print("ERROR: Invalid assignment {0}".format(new_task))
             else:
                 debug_print("{0}".format(new_task))
-    write_list_file(workfile, new_tasks, "a")
+    add_tasks(new_tasks)
     output_status()
     if num_fetched < num_to_get:
         debug_print(
             "Error: Failed to obtain requested number of new assignments, {0:n} requested, {1:n} successfully retrieved".format(
                 num_to_get, num_fetched))
-    return num_fetched
+    return [task for task in new_tasks if workpattern.search(task)]
 
 
-resultpattern = re.compile(r"Program: E|Mlucas|CUDALucas v")
+def update_progress_new(tasks, progress):
+    # Send the progress of just the new assignments, which are after all the
+    # existing ones, instead of updating every assignment again
+    section = worker_section(options.cpu)
+    msec_per_iter = None
+    if config.has_option(section, "usec_per_iter"):
+        msec_per_iter = float(config.get(section, "usec_per_iter"))
+    cur_time_left = None if msec_per_iter is None else 0
+    if progress is not None and progress[1] is not None:
+        cur_time_left = progress[1]
+    now = datetime.now()
+    for task in tasks:
+        assignment, iteration, _, fftlen = get_progress_assignment(task)
+        _, cur_time_left = update_progress(
+            assignment, iteration, msec_per_iter, fftlen, now, cur_time_left)
 
 
-def mersenne_find(line, complete=True):
-    # Pre-v19 old-style HRF-formatted result used "Program:..."; starting
-    # w/v19 JSON-formatted result uses "program",
-    return resultpattern.search(line)
+def start_thread(target, *args):
+    if options.profile:
+        # The phases are run one after the other, so that the allocations of
+        # each one can be measured separately
+        target(*args)
+        return None
+    thread = threading.Thread(target=target, args=args)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+# Number of cycles in the rolling --profile summary
+PROFILE_CYCLES = 24
+profile_cycle = 1
+profile_spans = OrderedDict()  # phase -> [(cycle, seconds, allocation peak, .prof file)]
+
+
+def profile_phase(name, func, *args):
+    # Run one phase of the main loop, in a cProfile and tracemalloc span with --profile
+    if not options.profile:
+        return func(*args)
+    if tracemalloc is not None:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        # Also resets the peak, so only the allocations of this phase are counted
+        tracemalloc.clear_traces()
+    profiler = cProfile.Profile()
+    start = timeit.default_timer()
+    profiler.enable()
+    try:
+        return func(*args)
+    finally:
+        profiler.disable()
+        elapsed = timeit.default_timer() - start
+        peak = tracemalloc.get_traced_memory()[1] if tracemalloc is not None else None
+        filename = os.path.join(options.profile, "cycle{0}-{1}.prof".format(profile_cycle, name))
+        profiler.dump_stats(filename)
+        profile_spans.setdefault(name, []).append((profile_cycle, elapsed, peak, filename))
+
+
+def profile_summary():
+    # Rewrite the summary of the phases over the last PROFILE_CYCLES cycles,
+    # with their top functions, and remove the older .prof files
+    global profile_cycle
+    with open(os.path.join(options.profile, "profile_summary.txt"), "w") as File:
+        File.write("Cycles {0:n} to {1:n}\n\n".format(max(profile_cycle - PROFILE_CYCLES + 1, 1), profile_cycle))
+        File.write("{0:<20} {1:>6} {2:>10} {3:>10} {4:>16}\n".format(
+            "Phase", "Spans", "Mean (s)", "Max (s)", "Max alloc (KiB)"))
+        for name, spans in profile_spans.items():
+            for span in [span for span in spans if span[0] <= profile_cycle - PROFILE_CYCLES]:
+                spans.remove(span)
+                if os.path.exists(span[3]):
+                    os.remove(span[3])
+            if not spans:
+                continue
+            peaks = [peak for _, _, peak, _ in spans if peak is not None]
+            File.write("{0:<20} {1:6n} {2:10.4f} {3:10.4f} {4:>16}\n".format(
+                name, len(spans), sum(elapsed for _, elapsed, _, _ in spans) / len(spans),
+                max(elapsed for _, elapsed, _, _ in spans), "{0:n}".format(max(peaks) // 1024) if peaks else "-"))
+        for name, spans in profile_spans.items():
+            if not spans:
+                continue
+            File.write("\n{0}, top functions by cumulative time:\n".format(name))
+            stats = pstats.Stats(*[filename for _, _, _, filename in spans], stream=File)
+            stats.sort_stats("cumulative").print_stats(10)
+    profile_cycle += 1
+
+
+def run_cycle():
+    # The phases overlap: the results are submitted while the progress is
+    # collected, and since the progress (and so the queue depth) is computed
+    # locally, getting new assignments starts right away, while the progress
+    # is sent. A cycle takes about one network round-trip instead of four.
+    submitter = start_thread(profile_phase, "submit_work", submit_work)
+    pending = []
+    # It changes the config, which the submitter thread may also change if
+    # it needs to register again
+    with config_mutex:
+        progress = profile_phase("update_progress_all", update_progress_all, pending)
+    sender = start_thread(profile_phase, "send_progress",
+                          lambda: [send_progress(*args) for args in pending])
+    new_tasks = profile_phase("get_assignment", get_assignment, progress)
+    debug_print("Got: {0:n}".format(len(new_tasks)))
+    if new_tasks and not options.password:
+        debug_print("Sending the progress of the just obtained assignment(s)")
+        profile_phase("update_progress_new", update_progress_new, new_tasks, progress)
+    for thread in (sender, submitter):
+        if thread is not None:
+            thread.join()
+    write_progress_sent(read_workfile())
+
+
+# Pre-v19 old-style HRF-formatted result used "Program:..."; starting
+# w/v19 JSON-formatted result uses "program",
+resultpattern = re.compile(br"Program: E|Mlucas|CUDALucas v|Prime95")
 
 
 try:
@@ -730,36 +1381,39 @@ except ImportError:
         return sorts[(length - 1) // 2]
 
 
-def parse_stat_file(p):
-    statfile = os.path.join(workdir, 'p' + str(p) + '.stat')
+stat_regex = re.compile(br"Iter# = (\d+) .*\[ *(\d+\.\d+) (m?sec)/iter\]")
+stat_fft_regex = re.compile(br'FFT length \d{3,}K = (\d{6,})')
+
+
+def parse_stat_file(p, directory=None):
+    statfile = os.path.join(directory or workdir, 'p' + str(p) + '.stat')
     if not os.path.exists(statfile):
         debug_print("stat file “" + statfile + "” does not exist")
         return 0, None, None
 
-    w = readonly_list_file(statfile)  # appended line by line, no lock needed
     found = 0
-    regex = re.compile(r"Iter# = (\d+) .*\[ *(\d+\.\d+) (m?sec)/iter\]")
-    fft_regex = re.compile(r'FFT length \d{3,}K = (\d{6,})')
     list_msec_per_iter = []
     fftlen = None
-    # get the 5 most recent Iter line
-    for line in reversed(w):
-        res = regex.search(line)
-        fft_res = fft_regex.search(line)
-        if res and found < 5:
-            found += 1
-            # keep the last iteration to compute the percent of progress
-            if found == 1:
-                iteration = int(res.group(1))
-            msec_per_iter = float(res.group(2))
-            unit = res.group(3)
-            if unit == "sec":
-                msec_per_iter *= 1000
-            list_msec_per_iter.append(msec_per_iter)
-        elif fft_res:
-            fftlen = int(fft_res.group(1))
-        if found == 5 and fftlen:
-            break
+    # appended line by line, no lock needed
+    with mapped_file(statfile) as buf:
+        # get the 5 most recent Iter line, only the end of the file is read
+        for start, end in line_spans(buf, reverse=True):
+            res = stat_regex.search(buf, start, end)
+            fft_res = None if res else stat_fft_regex.search(buf, start, end)
+            if res and found < 5:
+                found += 1
+                # keep the last iteration to compute the percent of progress
+                if found == 1:
+                    iteration = int(res.group(1))
+                msec_per_iter = float(res.group(2))
+                unit = res.group(3)
+                if unit == b"sec":
+                    msec_per_iter *= 1000
+                list_msec_per_iter.append(msec_per_iter)
+            elif fft_res:
+                fftlen = int(fft_res.group(1))
+            if found == 5 and fftlen:
+                break
     if found == 0:
         return 0, None, None  # iteration is 0, but don't know the estimated speed yet
     # take the media of the last grepped lines
@@ -803,18 +1457,51 @@ def secure_v5_url(guid, args):
     args["sh"] = ahash
 
 
+# The arguments and response fields that identify the user or computer, which
+# are replaced by a stable hash in the --record log
+RECORD_REDACT = frozenset(["g", "u", "un", "hg"])
+record_lock = threading.Lock()
+
+
+def redact(key, value):
+    if key not in RECORD_REDACT or not value:
+        return value
+    return md5(str(value).encode("utf-8")).hexdigest().upper()
+
+
+def record_request(args, start, text, error):
+    # Append the transaction to the --record log, one JSON object per line.
+    # The signature (ss and sh) is not recorded, as it changes every time.
+    entry = OrderedDict((
+        ("time", round(start, 3)),
+        ("elapsed", round(time.time() - start, 4)),
+        ("args", OrderedDict((key, redact(key, value)) for key, value in args.items() if key not in ("ss", "sh")))))
+    if text is not None:
+        lines = [line.partition("=") for line in text.splitlines()]
+        entry["response"] = "\n".join(key + sep + redact(key, value)
+                                      for key, sep, value in lines) + "\n"
+    if error is not None:
+        entry["error"] = error
+    with record_lock:
+        with open(options.record, "a") as File:
+            File.write(json.dumps(entry, separators=(",", ":")) + "\n")
+
+
 def send_request(guid, args):
     # to mimic mprime, it is necessary to add safe='"{}:,' argument to urlencode, in
     # particular to encode JSON in result submission. But safe is not
     # supported by python2...
+    start = time.time()
     try:
         if idx:
             args["ss"] = 19191919
             args["sh"] = "ABCDABCDABCDABCDABCDABCDABCDABCD"
         else:
             secure_v5_url(guid, args)
-        r = requests.get(primenet_v5_burl, params=args)
+        r = session().get(primenet_v5_burl, params=args)
         r.raise_for_status()
+        if options.record:
+            record_request(args, start, r.text, None)
         result = parse_v5_resp(r.text)
         rc = int(result["pnErrorResult"])
         if rc:
@@ -831,14 +1518,19 @@ def send_request(guid, args):
                 debug_print(result["pnErrorDetail"])
 
     except HTTPError as e:
+        if options.record:
+            record_request(args, start, r.text, str(e))
         debug_print("ERROR receiving answer to request: " +
                     r.url, file=sys.stderr)
-        debug_print(e, file=sys.stderr)
+        debug_print(str(e), file=sys.stderr)
         return None
     except ConnectionError as e:
+        if options.record:
+            record_request(args, start, None, str(e))
+        # There is no response, so r is not set
         debug_print("ERROR connecting to server for request: " +
-                    r.url, file=sys.stderr)
-        debug_print(e, file=sys.stderr)
+                    primenet_v5_burl, file=sys.stderr)
+        debug_print(str(e), file=sys.stderr)
         return None
     return result
 
@@ -847,6 +1539,59 @@ def create_new_guid():
     return uuid.uuid4().hex
 
 
+def get_hardware_fingerprint():
+    # Cheap local check of the detected topology and of the registered
+    # values, so that a resized instance sends one computer update instead of
+    # waiting for a transaction to fail with ERROR_STALE_CPU_INFO
+    hardware = [cpu_signature, get_cpu_threads(),
+                get_physical_memory(), uuid.getnode()]
+    hardware += [getattr(options, attr) for attr in [
+        "cpu_model", "features", "frequency", "memory", "L1", "L2", "np", "hp"]]
+    return md5(",".join(str(x) for x in hardware).encode("utf-8")).hexdigest()
+
+
+def hardware_changed():
+    if not config.has_option("primenet", "hardware_fingerprint"):
+        return True
+    return config.get("primenet", "hardware_fingerprint") != get_hardware_fingerprint()
+
+
+def refresh_hardware_options():
+    # Update the values that were detected rather than set by the user, on
+    # the command line or when registering, which are still their defaults.
+    # CUDALucas registers the GPU, so leave those alone.
+    if options.gpu:
+        return
+    detected = set(config.get("primenet", "detected").split(",")) if config.has_option(
+        "primenet", "detected") else set()
+    threads = get_cpu_threads()
+    values = [("memory", get_physical_memory()),
+              ("np", max(threads // options.hp, 1) if threads and options.hp else threads)]
+    for attr, value in values:
+        if value and not hasattr(opts_no_defaults, attr) and (
+                attr in detected or getattr(options, attr) == parser.defaults[attr]):
+            setattr(options, attr, value)
+            config.set("primenet", attr, str(value))
+            detected.add(attr)
+    if detected:
+        config.set("primenet", "detected", ",".join(sorted(detected)))
+
+
+def update_hardware(guid):
+    # The workers share the local.ini file, so check again with its lock held
+    # after picking up the values written by the others: only the first worker
+    # to see the change sends the computer update.
+    with config_lock():
+        config_reload(config)
+        merge_config_and_options(config, options)
+        if not hardware_changed():
+            return
+        debug_print(
+            "Hardware changed since the last computer update, re-send computer update")
+        refresh_hardware_options()
+        register_instance(guid)
+
+
 def register_instance(guid):
     # register the instance to server, guid is the instance identifier
     if options.username is None:
@@ -891,11 +1636,14 @@ def register_instance(guid):
         else:
             parser.error("Error while registering on mersenne.org")
     # Save program options in case they are changed by the PrimeNet server.
-    config.set("primenet", "username", result["u"])
-    config.set("primenet", "name", result["un"])
-    config.set("primenet", "hostname", result["cn"])
-    merge_config_and_options(config, options)
-    config_write(config, guid=guid)
+    # Also called from the threads of a cycle when the server asks for it.
+    with config_lock():
+        config.set("primenet", "username", result["u"])
+        config.set("primenet", "name", result["un"])
+        config.set("primenet", "hostname", result["cn"])
+        merge_config_and_options(config, options)
+        config.set("primenet", "hardware_fingerprint", get_hardware_fingerprint())
+        config_write(config, guid=guid)
     program_options(guid, True)
     print("GUID {guid} correctly registered with the following features:".format(
         guid=guid))
@@ -916,20 +1664,118 @@ def register_instance(guid):
     return
 
 
+def worker_section(cpu):
+    return "worker " + str(cpu)
+
+
+# Options saved in the “worker N” section of each worker instead of the
+# “primenet” section of the computer, so that the speed estimates and work
+# preferences of each CPU core or GPU are tracked separately
+worker_attrs = frozenset(["worktype", "days_work", "usec_per_iter"])
+
+
+def config_get(config, section, attr):
+    # Fall back to the “primenet” section of the computer
+    if config.has_option(section, attr):
+        return config.get(section, attr)
+    if config.has_option("primenet", attr):
+        return config.get("primenet", attr)
+    return None
+
+
+# Serializes the changes to the in-memory config between the threads of a
+# cycle (see run_cycle()). config_lock() also takes it.
+config_mutex = threading.RLock()
+config_lock_depth = 0  # only changed while holding config_mutex
+
+
+@contextmanager
+def config_lock():
+    # The local.ini file is shared (symlinked) by all the workers, so lock the
+    # real file. The lock can be nested by the same thread, the other threads
+    # wait for it, as they would not be excluded by the flock of this process.
+    global config_lock_depth
+    with config_mutex:
+        with open(os.path.realpath(localfile) + ".lock", "a") as lockfile:
+            if fcntl and not config_lock_depth:
+                fcntl.flock(lockfile, fcntl.LOCK_EX)
+            config_lock_depth += 1
+            try:
+                yield
+            finally:
+                config_lock_depth -= 1
+                if fcntl and not config_lock_depth:
+                    fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+
+def config_values(config):
+    return dict(((section, option), value) for section in config.sections()
+                for option, value in config.items(section, raw=True))
+
+
 def config_read():
+    global config_saved
     config = ConfigParser(dict_type=OrderedDict)
     try:
         config.read([localfile])
     except ConfigParserError as e:
         debug_print("ERROR reading “{0}” file:".format(
             localfile), file=sys.stderr)
-        debug_print(e, file=sys.stderr)
+        debug_print(str(e), file=sys.stderr)
+    config_saved = config_values(config)
     if not config.has_section("primenet"):
         # Create the section to avoid having to test for it later
         config.add_section("primenet")
     return config
 
 
+def config_migrate(config):
+    # Move the worker options of the old format, where they were all saved in
+    # the “primenet” section, to the “worker N” section of each worker
+    attrs = [attr for attr in sorted(
+        worker_attrs) if config.has_option("primenet", attr)]
+    if not attrs:
+        return False
+    nw = int(config.get("primenet", "nw")) if config.has_option(
+        "primenet", "nw") else options.nw
+    debug_print("Moving {0} to the worker sections of “{1}”".format(
+        ", ".join(attrs), options.localfile))
+    for cpu in range(max(nw, options.cpu + 1)):
+        section = worker_section(cpu)
+        if not config.has_section(section):
+            config.add_section(section)
+        for attr in attrs:
+            if not config.has_option(section, attr):
+                config.set(section, attr, config.get("primenet", attr))
+    for attr in attrs:
+        config.remove_option("primenet", attr)
+    return True
+
+
+def config_reload(config):
+    # Pick up the values written to the local.ini file by the other workers,
+    # keeping the values changed by this one that have not been written yet
+    global config_saved
+    changed = dict((key, value) for key, value in config_values(
+        config).items() if config_saved.get(key) != value)
+    removed = [key for key in config_saved if not config.has_option(*key)]
+    new_config = ConfigParser(dict_type=OrderedDict)
+    try:
+        new_config.read([localfile])
+    except ConfigParserError as e:
+        debug_print("ERROR reading “{0}” file:".format(
+            localfile), file=sys.stderr)
+        debug_print(str(e), file=sys.stderr)
+        return
+    config_saved = config_values(new_config)
+    for (section, option), value in list(config_saved.items()) + list(changed.items()):
+        if not config.has_section(section):
+            config.add_section(section)
+        config.set(section, option, value)
+    for section, option in removed:
+        config.remove_option(section, option)
+
+
 def get_guid(config):
     try:
         return config.get("primenet", "guid")
@@ -937,12 +1783,28 @@ def get_guid(config):
         return None
 
 
+def replace_file(src, dst):
+    if hasattr(os, "replace"):
+        os.replace(src, dst)
+    else:
+        # Python 2
+        if os.name == "nt" and os.path.exists(dst):
+            os.remove(dst)
+        os.rename(src, dst)
+
+
 def config_write(config, guid=None):
     # generate a new local.ini file
+    global config_saved
     if guid is not None:  # update the guid if necessary
         config.set("primenet", "guid", guid)
-    with open(localfile, "w") as configfile:
-        config.write(configfile)
+    with config_lock():
+        config_reload(config)
+        filename = os.path.realpath(localfile)
+        with open(filename + ".tmp", "w") as configfile:
+            config.write(configfile)
+        replace_file(filename + ".tmp", filename)
+        config_saved = config_values(config)
 
 
 def merge_config_and_options(config, options):
@@ -952,28 +1814,33 @@ def merge_config_and_options(config, options):
     # when adding an option you want to copy from argument options to
     # local.ini config.
     attr_to_copy = ["workfile", "resultsfile", "username", "password", "worktype", "num_cache", "nw", "days_work",
-                    "hostname", "cpu_model", "features", "frequency", "memory", "L1", "L2", "np", "hp", "gpu"]
+                    "hostname", "cpu_model", "features", "frequency", "memory", "L1", "L2", "np", "hp", "gpu", "prime95", "server", "gateway_key", "min_progress", "min_eta_change"]
     updated = False
     for attr in attr_to_copy:
         # if "attr" has its default value in options, copy it from config
         attr_val = getattr(options, attr)
-        if not hasattr(opts_no_defaults, attr) \
-                and config.has_option("primenet", attr):
+        section = worker_section(
+            options.cpu) if attr in worker_attrs else "primenet"
+        config_val = config_get(config, section, attr)
+        if not hasattr(opts_no_defaults, attr) and config_val is not None:
             # If no option is given and the option exists in local.ini, take it
             # from local.ini
-            new_val = config.get("primenet", attr)
+            new_val = config_val
             # config file values are always str()
             # they need to be converted to the expected type from options
-            if attr_val is not None:
+            if isinstance(attr_val, bool):
+                new_val = new_val == "True"
+            elif attr_val is not None:
                 new_val = type(attr_val)(new_val)
             setattr(options, attr, new_val)
-        elif attr_val is not None and (not config.has_option("primenet", attr)
-                                       or config.get("primenet", attr) != str(attr_val)):
+        elif attr_val is not None and config_val != str(attr_val):
             # If an option is given (even default value) and it is not already
             # identical in local.ini, update local.ini
             debug_print("update “" + options.localfile +
                         "” with {0}={1}".format(attr, attr_val))
-            config.set("primenet", attr, str(attr_val))
+            if not config.has_section(section):
+                config.add_section(section)
+            config.set(section, attr, str(attr_val))
             updated = True
 
     global localfile
@@ -993,7 +1860,7 @@ Assignment = namedtuple(
 
 
 def update_progress(assignment, iteration, msec_per_iter,
-                    fftlen, now, cur_time_left):
+                    fftlen, now, cur_time_left, pending=None):
     if not assignment:
         return
     percent = 100 * iteration / assignment.n
@@ -1003,18 +1870,399 @@ def update_progress(assignment, iteration, msec_per_iter,
     debug_print(
         "p:{0} is {1:.4n}% done ({2:n} / {0:n})".format(assignment.n, percent, iteration))
     if time_left is None:
+        # Still send the progress, with the default ETA, so that the
+        # assignment does not expire (e.g. Prime95/MPrime before its speed is
+        # known)
         debug_print("Finish cannot be estimated")
+        eta = None
+        delta = timedelta(seconds=7 * 24 * 60 * 60)
     else:
         cur_time_left += time_left
+        eta = cur_time_left
         delta = timedelta(seconds=cur_time_left)
         debug_print("Finish estimated in {0} (used {1:.4n} msec/iter estimation)".format(
             str(delta), msec_per_iter))
-        send_progress(assignment, percent, cur_time_left, now, delta, fftlen)
+    if progress_unchanged(assignment, percent, eta):
+        debug_print("Progress of {0} has not changed enough since the last update, not sending it".format(
+            assignment.n))
+    elif pending is not None:
+        # Sent later, concurrently with getting new assignments
+        pending.append((assignment, percent, eta, now, delta, fftlen))
+    else:
+        send_progress(assignment, percent, eta, now, delta, fftlen)
     return percent, cur_time_left
 
 
-def update_progress_all():
-    tasks = readonly_list_file(workfile)
+HISTORY_FIELDS = ("timestamp", "cpu", "exponent",
+                  "iteration", "msec_per_iter", "fftlen")
+
+
+def history_connect():
+    conn = sqlite3.connect(historyfile)
+    conn.execute("CREATE TABLE IF NOT EXISTS progress (timestamp INTEGER, cpu INTEGER, exponent INTEGER, iteration INTEGER, msec_per_iter REAL, fftlen INTEGER)")
+    return conn
+
+
+def record_progress(assignment, iteration, msec_per_iter, fftlen):
+    # Append one record to the progress time series on every update, so that
+    # slowdowns (e.g. thermal throttling or a bad FFT length) show as trends
+    if sqlite3 is None:
+        return
+    try:
+        conn = history_connect()
+        with conn:
+            conn.execute("INSERT INTO progress VALUES (?, ?, ?, ?, ?, ?)", (int(time.time(
+            )), options.cpu, assignment.n, iteration, msec_per_iter, fftlen))
+        conn.close()
+    except sqlite3.Error as e:
+        debug_print("ERROR: Unable to record the progress in “{0}”: {1}".format(
+            historyfile, e), file=sys.stderr)
+
+
+def export_history(filename):
+    # Write the progress history to a JSON or CSV file, by its extension
+    if sqlite3 is None:
+        parser.error("The progress history requires Python with SQLite")
+    if not os.path.exists(historyfile):
+        debug_print("No progress history in “" + historyfile + "”")
+        records = []
+    else:
+        conn = history_connect()
+        records = conn.execute(
+            "SELECT * FROM progress ORDER BY timestamp").fetchall()
+        conn.close()
+    with open(filename, "w") as File:
+        if filename.lower().endswith(".csv"):
+            writer = csv.writer(File, lineterminator="\n")
+            writer.writerow(HISTORY_FIELDS)
+            writer.writerows(records)
+        else:
+            json.dump([dict(zip(HISTORY_FIELDS, record))
+                       for record in records], File, indent=4)
+    debug_print("Exported {0:n} progress record(s) to “{1}”".format(
+        len(records), filename))
+
+
+# A worker is slow if its msec/iter is this much more than the median of the
+# workers with the same FFT length
+SLOW_FACTOR = 1.15
+# Iterations needed after a restart before the new speed is compared, enough
+# for the 5 “Iter#” lines that parse_stat_file() uses, at the default 10000
+# iterations per line
+REBALANCE_ITERATIONS = 5 * 10000
+
+
+def peer_median(fftlen):
+    # Median msec/iter of all the workers with the same FFT length, from the
+    # shared “local.ini” file
+    speeds = [float(config.get(section, "usec_per_iter")) for section in config.sections()
+              if section.startswith("worker ") and config.has_option(section, "usec_per_iter") and
+              config.has_option(section, "fftlen") and config.get(section, "fftlen") == str(fftlen)]
+    return median_low(speeds) if len(speeds) > 1 else None
+
+
+def check_throughput(msec_per_iter, fftlen):
+    median = peer_median(fftlen)
+    if median and msec_per_iter > SLOW_FACTOR * median:
+        debug_print("WARNING: This worker is running at {0:.4n} msec/iter, {1:.1%} slower than the median {2:.4n} msec/iter of the workers with the same FFT length. Run with --rebalance to try a different CPU affinity.".format(
+            msec_per_iter, msec_per_iter / median - 1, median))
+
+
+def read_sys(filename):
+    try:
+        with open(filename) as File:
+            return File.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+def parse_cpu_list(cpus):
+    # Expand a Linux (“0-3,8”) or Mlucas (“0:3,8” or “0:7:2”) CPU list
+    result = []
+    for part in cpus.split(","):
+        bounds = [int(x) for x in re.split(r"[-:]", part.strip())]
+        if len(bounds) == 1:
+            result.append(bounds[0])
+        else:
+            result.extend(range(bounds[0], bounds[1] + 1,
+                          bounds[2] if len(bounds) > 2 else 1))
+    return result
+
+
+def cpu_topology():
+    # The CPU threads of each physical core, ordered by their first CPU
+    cores = set()
+    for filename in glob.glob("/sys/devices/system/cpu/cpu[0-9]*/topology/thread_siblings_list"):
+        siblings = read_sys(filename)
+        if siblings:
+            cores.add(tuple(sorted(parse_cpu_list(siblings))))
+    return sorted(cores)
+
+
+def cpu_frequency(cpu):
+    # Current and maximum frequency (MHz) of the CPU thread from cpufreq
+    path = "/sys/devices/system/cpu/cpu{0}/cpufreq/".format(cpu)
+    cur = read_sys(path + "scaling_cur_freq")
+    maximum = read_sys(path + "cpuinfo_max_freq")
+    return int(cur) // 1000 if cur else None, int(maximum) // 1000 if maximum else None
+
+
+def find_mlucas(name="Mlucas"):
+    # The PID and arguments of the Mlucas (or CUDALucas) process running in workdir
+    if not os.path.isdir("/proc"):
+        return None, None
+    directory = os.path.realpath(workdir)
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit():
+            continue
+        try:
+            if os.readlink(os.path.join("/proc", pid, "cwd")) != directory:
+                continue
+            with open(os.path.join("/proc", pid, "cmdline"), "rb") as File:
+                args = [arg.decode("utf-8") for arg in File.read().split(b"\0") if arg]
+        except (IOError, OSError):
+            continue
+        if args and os.path.basename(args[0]) == name:
+            return int(pid), args
+    return None, None
+
+
+def set_affinity(cpus, pid):
+    # Save the new Mlucas “-cpu” argument and stop Mlucas so that idle.py
+    # restarts it with it. Mlucas writes its save files when it gets SIGTERM.
+    filename = os.path.realpath(cpufile)
+    write_list_file(filename + ".tmp", [cpus])
+    replace_file(filename + ".tmp", filename)
+    if pid is None:
+        debug_print("Mlucas is not running, it will use “-cpu {0}” the next time it starts".format(cpus))
+        return
+    debug_print("Restarting Mlucas (PID {0}) with “-cpu {1}”".format(pid, cpus))
+    os.kill(pid, signal.SIGTERM)
+    # If paused by idle.py, it has to continue to handle the signal
+    os.kill(pid, signal.SIGCONT)
+
+
+# Mlucas writes a line to the .stat file and CUDALucas to its output every
+# this many iterations
+STALL_ITERATIONS = 10000
+# A worker is stalled if there is no new line for this many times as long as
+# it should take, or at least STALL_MIN seconds
+STALL_FACTOR = 10
+STALL_MIN = 60 * 60
+# Seconds between the stall checks, which are also done between the cycles
+STALL_CHECK_INTERVAL = 15 * 60
+# Seconds to wait for a stalled program to exit before it is killed, when it
+# is restarted without idle.py
+STALL_EXIT_WAIT = 60
+# Written by idle.py each time it starts or resumes the worker
+IDLE_RESUMED_FILE = "idle_resumed.txt"
+
+
+def process_state(pid):
+    # The state (e.g. R, S or T for stopped) and start time (since the epoch)
+    # of the process
+    stat = read_sys("/proc/{0}/stat".format(pid))
+    uptime = read_sys("/proc/uptime")
+    if stat is None or uptime is None:
+        return None, None
+    # The command name in parentheses may contain spaces
+    fields = stat[stat.rindex(")") + 2:].split()
+    return fields[0], time.time() - float(uptime.split()[0]) + int(fields[19]) / os.sysconf("SC_CLK_TCK")
+
+
+def run_by_idle(pid):
+    # Whether the process was started by idle.py (through a shell and e.g.
+    # nice), which will start it again after it exits
+    while True:
+        stat = read_sys("/proc/{0}/stat".format(pid))
+        if stat is None:
+            return False
+        pid = int(stat[stat.rindex(")") + 2:].split()[1])
+        if pid <= 1:
+            return False
+        cmdline = read_sys("/proc/{0}/cmdline".format(pid))
+        if cmdline is not None and "idle.py" in cmdline:
+            return True
+
+
+def restart_worker(pid, args):
+    # Start the program again with the same arguments in the work directory
+    # once it has exited, as idle.py is not running it. Mlucas writes its
+    # save files when it gets SIGTERM, so it is given some time.
+    for i in range(STALL_EXIT_WAIT + 5):
+        state, _ = process_state(pid)
+        if state is None or state == "Z":
+            break
+        if i == STALL_EXIT_WAIT:
+            os.kill(pid, signal.SIGKILL)
+        time.sleep(1)
+    else:
+        debug_print("ERROR: {0} (PID {1}) did not exit".format(args[0], pid), file=sys.stderr)
+        return
+    debug_print("Starting “{0}”".format(" ".join(args)))
+    with open(os.devnull) as devnull, open(os.path.join(workdir, "nohup.out"), "ab") as out:
+        subprocess.Popen(args, cwd=workdir, stdin=devnull, stdout=out, stderr=subprocess.STDOUT, preexec_fn=os.setsid)
+
+
+def check_stall(assignment, iteration, msec_per_iter):
+    # Watchdog: restart the GIMPS program of this worker if its iteration has
+    # not advanced for too long. idle.py restarts it with the same “-cpu”
+    # argument from “mlucas_cpu.txt”, otherwise it is restarted here with the
+    # same arguments. A process paused by idle.py (stopped) is not stalled,
+    # and it must have run for at least the whole threshold since it was
+    # started or last resumed by idle.py.
+    # Returns True if the config was updated.
+    if options.prime95 or msec_per_iter is None:
+        return False
+    section = worker_section(options.cpu)
+    name = "CUDALucas" if options.gpu else "Mlucas"
+    pid, args = find_mlucas(name)
+    state, started = process_state(pid) if pid is not None else (None, None)
+    now = time.time()
+    last = dict((key, config.get(section, "watchdog_" + key)) for key in (
+        "exponent", "iteration", "time", "pid") if config.has_option(section, "watchdog_" + key))
+    if (len(last) < 4 or int(last["exponent"]) != assignment.n or int(last["iteration"]) != iteration
+            or last["pid"] != str(pid) or state == "T"):
+        config.set(section, "watchdog_exponent", str(assignment.n))
+        config.set(section, "watchdog_iteration", str(iteration))
+        config.set(section, "watchdog_time", str(int(now)))
+        config.set(section, "watchdog_pid", str(pid))
+        return True
+    if pid is None or started is None:
+        # Not running, idle.py will start it
+        return False
+    threshold = max(STALL_FACTOR * STALL_ITERATIONS * msec_per_iter / 1000, STALL_MIN)
+    resumed = os.path.join(workdir, IDLE_RESUMED_FILE)
+    since = max(int(last["time"]), started, os.path.getmtime(resumed) if os.path.exists(resumed) else 0)
+    stalled = now - since
+    if stalled < threshold:
+        return False
+    restarts = int(config.get(section, "watchdog_restarts")) + 1 if config.has_option(
+        section, "watchdog_restarts") else 1
+    # Kill it if it did not stop after the last restart
+    sig = signal.SIGKILL if config.has_option(section, "watchdog_restart_pid") and config.get(
+        section, "watchdog_restart_pid") == str(pid) else signal.SIGTERM
+    debug_print("WARNING: {0} (PID {1}) has been stalled at iteration {2:n} of {3} for {4}, restarting it ({5:n} restarts so far)".format(
+        name, pid, iteration, assignment.n, timedelta(seconds=int(stalled)), restarts), file=sys.stderr)
+    try:
+        idle = run_by_idle(pid)
+        os.kill(pid, sig)
+        os.kill(pid, signal.SIGCONT)
+        if not idle:
+            restart_worker(pid, args)
+    except OSError as e:
+        debug_print("ERROR: Unable to restart {0}: {1}".format(name, e), file=sys.stderr)
+    config.set(section, "watchdog_restarts", str(restarts))
+    config.set(section, "watchdog_restart_pid", str(pid))
+    config.set(section, "watchdog_last_restart", str(int(now)))
+    # Wait another threshold before the next restart
+    config.set(section, "watchdog_time", str(int(now)))
+    return True
+
+
+def watchdog():
+    # The stall check of the first assignment, between the cycles
+    tasks = read_workfile()
+    progress = get_progress_assignment(tasks[0]) if tasks else None
+    if not progress:
+        return
+    assignment, iteration, msec_per_iter, _ = progress
+    section = worker_section(options.cpu)
+    if msec_per_iter is None and config.has_option(section, "usec_per_iter"):
+        msec_per_iter = float(config.get(section, "usec_per_iter"))
+    if check_stall(assignment, iteration, msec_per_iter):
+        config_write(config)
+
+
+def wait_timeout():
+    # Sleep --timeout seconds, checking for a stall every STALL_CHECK_INTERVAL
+    # seconds, as the cycles may be much further apart than the threshold
+    end = time.time() + options.timeout
+    while True:
+        remaining = end - time.time()
+        if remaining <= 0:
+            break
+        time.sleep(min(remaining, STALL_CHECK_INTERVAL))
+        if end - time.time() > 0 and not options.prime95:
+            watchdog()
+
+
+def rebalance():
+    # Compare the speed of this worker to the other workers with the same FFT
+    # length and if it is slow, try the CPU affinity from the topology of the
+    # computer, keeping it only if it is faster
+    if options.gpu or options.prime95 or not os.path.isdir("/proc"):
+        parser.error("Rebalancing is only supported for Mlucas on Linux")
+    tasks = read_workfile()
+    if not tasks:
+        debug_print("No assignments to measure the speed")
+        return
+    assignment, iteration, msec_per_iter, fftlen = get_progress_assignment(
+        tasks[0])
+    if msec_per_iter is None:
+        debug_print("The speed of this worker is not known yet")
+        return
+    pid, args = find_mlucas()
+    cpus = readonly_list_file(cpufile)
+    if cpus:
+        cpus = cpus[0]
+    elif args and "-cpu" in args[:-1]:
+        cpus = args[args.index("-cpu") + 1]
+    else:
+        debug_print("ERROR: Unable to find the CPU affinity of Mlucas", file=sys.stderr)
+        return
+    cpu_list = parse_cpu_list(cpus)
+    for cpu in cpu_list:
+        cur, maximum = cpu_frequency(cpu)
+        if cur and maximum:
+            debug_print("CPU {0}: {1:n} / {2:n} MHz{3}".format(cpu, cur, maximum,
+                        " (throttled)" if cur < 0.8 * maximum else ""))
+    median = peer_median(fftlen)
+    debug_print("This worker (-cpu {0}) is running at {1:.4n} msec/iter with an FFT length of {2}K, median of the workers: {3}".format(
+        cpus, msec_per_iter, fftlen // 1024 if fftlen else "?", "{0:.4n} msec/iter".format(median) if median else "unknown"))
+    section = worker_section(options.cpu)
+    if config.has_option(section, "rebalance_previous"):
+        # A different affinity is being tried
+        if iteration - int(config.get(section, "rebalance_iteration")) < REBALANCE_ITERATIONS:
+            debug_print("Not enough iterations since Mlucas was restarted with “-cpu {0}”, try again later".format(cpus))
+            return
+        previous = config.get(section, "rebalance_previous")
+        previous_msec = float(config.get(section, "rebalance_msec_per_iter"))
+        for key in ("rebalance_previous", "rebalance_iteration", "rebalance_msec_per_iter"):
+            config.remove_option(section, key)
+        config_write(config)
+        if msec_per_iter < previous_msec:
+            debug_print("“-cpu {0}” is faster than “-cpu {1}” ({2:.4n} vs {3:.4n} msec/iter), keeping it".format(
+                cpus, previous, msec_per_iter, previous_msec))
+        else:
+            debug_print("“-cpu {0}” is not faster than “-cpu {1}” ({2:.4n} vs {3:.4n} msec/iter), reverting".format(
+                cpus, previous, msec_per_iter, previous_msec))
+            set_affinity(previous, pid)
+        return
+    if median is None or msec_per_iter <= SLOW_FACTOR * median:
+        debug_print("This worker is not slower than the others, nothing to do")
+        return
+    # Use whole physical cores, the same number of them for each worker
+    cores = cpu_topology()
+    if not cores:
+        debug_print("ERROR: Unable to read the CPU topology", file=sys.stderr)
+        return
+    num_cores = -(-len(cpu_list) // len(cores[0]))
+    candidate = sorted(cpu for core in cores[options.cpu * num_cores:(
+        options.cpu + 1) * num_cores] for cpu in core)
+    if not candidate or candidate == sorted(cpu_list):
+        debug_print("There is no other CPU affinity to try")
+        return
+    config.set(section, "rebalance_previous", cpus)
+    config.set(section, "rebalance_iteration", str(iteration))
+    config.set(section, "rebalance_msec_per_iter", str(msec_per_iter))
+    config_write(config)
+    set_affinity(",".join(str(cpu) for cpu in candidate), pid)
+
+
+def update_progress_all(pending=None):
+    compact_workfile()
+    tasks = read_workfile()
     if not len(tasks):
         return  # don't update if no worktodo
     config_updated = False
@@ -1030,21 +2278,37 @@ def update_progress_all():
     now = datetime.now()
     assignment, iteration, msec_per_iter, fftlen = get_progress_assignment(
         tasks[0])
+    section = worker_section(options.cpu)
+    if options.prime95 and assignment and iteration and msec_per_iter is None:
+        msec_per_iter = prime95_speed(assignment, iteration)
+        config_updated = True
+    if assignment and iteration:
+        record_progress(assignment, iteration, msec_per_iter, fftlen)
+    if assignment and check_stall(assignment, iteration, msec_per_iter if msec_per_iter is not None else (
+            float(config.get(section, "usec_per_iter")) if config.has_option(section, "usec_per_iter") else None)):
+        config_updated = True
+    if options.gpu and assignment and check_cuda_errors(assignment, fftlen):
+        config_updated = True
     if msec_per_iter is not None:
-        config.set("primenet", "usec_per_iter",
+        config.set(section, "usec_per_iter",
                    "{0:.2f}".format(msec_per_iter))
+        if fftlen:
+            config.set(section, "fftlen", str(fftlen))
+            check_throughput(msec_per_iter, fftlen)
         config_updated = True
-    elif config.has_option("primenet", "usec_per_iter"):
+    elif config.has_option(section, "usec_per_iter"):
         # If not speed available, get it from the local.ini file
-        msec_per_iter = float(config.get("primenet", "usec_per_iter"))
+        msec_per_iter = float(config.get(section, "usec_per_iter"))
     # Do the other assignment accumulating the time_lefts
     cur_time_left = None if msec_per_iter is None else 0
     percent, cur_time_left = update_progress(
-        assignment, iteration, msec_per_iter, fftlen, now, cur_time_left)
+        assignment, iteration, msec_per_iter, fftlen, now, cur_time_left, pending)
     for task in tasks[1:]:
         assignment, iteration, _, fftlen = get_progress_assignment(task)
         percent, cur_time_left = update_progress(
-            assignment, iteration, msec_per_iter, fftlen, now, cur_time_left)
+            assignment, iteration, msec_per_iter, fftlen, now, cur_time_left, pending)
+    if pending is None:
+        write_progress_sent(tasks)
     if config_updated:
         config_write(config)
     return percent, cur_time_left
@@ -1054,13 +2318,92 @@ def get_progress_assignment(task):
     assignment = parse_assignment(task)
     if not assignment:
         return
-    if not options.gpu:
+    if options.prime95:
+        iteration, msec_per_iter, fftlen = parse_prime95_output(assignment.n)
+        if not iteration:
+            iteration = parse_prime95_save(assignment.n)
+    elif not options.gpu:
         iteration, msec_per_iter, fftlen = parse_stat_file(assignment.n)
     else:
         iteration, msec_per_iter, fftlen = parse_stat_file_cuda(assignment.n)
     return assignment, iteration, msec_per_iter, fftlen
 
 
+# Prime95/MPrime does not write a .stat file. With “mprime -d”, as run by
+# idle.py, it writes its progress to the “nohup.out” file, with lines like:
+# [Worker #1 Oct 19 08:00] Iteration: 1000000 / 110000017 [0.90%], ms/iter:  5.123, ETA: 6d 12:33
+PRIME95_OUTPUT = "nohup.out"
+prime95_iter_regex = re.compile(
+    br'\bIteration: (\d+) / (\d+) \[[0-9.]+%\](?:, ms/iter:\s*([0-9.]+))?')
+prime95_fft_regex = re.compile(br'\bM(\d+) using .*?\bFFT length (\d+)([KM]?)\b')
+# Most lines of the output read for the progress
+PRIME95_OUTPUT_LINES = 10000
+
+
+def parse_prime95_output(p):
+    # The iteration, median msec/iter of the last 5 lines and FFT length of
+    # the exponent p from the Prime95/MPrime output. The lines of the other
+    # workers are for other exponents, with a different number of iterations.
+    found = 0
+    iteration = 0
+    list_msec_per_iter = []
+    fftlen = None
+    with mapped_file(os.path.join(workdir, PRIME95_OUTPUT)) as buf:
+        for count, (start, end) in enumerate(line_spans(buf, reverse=True)):
+            if count >= PRIME95_OUTPUT_LINES:
+                break
+            res = prime95_iter_regex.search(buf, start, end)
+            fft_res = None if res else prime95_fft_regex.search(buf, start, end)
+            if res and found < 5 and p - 2 <= int(res.group(2)) <= p:
+                found += 1
+                if found == 1:
+                    iteration = int(res.group(1))
+                if res.group(3):
+                    list_msec_per_iter.append(float(res.group(3)))
+            elif fft_res and int(fft_res.group(1)) == p and found:
+                fftlen = int(fft_res.group(2)) * {b"K": 1024, b"M": 1024 * 1024}.get(fft_res.group(3), 1)
+                break
+    msec_per_iter = median_low(list_msec_per_iter) if list_msec_per_iter else None
+    return iteration, msec_per_iter, fftlen
+
+
+def parse_prime95_save(p):
+    # The iteration of the exponent p from the percent complete in the header
+    # of its Prime95/MPrime save file: magic number, version, k, b, n, c,
+    # stage and percent complete. Returns 0 if there is no valid save file.
+    files = [os.path.join(workdir, name) for name in ("p" + str(p), "P" + str(p))]
+    files = [name for name in files if os.path.isfile(name)]
+    if not files:
+        return 0
+    try:
+        with open(max(files, key=os.path.getmtime), "rb") as File:
+            header = File.read(47)
+        _, _, k, b, n, _, _, pct = struct.unpack("<IIdIIi11sd", header)
+    except (IOError, OSError, struct.error):
+        return 0
+    if k != 1.0 or b != 2 or n != p or not 0 <= pct <= 1:
+        return 0
+    return int(pct * p)
+
+
+def prime95_speed(assignment, iteration):
+    # The msec/iter of Prime95/MPrime from the iterations done since the
+    # progress from its save file was last seen, when its output is not
+    # available. Returns None until there are two different samples.
+    section = worker_section(options.cpu)
+    now = time.time()
+    msec_per_iter = None
+    if config.has_option(section, "prime95_sample"):
+        n, last_iteration, last_time = config.get(section, "prime95_sample").split(",")
+        if int(n) == assignment.n:
+            if iteration == int(last_iteration):
+                return None
+            if iteration > int(last_iteration):
+                msec_per_iter = (now - float(last_time)) * 1000 / (iteration - int(last_iteration))
+    config.set(section, "prime95_sample", "{0},{1},{2:.0f}".format(assignment.n, iteration, now))
+    return msec_per_iter
+
+
 def parse_assignment(task):
     ''' Ex: Test=197ED240A7A41EC575CB408F32DDA661,57600769,74 '''
     found = workpattern.search(task)
@@ -1124,6 +2467,13 @@ def parse_assignment(task):
                       b, n, c, sieve_depth, pminus1ed)
 
 
+cuda_num_regex = re.compile(br'\bM(\d{7,})\b')
+cuda_iter_regex = re.compile(br'\b\d{5,}\b')
+cuda_ms_per_regex = re.compile(br'\b\d+\.\d{1,5}\b')
+cuda_eta_regex = re.compile(br'\b(?:(?:(\d+):)?(\d{1,2}):)?(\d{1,2}):(\d{2})\b')
+cuda_fft_regex = re.compile(br'\b(\d{3,})K\b')
+
+
 def parse_stat_file_cuda(p):
     # CUDALucas only function
     # appended line by line, no lock needed
@@ -1132,49 +2482,47 @@ def parse_stat_file_cuda(p):
         debug_print("GPU file “" + gpu + "” does not exist")
         return 0, None, None
 
-    w = readonly_list_file(gpu)
     found = 0
-    num_regex = re.compile(r'\bM(\d{7,})\b')
-    iter_regex = re.compile(r'\b\d{5,}\b')
-    ms_per_regex = re.compile(r'\b\d+\.\d{1,5}\b')
-    eta_regex = re.compile(r'\b(?:(?:(\d+):)?(\d{1,2}):)?(\d{1,2}):(\d{2})\b')
-    fft_regex = re.compile(r'\b(\d{3,})K\b')
     list_msec_per_iter = []
     fftlen = None
-    # get the 5 most recent Iter line
-    for line in reversed(w):
-        num_res = re.findall(num_regex, line)
-        iter_res = re.findall(iter_regex, line)
-        ms_res = re.findall(ms_per_regex, line)
-        eta_res = re.findall(eta_regex, line)
-        fft_res = re.findall(fft_regex, line)
-        # regex matches, but not when CUDALucas is continuing
-        # if iter_res and ms_res and "Compatibility" not in line and
-        # "Continuing" not in line and "M(" not in line:
-        if num_res and iter_res and ms_res and eta_res and fft_res:
-            if int(num_res[0]) != p:
-                if found == 0:
-                    debug_print(
-                        "ERROR: looking for the exponent " + str(p) + ", but found " + num_res[0])
-                break
-            found += 1
-            # keep the last iteration to compute the percent of progress
-            if found == 1:
-                iteration = int(iter_res[0])
-                eta = eta_res[1]
-                time_left = int(eta[3]) + (int(eta[2]) * 60)
-                if eta[1]:
-                    time_left += int(eta[1]) * 60 * 60
-                if eta[0]:
-                    time_left += int(eta[0]) * 60 * 60 * 24
-                avg_msec_per_iter = (time_left * 1000) / (p - iteration)
-                fftlen = int(fft_res[0]) * 1024
-            elif int(iter_res[0]) > iteration:
-                break
-            msec_per_iter = float(ms_res[1])
-            list_msec_per_iter.append(msec_per_iter)
-            if found == 5:
-                break
+    with mapped_file(gpu) as buf:
+        # get the 5 most recent Iter line, only the end of the file is read
+        for start, end in line_spans(buf, reverse=True):
+            # the exponent is checked first, as most lines do not have one
+            num_res = cuda_num_regex.search(buf, start, end)
+            if not num_res:
+                continue
+            iter_res = cuda_iter_regex.findall(buf, start, end)
+            ms_res = cuda_ms_per_regex.findall(buf, start, end)
+            eta_res = cuda_eta_regex.findall(buf, start, end)
+            fft_res = cuda_fft_regex.search(buf, start, end)
+            # regex matches, but not when CUDALucas is continuing
+            # if iter_res and ms_res and "Compatibility" not in line and
+            # "Continuing" not in line and "M(" not in line:
+            if iter_res and len(ms_res) > 1 and len(eta_res) > 1 and fft_res:
+                if int(num_res.group(1)) != p:
+                    if found == 0:
+                        debug_print("ERROR: looking for the exponent {0}, but found {1}".format(
+                            p, int(num_res.group(1))))
+                    break
+                found += 1
+                # keep the last iteration to compute the percent of progress
+                if found == 1:
+                    iteration = int(iter_res[0])
+                    eta = eta_res[1]
+                    time_left = int(eta[3]) + (int(eta[2]) * 60)
+                    if eta[1]:
+                        time_left += int(eta[1]) * 60 * 60
+                    if eta[0]:
+                        time_left += int(eta[0]) * 60 * 60 * 24
+                    avg_msec_per_iter = (time_left * 1000) / (p - iteration)
+                    fftlen = int(fft_res.group(1)) * 1024
+                elif int(iter_res[0]) > iteration:
+                    break
+                msec_per_iter = float(ms_res[1])
+                list_msec_per_iter.append(msec_per_iter)
+                if found == 5:
+                    break
     if found == 0:
         return 0, None, None  # iteration is 0, but don't know the estimated speed yet
     # take the media of the last grepped lines
@@ -1185,6 +2533,167 @@ def parse_stat_file_cuda(p):
     return iteration, avg_msec_per_iter, fftlen
 
 
+# The error messages of CUDALucas, which are classified by parse_cuda_errors()
+cuda_error_regexes = (
+    ("roundoff", re.compile(br'[Rr]ound ?off error')),
+    ("restart", re.compile(br'[Rr]estarting from (?:the )?last checkpoint')),
+    ("reset", re.compile(br'[Rr]esetting device')),
+    ("illegal residue", re.compile(br'[Ii]llegal residue')),
+    ("larger FFT", re.compile(br'[Tt]rying a larger fft|[Ii]ncreasing n')))
+cuda_fft_table_regex = re.compile(r'^\s*(\d+)\s+(\d+)\s+(\d+\.\d+)\s*$')
+# Step up to the next FFT length when more than this fraction of the
+# iterations had to be done again after rolling back to a checkpoint
+CUDA_WASTE_LIMIT = 0.05
+# Most lines of the CUDALucas output read to classify the errors
+CUDA_ERROR_LINES = 5000
+
+
+def parse_cuda_errors(p, since=0):
+    # Count the error messages in the CUDALucas output for the exponent p,
+    # after the offset since, and the iterations that were done again after
+    # CUDALucas rolled back to a checkpoint (the reported iteration went down)
+    events = OrderedDict((name, 0) for name, _ in cuda_error_regexes)
+    iterations = []
+    with mapped_file(os.path.join(workdir, options.gpu)) as buf:
+        for count, (start, end) in enumerate(line_spans(buf, reverse=True)):
+            if count >= CUDA_ERROR_LINES or start < since:
+                break
+            num_res = cuda_num_regex.search(buf, start, end)
+            if num_res and int(num_res.group(1)) != p:
+                break
+            for name, regex in cuda_error_regexes:
+                if regex.search(buf, start, end):
+                    events[name] += 1
+            if num_res and len(cuda_ms_per_regex.findall(buf, start, end)) > 1 and cuda_fft_regex.search(buf, start, end):
+                iter_res = cuda_iter_regex.search(buf, start, end)
+                if iter_res:
+                    iterations.append(int(iter_res.group()))
+    iterations.reverse()
+    wasted = sum(a - b for a, b in zip(iterations, iterations[1:]) if b < a)
+    done = sum(b - a for a, b in zip(iterations, iterations[1:]) if b > a)
+    return events, wasted, wasted / (wasted + done) if wasted + done else 0.0
+
+
+def cuda_fft_table():
+    # The FFT lengths (K) benchmarked for this GPU, from the “<device> fft.txt”
+    # file of “CUDALucas -cufftbench” (see google-colab/gpu_optimizations)
+    files = glob.glob(os.path.join(workdir, "* fft.txt"))
+    device = os.path.join(workdir, options.cpu_model + " fft.txt")
+    if device in files:
+        files = [device]
+    if len(files) != 1:
+        return []
+    rows = []
+    for line in readonly_list_file(files[0]):
+        res = cuda_fft_table_regex.match(line)
+        if res:
+            rows.append(int(res.group(1)))
+    return sorted(rows)
+
+
+def set_cuda_fftlen(filename, fftlen):
+    # Set the FFTLength of the CUDALucas ini file, 0 is the default (automatic)
+    lines = readonly_list_file(filename)
+    line = "FFTLength={0}".format(fftlen)
+    for i, aline in enumerate(lines):
+        if aline.startswith("FFTLength="):
+            lines[i] = line
+            break
+    else:
+        lines.append(line)
+    write_list_file(filename + ".tmp", lines)
+    replace_file(filename + ".tmp", filename)
+
+
+def check_cuda_errors(assignment, fftlen):
+    # If too many iterations are done again because of roundoff errors or
+    # device resets, restart CUDALucas with the next benchmarked FFT length
+    # for the rest of this assignment. Returns True if the config was updated.
+    section = worker_section(options.cpu)
+    pid, args = find_mlucas("CUDALucas")
+    ini = os.path.join(workdir, args[args.index("-i") + 1] if args and "-i" in args[:-1] else "CUDALucas.ini")
+    updated = False
+    if config.has_option(section, "cuda_fft_exponent") and int(config.get(section, "cuda_fft_exponent")) != assignment.n:
+        debug_print("Restoring the default FFT length in “{0}”".format(ini))
+        set_cuda_fftlen(ini, 0)
+        config.remove_option(section, "cuda_fft_exponent")
+        config.remove_option(section, "cuda_fft_offset")
+        updated = True
+    since = int(config.get(section, "cuda_fft_offset")) if config.has_option(section, "cuda_fft_offset") else 0
+    events, wasted, rate = parse_cuda_errors(assignment.n, since)
+    if not wasted and not any(events.values()):
+        return updated
+    debug_print("CUDALucas errors for {0}: {1}, {2:n} iterations done again ({3:.2%})".format(
+        assignment.n, ", ".join("{0:n} {1}".format(count, name) for name, count in events.items() if count), wasted, rate))
+    if rate <= CUDA_WASTE_LIMIT or not fftlen:
+        return updated
+    larger = [fft for fft in cuda_fft_table() if fft > fftlen // 1024]
+    if not larger:
+        debug_print("WARNING: {0:.2%} of the iterations are done again, but there is no larger FFT length than {1:n}K in the “<device> fft.txt” file".format(
+            rate, fftlen // 1024), file=sys.stderr)
+        return updated
+    debug_print("WARNING: {0:.2%} of the iterations are done again, restarting CUDALucas with the FFT length {1:n}K instead of {2:n}K".format(
+        rate, larger[0], fftlen // 1024), file=sys.stderr)
+    set_cuda_fftlen(ini, larger[0] * 1024)
+    config.set(section, "cuda_fft_exponent", str(assignment.n))
+    # Only count the errors after the change
+    config.set(section, "cuda_fft_offset", str(os.path.getsize(os.path.join(workdir, options.gpu))))
+    if pid is not None:
+        try:
+            os.kill(pid, signal.SIGTERM)
+            os.kill(pid, signal.SIGCONT)
+        except OSError as e:
+            debug_print("ERROR: Unable to restart CUDALucas: {0}".format(e), file=sys.stderr)
+    return True
+
+
+# Last progress sent for each assignment, saved to “progress_sent.json”
+progress_sent = {}
+# Longest time between the progress updates of an assignment, like the
+# default DaysBetweenCheckins=1 of Prime95
+PROGRESS_INTERVAL = 24 * 60 * 60
+
+
+def checkin_interval():
+    return max(options.timeout, PROGRESS_INTERVAL)
+
+
+def read_progress_sent():
+    try:
+        with open(progressfile) as File:
+            progress_sent.update(json.load(File))
+    except (IOError, OSError, ValueError):
+        pass
+
+
+def write_progress_sent(tasks):
+    # Forget the assignments that are no longer in the workfile
+    with work_mutex:
+        uids = set(task.group(2) for task in (workpattern.search(task)
+                                              for task in tasks) if task)
+        for uid in list(progress_sent):
+            if uid not in uids:
+                del progress_sent[uid]
+        filename = os.path.realpath(progressfile)
+        with open(filename + ".tmp", "w") as File:
+            json.dump(progress_sent, File)
+        replace_file(filename + ".tmp", filename)
+
+
+def progress_unchanged(assignment, percent, time_left):
+    # The server only needs a progress update if the percent done or the
+    # completion date changed enough, or before the client is expected to
+    # check in again (d=), taking the next update interval into account
+    last = progress_sent.get(assignment.uid)
+    if last is None:
+        return False
+    now = time.time()
+    eta = now + (time_left if time_left is not None else 7 * 24 * 60 * 60)
+    return (abs(percent - last["p"]) < options.min_progress and
+            abs(eta - last["e"]) < options.min_eta_change * 60 * 60 and
+            now + options.timeout < last["time"] + last["d"])
+
+
 def send_progress(assignment, percent, time_left,
                   now, delta, fftlen, retry_count=0):
     guid = get_guid(config)
@@ -1205,7 +2714,7 @@ def send_progress(assignment, percent, time_left,
     # p= progress in %-done, 4-char format = xy.z
     args["p"] = "{0:.4f}".format(percent)
     # d= when the client is expected to check in again (in seconds ... )
-    args["d"] = options.timeout if options.timeout else 24 * 60 * 60
+    args["d"] = checkin_interval()
     # e= the ETA of completion in seconds, if unknown, just put 1 week
     args["e"] = int(time_left) if time_left is not None else 7 * 24 * 60 * 60
     # c= the worker thread of the machine ... always sets = 0 for now,
@@ -1231,6 +2740,9 @@ def send_progress(assignment, percent, time_left,
         rc = int(result["pnErrorResult"])
         if rc == primenet_api.ERROR_OK:
             debug_print("Update correctly sent to server")
+            with work_mutex:
+                progress_sent[assignment.uid] = {"time": int(time.time()), "p": percent, "e": int(
+                    time.time() + args["e"]), "d": args["d"]}
         else:
             debug_print("ERROR while sending progress on mersenne.org: assignment_id={0}".format(assignment.uid),
                         file=sys.stderr)
@@ -1245,11 +2757,15 @@ def send_progress(assignment, percent, time_left,
                 retry = True
             elif rc == primenet_api.ERROR_SERVER_BUSY:
                 retry = True
+            elif rc in frozenset([primenet_api.ERROR_INVALID_ASSIGNMENT_KEY,
+                                  primenet_api.ERROR_WORK_NO_LONGER_NEEDED]):
+                # drop the assignment
+                debug_print("Assignment {0} will be removed from “{1}”".format(
+                    assignment.uid, workfile), file=sys.stderr)
+                with work_mutex:
+                    dead_tasks[assignment.uid] = errors[rc]
             # else:
                 # TODO: treat more errors correctly in all send_request callers
-                # primenet_api.ERROR_INVALID_ASSIGNMENT_KEY
-                # primenet_api.ERROR_WORK_NO_LONGER_NEEDED
-                # drop the assignment
     if retry:
         return send_progress(assignment, percent, time_left,
                              now, delta, fftlen, retry_count + 1)
@@ -1289,7 +2805,7 @@ def get_cuda_ar_object(sendline):
 
 def submit_one_line(sendline):
     """Submit one line"""
-    if not options.gpu:  # Mlucas
+    if not options.gpu:  # Mlucas or Prime95
         try:
             ar = json.loads(sendline)
             is_json = True
@@ -1298,10 +2814,15 @@ def submit_one_line(sendline):
                         resultsfile + "”: " + sendline)
             if "Program: E" in sendline:
                 debug_print("Please upgrade to Mlucas v19 or greater.")
+            ar = None
             is_json = False
     else:  # CUDALucas
         ar = get_cuda_ar_object(sendline)
 
+    if ar is not None and ar.get('worktype', '') != 'LL' and not ar.get('worktype', '').startswith('PRP'):
+        # Prime95 also does factoring, which is not supported by the v5 API here
+        is_json = False
+
     guid = get_guid(config)
     if guid is not None and ar is not None and (options.gpu or is_json):
         # If registered and the ar object was returned successfully, submit using the v5 API
@@ -1431,7 +2952,7 @@ def submit_one_line_manually(sendline):
     """Submit results using manual testing, will be attributed to "Manual Testing" in mersenne.org"""
     debug_print("Submitting using manual results\n" + sendline)
     try:
-        r = s.post(
+        r = session().post(
             primenet_baseurl +
             "manual_result/default.php",
             data={
@@ -1464,10 +2985,9 @@ def submit_work():
     results_send = readonly_list_file(sentfile)
     # Only submit completed work, i.e. the exponent must not exist in worktodo file any more
     # appended line by line, no lock needed
-    results = readonly_list_file(resultsfile)
-    # EWM: Note that readonly_list_file does not need the file(s) to exist - nonexistent files simply yield 0-length rs-array entries.
-    # remove nonsubmittable lines from list of possibles
-    results = filter(mersenne_find, results)
+    # EWM: Note that scan_lines does not need the file(s) to exist - nonexistent files simply yield 0-length rs-array entries.
+    # only keep the submittable lines from the list of possibles
+    results = scan_lines(resultsfile, resultpattern)
 
     # if a line was previously submitted, discard
     results_send = [line for line in results if line not in results_send]
@@ -1491,6 +3011,273 @@ def submit_work():
             sent.append(sendline)
     write_list_file(sentfile, sent, "a")
 
+# The errors after which the gateway keeps a transaction queued to send it
+# again in the next cycle, the others are permanent
+GATEWAY_RETRY_ERRORS = frozenset([primenet_api.ERROR_SERVER_BUSY, primenet_api.ERROR_STALE_CPU_INFO,
+                                  primenet_api.ERROR_UNREGISTERED_CPU, primenet_api.ERROR_INVALID_PARAMETER])
+GATEWAY_KEY_HEADER = "X-Gateway-Key"
+
+
+def format_v5_resp(result):
+    lines = ["{0}={1}".format(key, value) for key, value in result.items()]
+    return "\n".join(lines + ["==END=="]) + "\n"
+
+
+class Gateway(object):
+    # The state of the LAN gateway: a pool of prefetched assignments and the
+    # queued progress, results and unreserves of the clients. It is saved to
+    # “gateway.json” after each change, so nothing is lost on a restart.
+    # The results are forwarded right away and only queued if the server
+    # cannot be reached, those it then refuses are kept in “refused”.
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.pool = []  # ga answers not yet given to a client
+        self.issued = OrderedDict()  # AID -> ga answer given to a client
+        self.progress = OrderedDict()  # AID -> latest ap arguments
+        self.results = []  # ar arguments
+        self.unreserves = []  # AIDs
+        self.errors = {}  # AID -> error from the server, for the client
+        self.refused = []  # [ar arguments, error] refused by the server after they were queued
+        try:
+            with open(filename) as File:
+                state = json.load(File)
+        except (IOError, OSError, ValueError):
+            state = {}
+        for attr in ("pool", "results", "unreserves", "refused"):
+            setattr(self, attr, state.get(attr, []))
+        for attr in ("issued", "progress"):
+            setattr(self, attr, OrderedDict(state.get(attr, [])))
+        self.errors = dict(state.get("errors", {}))
+
+    def save(self):
+        state = {"pool": self.pool, "issued": list(self.issued.items()), "progress": list(self.progress.items()),
+                 "results": self.results, "unreserves": self.unreserves, "errors": self.errors, "refused": self.refused}
+        with open(self.filename + ".tmp", "w") as File:
+            json.dump(state, File)
+        replace_file(self.filename + ".tmp", self.filename)
+
+    def forward(self, args):
+        # Send a client transaction upstream as this computer
+        guid = get_guid(config)
+        fargs = primenet_v5_bargs.copy()
+        for key, value in args.items():
+            if key not in fargs and key not in ("ss", "sh"):
+                fargs[key] = value
+        fargs["g"] = guid
+        return send_request(guid, fargs)
+
+    def send(self, args):
+        # Send a queued transaction upstream, registering this computer again
+        # if the server asks for it. Returns None if it must stay queued.
+        result = self.forward(args)
+        if result is None:
+            return None
+        rc = int(result["pnErrorResult"])
+        if rc in (primenet_api.ERROR_STALE_CPU_INFO, primenet_api.ERROR_UNREGISTERED_CPU):
+            if rc == primenet_api.ERROR_STALE_CPU_INFO:
+                debug_print("STALE CPU INFO ERROR: re-send computer update")
+                register_instance(get_guid(config))
+            else:
+                debug_print(
+                    "UNREGISTERED CPU ERROR: pick a new GUID and register again")
+                register_instance(None)
+            result = self.forward(args)
+            if result is None:
+                return None
+            rc = int(result["pnErrorResult"])
+        if rc in GATEWAY_RETRY_ERRORS:
+            debug_print("Keeping the {0} transaction for {1} queued: {2}".format(
+                args.get("t"), args.get("k"), errors.get(rc, "Unknown error code")), file=sys.stderr)
+            return None
+        return rc
+
+    def fetch(self):
+        # Get one assignment from the server
+        args = OrderedDict((("t", "ga"), ("a", ""), ("c", options.cpu)))
+        result = self.forward(args)
+        if result is None or int(result["pnErrorResult"]) != primenet_api.ERROR_OK or "k" not in result:
+            return None
+        debug_print("Got assignment {0} for the pool: {1}".format(
+            result["k"], result.get("n")))
+        return result
+
+    def answer(self, args):
+        # Answer a client transaction, from the pool and queues when possible
+        t = args.get("t")
+        k = args.get("k")
+        result = OrderedDict(
+            (("pnErrorResult", primenet_api.ERROR_OK), ("pnErrorDetail", "SUCCESS")))
+        if t == "uc":
+            # The clients are not registered, all the work is done as this
+            # computer, so answer with the reply the server gave it
+            result["u"] = config_get(config, "primenet", "username") or options.username
+            result["un"] = config_get(config, "primenet", "name")
+            result["cn"] = config_get(config, "primenet", "hostname")
+            return result
+        if t == "po":
+            # The worktype of the pool, as set by the server
+            section = worker_section(options.cpu)
+            result["w"] = config_get(config, section, "worktype") or options.worktype
+            result["DaysOfWork"] = config_get(config, section, "days_work") or options.days_work
+            return result
+        if t == "ar":
+            rc = self.send(args)
+            with self.lock:
+                self.issued.pop(k, None)
+                self.progress.pop(k, None)
+                if rc is None:
+                    # Sent with the next cycle
+                    self.results.append(args)
+                self.save()
+            if rc is None or rc == primenet_api.ERROR_OK:
+                return result
+            return OrderedDict((("pnErrorResult", rc), ("pnErrorDetail", errors.get(rc, "Unknown error code"))))
+        with self.lock:
+            if t == "ga":
+                assignment = self.pool.pop(0) if self.pool else None
+            elif t == "ap":
+                if k in self.errors:
+                    rc = self.errors.pop(k)
+                    self.save()
+                    return OrderedDict((("pnErrorResult", rc), ("pnErrorDetail", errors.get(rc, "Unknown error code"))))
+                self.progress[k] = args
+                self.save()
+                return result
+            elif t == "au":
+                self.progress.pop(k, None)
+                if k in self.issued:
+                    # Give it to another client
+                    self.pool.insert(0, self.issued.pop(k))
+                else:
+                    self.unreserves.append(k)
+                self.save()
+                return result
+            else:
+                assignment = None
+        if t != "ga":
+            result = self.forward(args)
+            if result is None:
+                result = OrderedDict(((
+                    "pnErrorResult", primenet_api.ERROR_SERVER_BUSY), ("pnErrorDetail", "The gateway is unable to reach the server")))
+            return result
+        if assignment is None:
+            # The pool is empty
+            assignment = self.fetch()
+            if assignment is None:
+                return OrderedDict((("pnErrorResult", primenet_api.ERROR_NO_ASSIGNMENT), ("pnErrorDetail", errors[primenet_api.ERROR_NO_ASSIGNMENT])))
+        with self.lock:
+            self.issued[assignment["k"]] = assignment
+            self.save()
+        debug_print("Gave assignment {0} to {1}".format(
+            assignment["k"], args.get("g")))
+        return assignment
+
+    def cycle(self):
+        # Send the queued transactions in one batch and refill the pool
+        with self.lock:
+            results, unreserves = list(self.results), list(self.unreserves)
+            progress = OrderedDict(self.progress)
+        debug_print("Sending {0:n} result(s), {1:n} progress update(s) and {2:n} unreserve(s)".format(
+            len(results), len(progress), len(unreserves)))
+        # Only the transactions that the server accepted or permanently
+        # refused are removed from the queues
+        sent = []
+        refused = []
+        for args in results:
+            rc = self.send(args)
+            if rc is not None:
+                sent.append(args)
+                if rc != primenet_api.ERROR_OK:
+                    # The client was already told it was accepted, keep it
+                    # so that it can be reported manually
+                    print("ERROR: The server refused a queued result ({0}), it is kept in {1!r}: {2}".format(
+                        errors.get(rc, rc), self.filename, args.get("m", "")), file=sys.stderr)
+                    refused.append([args, rc])
+        done = {}
+        for k, args in progress.items():
+            rc = self.send(args)
+            if rc is not None:
+                done[k] = rc if rc in (
+                    primenet_api.ERROR_INVALID_ASSIGNMENT_KEY, primenet_api.ERROR_WORK_NO_LONGER_NEEDED) else None
+        unreserved = []
+        for k in unreserves:
+            args = OrderedDict((("t", "au"), ("k", k)))
+            if self.send(args) is not None:
+                unreserved.append(k)
+        with self.lock:
+            self.results = [args for args in self.results if args not in sent]
+            self.refused.extend(refused)
+            self.unreserves = [k for k in self.unreserves if k not in unreserved]
+            for k, rc in done.items():
+                # unless the client sent a newer one meanwhile
+                if self.progress.get(k) is progress[k]:
+                    del self.progress[k]
+                if rc is not None:
+                    self.errors[k] = rc
+            num_to_get = options.num_cache - len(self.pool)
+        new = []
+        for _ in range(num_to_get):
+            assignment = self.fetch()
+            if assignment is None:
+                break
+            new.append(assignment)
+        with self.lock:
+            self.pool.extend(new)
+            self.save()
+        debug_print("{0:n} assignment(s) in the pool, {1:n} given to clients".format(
+            len(self.pool), len(self.issued)))
+
+
+class GatewayHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if options.gateway_key:
+            key = self.headers.get(GATEWAY_KEY_HEADER) or ""
+            if not hmac.compare_digest(md5(key.encode("utf-8")).digest(), md5(options.gateway_key.encode("utf-8")).digest()):
+                self.send_error(403, "Wrong or missing gateway key")
+                return
+        args = OrderedDict(parse_qsl(urlparse(self.path).query, keep_blank_values=True))
+        body = format_v5_resp(self.server.gateway.answer(args)).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if options.debug > 1:
+            debug_print(self.address_string() + " " + format % args)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def run_gateway(port):
+    # Serve the v5 API to the computers on the LAN (run with --server), with
+    # one pooled connection upstream as this computer
+    state = Gateway(gatewayfile)
+    # Without a shared key, only the clients on this computer are allowed
+    host = "" if options.gateway_key else "127.0.0.1"
+    server = ThreadingHTTPServer((host, port), GatewayHandler)
+    server.gateway = state
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    debug_print("PrimeNet gateway listening on port {0}, run the clients with --server http://{1}:{0}/{2}".format(
+        port, platform.node() if host == "" else host, " and the same --gateway_key" if options.gateway_key else ""))
+    while True:
+        state.cycle()
+        if options.timeout <= 0:
+            break
+        try:
+            time.sleep(options.timeout)
+        except KeyboardInterrupt:
+            break
+    server.shutdown()
+
+
 #######################################################################################################
 #
 # Start main program here
@@ -1540,6 +3327,8 @@ parser.add_option("-T", "--worktype", dest="worktype", default=str(primenet_api.
 # parser.add_option("-g", "--gpu", action="store_true", dest="gpu", default=False,
 parser.add_option("-g", "--gpu", dest="gpu",
                   help="Get assignments for a GPU (CUDALucas) instead of the CPU (Mlucas). This flag takes as an argument the CUDALucas output filename.")
+parser.add_option("--prime95", action="store_true", dest="prime95", default=False,
+                  help="Handle the PrimeNet communication for Prime95/MPrime (with UsePrimenet=0 in its prime.txt file) instead of Mlucas, reading its “worktodo.txt” and “results.json.txt” files and its progress from the output of “mprime -d” in “nohup.out” (as run by idle.py from our mprime-python-port/mprime.py script) or else its save files. To share one session, queue of progress and results and pool of assignments between all the GIMPS programs on a computer, run one --gateway on it and each with --server.")
 parser.add_option("--num_workers", dest="nw", type="int", default=1,
                   help="Number of worker threads (CPU Cores/GPUs), Default: %default")
 parser.add_option("-c", "--cpu_num", dest="cpu", type="int", default=0,
@@ -1551,15 +3340,40 @@ parser.add_option("-L", "--days_work", dest="days_work", type="int", default=3,
 
 parser.add_option("-t", "--timeout", dest="timeout", type="int", default=60 * 60 * 6,
                   help="Seconds to wait between network updates, Default: %default seconds (6 hours). Use 0 for a single update without looping.")
+parser.add_option("--min_progress", dest="min_progress", type="float", default=1.0,
+                  help="Only send the progress of an assignment if its percent done changed by at least this much, Default: %default%%")
+parser.add_option("--min_eta_change", dest="min_eta_change", type="float", default=12.0,
+                  help="Or if its estimated completion date changed by at least this many hours, Default: %default hours. The progress is always sent at least every {0:n} hours.".format(PROGRESS_INTERVAL // (60 * 60)))
 parser.add_option("--status", action="store_true", dest="status", default=False,
                   help="Output a status report and any expected completion dates for all assignments and exit.")
 parser.add_option("--unreserve_all", action="store_true", dest="unreserve_all", default=False,
                   help="Unreserve all assignments and exit. Requires that the instance is registered with PrimeNet.")
+parser.add_option("--export", dest="export", metavar="FILE",
+                  help="Export the progress history (time, exponent, iteration, msec/iter and FFT length of each update) to FILE in the JSON format, or CSV if it ends with “.csv”, and exit.")
+parser.add_option("--gateway", dest="gateway", type="int", metavar="PORT",
+                  help="Run as a PrimeNet gateway for the computers on the LAN, which are run with --server. It keeps a pool of --num_cache prefetched assignments and sends the progress and results of the clients upstream in one batch every --timeout seconds, as this computer.")
+parser.add_option("--server", dest="server", metavar="URL",
+                  help="URL of a PrimeNet gateway (see --gateway) to use instead of the PrimeNet server, e.g. http://gateway:8080/")
+parser.add_option("--gateway_key", dest="gateway_key", metavar="KEY",
+                  help="Shared secret of the PrimeNet gateway and its clients. The gateway only accepts the clients on the LAN with this key and without it only listens on localhost. Give the same key to the clients with --server.")
+parser.add_option("--record", dest="record", metavar="FILE",
+                  help="Append every PrimeNet transaction, its response and timing to FILE, with the GUIDs and user name replaced by a hash. The file can be replayed with our replay.py script.")
+parser.add_option("--profile", dest="profile", metavar="DIR",
+                  help="Profile each phase of every cycle (registration, submit_work, update_progress_all, send_progress and get_assignment) with cProfile and tracemalloc. Writes a .prof file for each phase and a “profile_summary.txt” of the last {0:n} cycles with the top functions and allocation peaks to DIR. The phases are run one after the other.".format(PROFILE_CYCLES))
+parser.add_option("--plan", action="store_true", dest="plan", default=False,
+                  help="Estimate the time of each worktype on this worker from its measured speed and FFT length, the LL and PRP error rates and the exponents last assigned by the server, then switch to the one with the most useful throughput (exponents verified, counting double-checks and PRP proofs, plus expected new primes per day) where a test finishes within --days_work days and exit.")
+parser.add_option("--rebalance", action="store_true", dest="rebalance", default=False,
+                  help="Compare the speed of this Mlucas worker to the others with the same FFT length and if it is slow, restart Mlucas with a CPU affinity from the topology of the computer. Run it again after some time to keep the new affinity only if it is faster, then exit. Requires that Mlucas is run by idle.py, as mlucas.sh does.")
+parser.add_option("--drain", dest="drain", metavar="BUNDLE",
+                  help="Safely shut down: unreserve the assignments that have not started and save the others with their save files to the BUNDLE .tar.gz file, most complete first, then exit. Stop the GIMPS program first. Requires that the instance is registered with PrimeNet.")
+parser.add_option("--import_bundle", dest="import_bundle", metavar="BUNDLE",
+                  help="Add the assignments and save files from a BUNDLE created with --drain on another computer, to resume them without losing any iterations, then exit.")
 
 group = optparse.OptionGroup(parser, "Registering Options: sent to PrimeNet/GIMPS when registering. The progress will automatically be sent and the program can then be monitored on the GIMPS website CPUs page (https://www.mersenne.org/cpus/), just like with Prime95/MPrime. This also allows for the program to get much smaller Category 0 and 1 exponents, if it meets the other requirements (https://www.mersenne.org/thresholds/).")
 group.add_option("-H", "--hostname", dest="hostname",
                  default=platform.node()[:20], help="Computer name, Default: %default")
-# TODO: add detection for most parameter, including automatic change of the hardware
+# TODO: add detection for most parameter (changes of the hardware are detected
+# with get_hardware_fingerprint())
 # "cpu.unknown"
 group.add_option("--cpu_model", dest="cpu_model", default=cpu_signature,
                  help="Processor (CPU) model, Default: %default")
@@ -1582,22 +3396,6 @@ parser.add_option_group(group)
 #(options, args) = parser.parse_args()
 # print(options)
 
-opts_no_defaults = optparse.Values()
-__, args = parser.parse_args(values=opts_no_defaults)
-options = optparse.Values(parser.get_default_values().__dict__)
-options._update_careful(opts_no_defaults.__dict__)
-
-progname = os.path.basename(sys.argv[0])
-workdir = os.path.expanduser(options.workdir)
-
-localfile = os.path.join(workdir, options.localfile)
-workfile = os.path.join(workdir, options.workfile)
-resultsfile = os.path.join(workdir, options.resultsfile)
-
-
-# A cumulative backup
-sentfile = os.path.join(workdir, "results_sent.txt")
-
 # Good refs re. Python regexp: https://www.geeksforgeeks.org/pattern-matching-python-regex/, https://www.python-course.eu/re.php
 # pre-v19 only handled LL-test assignments starting with either DoubleCheck or Test, followed by =, and ending with 3 ,number pairs:
 #
@@ -1646,128 +3444,250 @@ sentfile = os.path.join(workdir, "results_sent.txt")
 workpattern = re.compile(
     r'^(Test|DoubleCheck|PRP(?:DC)?|Cert)\s*=\s*([0-9A-F]{32})(,(?:-?\d+|"\d+(?:,\d+)*")){3,9}$')
 
-# mersenne.org limit is about 4 KB; stay on the safe side
-# sendlimit = 3000  # TODO: enforce this limit
 
-# If debug is requested
+def set_workdir(directory):
+    """Sets the work directory and the paths of the files in it"""
+    global workdir, localfile, workfile, resultsfile, sentfile, removedfile, historyfile, progressfile, gatewayfile, cpufile
+    workdir = directory
 
-# https://stackoverflow.com/questions/10588644/how-can-i-see-the-entire-http-request-thats-being-sent-by-my-python-application
-if options.debug > 1:
-    try:
-        import http.client as http_client
-    except ImportError:
-        # Python 2
-        import httplib as http_client
-    http_client.HTTPConnection.debuglevel = options.debug
-
-    # You must initialize logging, otherwise you'll not see debug output.
-    logging.basicConfig()
-    logging.getLogger().setLevel(logging.DEBUG)
-    requests_log = logging.getLogger("requests.packages.urllib3")
-    requests_log.setLevel(logging.DEBUG)
-    requests_log.propagate = True
-
-# load local.ini and update options
-config = config_read()
-config_updated = merge_config_and_options(config, options)
-
-# check options after merging so that if local.ini file is changed by hand,
-# values are also checked
-# TODO: check that input char are ascii or at least supported by the server
-if not (8 <= len(options.cpu_model) <= 64):
-    parser.error("cpu_model must be between 8 and 64 characters")
-if options.hostname is not None and len(options.hostname) > 20:
-    parser.error("hostname must be less than 21 characters")
-if options.features is not None and len(options.features) > 64:
-    parser.error("features must be less than 64 characters")
-
-program = programs[2]["name"] if options.gpu else programs[1]["name"]
-
-# Convert mnemonic-form worktypes to corresponding numeric value, check
-# worktype value vs supported ones:
-option_dict = {
-    "SmallestAvail": primenet_api.PRIMENET_WP_LL_FIRST,
-    "DoubleCheck": primenet_api.PRIMENET_WP_LL_DBLCHK,
-    "WorldRecord": primenet_api.PRIMENET_WP_LL_WORLD_RECORD,
-    "100Mdigit": primenet_api.PRIMENET_WP_LL_100M,
-    "SmallestAvailPRP": primenet_api.PRIMENET_WP_PRP_FIRST,
-    "DoubleCheckPRP": primenet_api.PRIMENET_WP_PRP_DBLCHK,
-    "WorldRecordPRP": primenet_api.PRIMENET_WP_PRP_WORLD_RECORD,
-    "100MdigitPRP": primenet_api.PRIMENET_WP_PRP_100M}
-if options.worktype in option_dict:  # this and the above line of code enables us to use words or numbers on the cmdline
-    options.worktype = option_dict[options.worktype]
-supported = frozenset([primenet_api.PRIMENET_WP_LL_FIRST, primenet_api.PRIMENET_WP_LL_DBLCHK, primenet_api.PRIMENET_WP_LL_WORLD_RECORD, primenet_api.PRIMENET_WP_LL_100M, primenet_api.PRIMENET_WP_PRP_FIRST, primenet_api.PRIMENET_WP_PRP_DBLCHK, primenet_api.PRIMENET_WP_PRP_WORLD_RECORD, primenet_api.PRIMENET_WP_PRP_100M
-                       ]) if not options.gpu else frozenset([primenet_api.PRIMENET_WP_LL_FIRST, primenet_api.PRIMENET_WP_LL_DBLCHK, primenet_api.PRIMENET_WP_LL_WORLD_RECORD, primenet_api.PRIMENET_WP_LL_100M])
-if not options.worktype.isdigit() or int(options.worktype) not in supported:
-    parser.error("Unsupported/unrecognized worktype = " +
-                 options.worktype + " for " + program)
-
-# write back local.ini if necessary
-if config_updated:
-    debug_print("write " + options.localfile)
-    config_write(config)
+    localfile = os.path.join(workdir, options.localfile)
+    workfile = os.path.join(workdir, options.workfile)
+    resultsfile = os.path.join(workdir, options.resultsfile)
 
-# if guid already exist, recover it, this way, one can (re)register to change
-# the CPU model (changing instance name can only be done in the website)
-guid = get_guid(config)
-if options.username is None:
-    parser.error("Username must be given")
+    # A cumulative backup
+    sentfile = os.path.join(workdir, "results_sent.txt")
+    # The assignments removed from the workfile and why
+    removedfile = os.path.join(workdir, "worktodo_removed.txt")
+    # The progress time series
+    historyfile = os.path.join(workdir, "progress_history.db")
+    # The last progress sent for each assignment
+    progressfile = os.path.join(workdir, "progress_sent.json")
+    # The pool and queues of --gateway
+    gatewayfile = os.path.join(workdir, "gateway.json")
+    # The Mlucas “-cpu” argument, from mlucas.sh and --rebalance
+    cpufile = os.path.join(workdir, "mlucas_cpu.txt")
+
+
+def simulate(values, server, clock, now):
+    """Runs the script against a simulated PrimeNet server in simulated time, for our simulate.py script
+    Parameters:
+    values (optparse.Values): the options
+    server: replaces the requests session, its get() method returns a response with the text of the v5 API
+    clock: replaces the time module
+    now (datetime subclass): replaces the datetime class
+    """
+    global options, opts_no_defaults, progname, program, s, time, datetime, sqlite3
+    options = values
+    opts_no_defaults = optparse.Values()
+    progname = "primenet.py"
+    program = programs[idx]["name"]
+    s = session_local.session = server
+    time = clock
+    datetime = now
+    # The progress history is not recorded
+    sqlite3 = None
+
+
+def simulate_worker(directory, progress, dead):
+    """Switches to the simulated worker in directory
+    Parameters:
+    directory (string): the work directory of the worker
+    progress (dict): the last progress sent for its assignments
+    dead (OrderedDict): its assignments to remove from the workfile and why
+    Returns:
+    Its configuration
+    """
+    global config, progress_sent, dead_tasks
+    set_workdir(directory)
+    progress_sent = progress
+    dead_tasks = dead
+    config = config_read()
+    return config
 
-if options.cpu >= options.nw:
-    parser.error(
-        "CPU core or GPU number must be less than the number of worker threads")
 
-if options.status:
-    output_status()
-    sys.exit(0)
+def main():
+    global options, opts_no_defaults, progname, config, idx, program, option_dict, supported, guid, primenet_v5_burl, primenet_login
+    opts_no_defaults = optparse.Values()
+    __, args = parser.parse_args(values=opts_no_defaults)
+    options = optparse.Values(parser.get_default_values().__dict__)
+    options._update_careful(opts_no_defaults.__dict__)
+    if options.prime95:
+        # The filenames used by Prime95/MPrime
+        if not hasattr(opts_no_defaults, "workfile"):
+            options.workfile = "worktodo.txt"
+        if not hasattr(opts_no_defaults, "resultsfile"):
+            options.resultsfile = "results.json.txt"
 
-if options.unreserve_all:
-    unreserve_all()
-    sys.exit(0)
+    progname = os.path.basename(sys.argv[0])
+    set_workdir(os.path.expanduser(options.workdir))
 
-while True:
-    # Carry on with Loarer's style of primenet
-    try:
-        if options.password:
-            login_data = {"user_login": options.username,
-                          "user_password": options.password}
-            r = s.post(primenet_baseurl + "default.php", data=login_data)
-            r.raise_for_status()
 
-            if options.username + "<br>logged in" not in r.text:
-                primenet_login = False
-                debug_print("ERROR: Login failed.")
+    # mersenne.org limit is about 4 KB; stay on the safe side
+    # sendlimit = 3000  # TODO: enforce this limit
+
+    # If debug is requested
+
+    # https://stackoverflow.com/questions/10588644/how-can-i-see-the-entire-http-request-thats-being-sent-by-my-python-application
+    if options.debug > 1:
+        try:
+            import http.client as http_client
+        except ImportError:
+            # Python 2
+            import httplib as http_client
+        http_client.HTTPConnection.debuglevel = options.debug
+
+        # You must initialize logging, otherwise you'll not see debug output.
+        logging.basicConfig()
+        logging.getLogger().setLevel(logging.DEBUG)
+        requests_log = logging.getLogger("requests.packages.urllib3")
+        requests_log.setLevel(logging.DEBUG)
+        requests_log.propagate = True
+
+    # load local.ini and update options
+    config = config_read()
+    config_updated = config_migrate(config)
+    config_updated = merge_config_and_options(config, options) or config_updated
+
+    # check options after merging so that if local.ini file is changed by hand,
+    # values are also checked
+    # TODO: check that input char are ascii or at least supported by the server
+    if not (8 <= len(options.cpu_model) <= 64):
+        parser.error("cpu_model must be between 8 and 64 characters")
+    if options.hostname is not None and len(options.hostname) > 20:
+        parser.error("hostname must be less than 21 characters")
+    if options.features is not None and len(options.features) > 64:
+        parser.error("features must be less than 64 characters")
+
+    if options.prime95 and options.gpu:
+        parser.error("The --prime95 and --gpu options cannot be used together")
+    if options.prime95:
+        idx = 0
+    program = programs[2]["name"] if options.gpu else programs[idx]["name"]
+
+    # Convert mnemonic-form worktypes to corresponding numeric value, check
+    # worktype value vs supported ones:
+    option_dict = {
+        "SmallestAvail": primenet_api.PRIMENET_WP_LL_FIRST,
+        "DoubleCheck": primenet_api.PRIMENET_WP_LL_DBLCHK,
+        "WorldRecord": primenet_api.PRIMENET_WP_LL_WORLD_RECORD,
+        "100Mdigit": primenet_api.PRIMENET_WP_LL_100M,
+        "SmallestAvailPRP": primenet_api.PRIMENET_WP_PRP_FIRST,
+        "DoubleCheckPRP": primenet_api.PRIMENET_WP_PRP_DBLCHK,
+        "WorldRecordPRP": primenet_api.PRIMENET_WP_PRP_WORLD_RECORD,
+        "100MdigitPRP": primenet_api.PRIMENET_WP_PRP_100M}
+    if options.worktype in option_dict:  # this and the above line of code enables us to use words or numbers on the cmdline
+        options.worktype = option_dict[options.worktype]
+    supported = frozenset([primenet_api.PRIMENET_WP_LL_FIRST, primenet_api.PRIMENET_WP_LL_DBLCHK, primenet_api.PRIMENET_WP_LL_WORLD_RECORD, primenet_api.PRIMENET_WP_LL_100M, primenet_api.PRIMENET_WP_PRP_FIRST, primenet_api.PRIMENET_WP_PRP_DBLCHK, primenet_api.PRIMENET_WP_PRP_WORLD_RECORD, primenet_api.PRIMENET_WP_PRP_100M
+                           ]) if not options.gpu else frozenset([primenet_api.PRIMENET_WP_LL_FIRST, primenet_api.PRIMENET_WP_LL_DBLCHK, primenet_api.PRIMENET_WP_LL_WORLD_RECORD, primenet_api.PRIMENET_WP_LL_100M])
+    if not options.worktype.isdigit() or int(options.worktype) not in supported:
+        parser.error("Unsupported/unrecognized worktype = " +
+                     options.worktype + " for " + program)
+
+    # write back local.ini if necessary
+    if config_updated:
+        debug_print("write " + options.localfile)
+        config_write(config)
+
+    # if guid already exist, recover it, this way, one can (re)register to change
+    # the CPU model (changing instance name can only be done in the website)
+    guid = get_guid(config)
+    if options.username is None:
+        parser.error("Username must be given")
+
+    if options.cpu >= options.nw:
+        parser.error(
+            "CPU core or GPU number must be less than the number of worker threads")
+
+    if options.status:
+        output_status()
+        sys.exit(0)
+
+    if options.export:
+        export_history(options.export)
+        sys.exit(0)
+
+    if options.unreserve_all:
+        unreserve_all()
+        sys.exit(0)
+
+    if options.server:
+        primenet_v5_burl = options.server.rstrip("?") + "?"
+        if options.gateway_key:
+            s.headers[GATEWAY_KEY_HEADER] = options.gateway_key
+
+    if options.gateway:
+        if options.password or options.server:
+            parser.error("The gateway requires the v5 API directly to the PrimeNet server")
+        if guid is None:
+            register_instance(guid)
+            guid = get_guid(config)
+        run_gateway(options.gateway)
+        sys.exit(0)
+
+    if options.plan:
+        plan(guid)
+        sys.exit(0)
+
+    if options.rebalance:
+        rebalance()
+        sys.exit(0)
+
+    if options.drain:
+        drain(options.drain)
+        sys.exit(0)
+
+    if options.import_bundle:
+        import_bundle(options.import_bundle)
+        sys.exit(0)
+
+    if options.profile and not os.path.isdir(options.profile):
+        os.makedirs(options.profile)
+
+    read_progress_sent()
+
+    while True:
+        # Carry on with Loarer's style of primenet
+        try:
+            if options.password:
+                login_data = {"user_login": options.username,
+                              "user_password": options.password}
+                r = s.post(primenet_baseurl + "default.php", data=login_data)
+                r.raise_for_status()
+
+                if options.username + "<br>logged in" not in r.text:
+                    primenet_login = False
+                    debug_print("ERROR: Login failed.")
+                else:
+                    primenet_login = True
+            # use the v5 API for registration and program options
             else:
-                primenet_login = True
-        # use the v5 API for registration and program options
-        else:
-            if guid is None:
-                register_instance(guid)
-                if options.timeout <= 0:
-                    break
-            # worktype has changed, update worktype preference in program_options()
-            # if config_updated:
-            elif config_updated:
-                program_options(guid, False)
-    except HTTPError as e:
-        debug_print("ERROR: Login failed.")
-
-    # branch 1 or branch 2 above was taken
-    if not options.password or (options.password and primenet_login):
-        submit_work()
-        progress = update_progress_all()
-        got = get_assignment(progress)
-        debug_print("Got: {0:n}".format(got))
-        if got > 0 and not options.password:
-            debug_print(
-                "Redo progress update to update the just obtain assignmment(s)")
-            time.sleep(1)
-            update_progress_all()
-    if options.timeout <= 0:
-        break
-    try:
-        time.sleep(options.timeout)
-    except KeyboardInterrupt:
-        break
+                if guid is None:
+                    profile_phase("registration", register_instance, guid)
+                    if options.timeout <= 0:
+                        break
+                elif hardware_changed():
+                    profile_phase("registration", update_hardware, guid)
+                # worktype has changed, update worktype preference in program_options()
+                # if config_updated:
+                elif config_updated:
+                    profile_phase("registration", program_options, guid, False)
+        except HTTPError as e:
+            debug_print("ERROR: Login failed.")
+
+        # branch 1 or branch 2 above was taken
+        if not options.password or (options.password and primenet_login):
+            run_cycle()
+        if options.profile:
+            profile_summary()
+        if options.timeout <= 0:
+            break
+        try:
+            wait_timeout()
+        except KeyboardInterrupt:
+            break
+
+    sys.exit(0)
+
 
-sys.exit(0)
+if __name__ == "__main__":
+    main()
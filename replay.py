@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+
+# Teal Dulcet and Daniel Connelly
+# Replays the PrimeNet v5 transactions recorded by the PrimeNet script with --record, so that changes to the
+# transport, retries or batching can be benchmarked without a network.
+# As a server, it answers each request with the recorded response of the same transaction (and assignment),
+# after the recorded delay. As a client (--target), it sends the recorded requests with the recorded timing.
+# The delays are divided by --speed.
+# ./replay.py [options] <log>
+# ./replay.py -p 8765 --speed 10 primenet.log, then python3 primenet.py --server http://localhost:8765/
+# ./replay.py --target http://localhost:8080/ --speed 3600 primenet.log
+
+import sys
+import json
+import time
+import signal
+import optparse
+import threading
+import urllib.request
+import urllib.error
+from urllib.parse import urlencode, urlparse, parse_qsl
+from collections import Counter, OrderedDict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from statistics import mean, median
+
+# pnErrorResult when there is no recorded response left, ERROR_SERVER_BUSY
+BUSY = "pnErrorResult=3\npnErrorDetail=No recorded response\n==END==\n"
+
+
+def read_log(filename):
+    '''Reads a --record log
+    Returns:
+    The list of transactions, in the order they were sent
+    '''
+    entries = []
+    with open(filename) as f:
+        for line in f:
+            if line.strip():
+                entries.append(json.loads(line, object_pairs_hook=OrderedDict))
+    return sorted(entries, key=lambda entry: entry["time"])
+
+
+class Recording:
+    '''The recorded responses, in queues for each transaction type and for each transaction type and assignment ID'''
+
+    def __init__(self, entries):
+        self.lock = threading.Lock()
+        self.queues = {}
+        for entry in entries:
+            args = entry["args"]
+            if args.get("k"):
+                self.queues.setdefault((args["t"], args["k"]), deque()).append(entry)
+            self.queues.setdefault((args["t"], None), deque()).append(entry)
+        self.used = set()
+        self.stats = Counter()
+
+    def next(self, args):
+        '''The first unused response for the same transaction and assignment, or else the same transaction'''
+        with self.lock:
+            keys = [(args.get("t"), args["k"])] if args.get("k") else []
+            for key in keys + [(args.get("t"), None)]:
+                queue = self.queues.get(key, deque())
+                while queue and id(queue[0]) in self.used:
+                    queue.popleft()
+                if queue:
+                    entry = queue.popleft()
+                    self.used.add(id(entry))
+                    self.stats["matched" if key[1] is not None else "by transaction"] += 1
+                    return entry
+            self.stats["unmatched"] += 1
+            return None
+
+
+class ReplayHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        args = dict(parse_qsl(urlparse(self.path).query, keep_blank_values=True))
+        entry = self.server.recording.next(args)
+        if entry is not None:
+            time.sleep(entry["elapsed"] / self.server.speed)
+        if entry is not None and "response" not in entry:
+            # The connection failed when it was recorded
+            self.close_connection = True
+            return
+        body = (entry["response"] if entry is not None else BUSY).encode("utf-8")
+        self.send_response(200 if entry is None or "error" not in entry else 500)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.debug:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+def serve(entries, port, speed, debug):
+    server = ThreadingHTTPServer(("", port), ReplayHandler)
+    server.recording = Recording(entries)
+    server.speed = speed
+    server.debug = debug
+    print("Replaying {0:n} transactions on port {1}, run the PrimeNet script with --server http://localhost:{1}/".format(
+        len(entries), port))
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(", ".join("{0}: {1:n}".format(key, value) for key, value in sorted(server.recording.stats.items())))
+
+
+def send(entries, target, speed):
+    '''Sends the recorded requests to target with the recorded timing
+    Returns:
+    The number of requests that failed
+    '''
+    url = target.rstrip("?") + "?"
+    first = entries[0]["time"]
+    start = time.time()
+    latencies = {}
+    errors = 0
+    for entry in entries:
+        delay = start + (entry["time"] - first) / speed - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        begin = time.time()
+        try:
+            with urllib.request.urlopen(url + urlencode(entry["args"]), timeout=60) as r:
+                r.read()
+        except (urllib.error.URLError, OSError) as e:
+            sys.stderr.write("Error sending the “{0}” transaction: {1}\n".format(entry["args"]["t"], e))
+            errors += 1
+        latencies.setdefault(entry["args"]["t"], []).append((time.time() - begin, entry["elapsed"]))
+    print("{0:>4} {1:>7} {2:>12} {3:>12} {4:>12}".format("t", "count", "median (s)", "max (s)", "recorded (s)"))
+    for t, values in sorted(latencies.items()):
+        print("{0:>4} {1:7n} {2:12.4f} {3:12.4f} {4:12.4f}".format(
+            t, len(values), median(v for v, _ in values), max(v for v, _ in values), mean(v for _, v in values)))
+    print("{0:n} requests in {1:.4n} seconds, {2:n} errors".format(len(entries), time.time() - start, errors))
+    return errors
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options] <log>",
+                                   description="Replays the PrimeNet v5 transactions recorded by the PrimeNet script with --record, either as a server that answers with the recorded responses or as a client that sends the recorded requests to --target.")
+    parser.add_option("-p", "--port", dest="port", type="int", default=8765, help="Port of the server, Default: %default")
+    parser.add_option("--target", dest="target", metavar="URL",
+                      help="Send the recorded requests to this server (e.g. a --gateway) instead")
+    parser.add_option("-s", "--speed", dest="speed", type="float", default=1,
+                      help="Replay this many times faster than recorded, Default: %default")
+    parser.add_option("-d", "--debug", action="store_true", dest="debug", default=False, help="Log every request")
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error("A --record log is required")
+    if options.speed <= 0:
+        parser.error("The speed must be greater than 0")
+    entries = read_log(args[0])
+    if not entries:
+        parser.error("“{0}” does not have any transactions".format(args[0]))
+    if options.target:
+        sys.exit(1 if send(entries, options.target, options.speed) else 0)
+    serve(entries, options.port, options.speed, options.debug)
+
+
+if __name__ == "__main__":
+    main()
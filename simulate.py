@@ -0,0 +1,375 @@
+#!/usr/bin/env python3
+
+# Teal Dulcet and Daniel Connelly
+# Discrete-event simulator of a fleet of workers, which runs the real decision logic of the PrimeNet script
+# (sizing of the assignment requests, progress ETAs and retries) against a simulated PrimeNet server with outages,
+# to choose the --timeout, --num_cache and --days_work options offline.
+# The speed of the workers is from a CUDALucas “<device> fft.txt” table or from recorded Mlucas .stat files.
+# ./simulate.py [options]
+# ./simulate.py --days 180 --workers 4 -t 21600,3600 -n 0,1,2 -L 1,3 --outage 30:48 --outages 3
+# ./simulate.py --stat p110000017.stat -n 1
+
+import sys
+import os
+import re
+import json
+import heapq
+import uuid
+import random
+import shutil
+import tempfile
+import itertools
+import threading
+import optparse
+import contextlib
+import time
+from datetime import datetime
+from collections import Counter, OrderedDict
+
+import primenet
+from cudalucas_bench import parse_fft
+
+DAY = 24 * 60 * 60
+# Days after which the server expires an assignment that has no result
+DEADLINE = 180
+TABLE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                     "google-colab", "gpu_optimizations", "Tesla T4 fft.txt")
+
+
+class Clock(object):
+    '''Replaces the time module in the PrimeNet script, so that it runs in simulated time'''
+
+    def __init__(self, start):
+        self.now = start
+
+    def time(self):
+        return self.now
+
+    def sleep(self, secs):
+        pass
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+clock = Clock(time.time())
+
+
+class SimDatetime(datetime):
+    @classmethod
+    def now(cls, tz=None):
+        return cls.fromtimestamp(clock.now, tz)
+
+
+class Response(object):
+    '''The part of a requests response used by send_request()'''
+
+    def __init__(self, url, text):
+        self.url = url
+        self.text = text
+
+    def raise_for_status(self):
+        pass
+
+
+class Server(object):
+    '''Simulated PrimeNet v5 server, which replaces the requests session of the PrimeNet script.
+    An assignment expires if it has no progress update for expire days or no result for deadline days.'''
+
+    def __init__(self, exponent, outages, expire, deadline):
+        self.exponent = exponent
+        self.outages = outages
+        self.expire = expire
+        self.deadline = deadline
+        self.lock = threading.Lock()
+        self.assignments = OrderedDict()
+        self.requests = Counter()
+
+    def get(self, url, params=None):
+        if any(start <= clock.now < end for start, end in self.outages):
+            raise primenet.ConnectionError("Simulated outage")
+        with self.lock:
+            self.requests[params["t"]] += 1
+            self.expire_assignments()
+            return Response(url, primenet.format_v5_resp(self.answer(params)))
+
+    def expire_assignments(self):
+        for a in self.assignments.values():
+            if a["done"] is None and not a["expired"] and (
+                    clock.now - a["updated"] > self.expire or clock.now - a["issued"] > self.deadline):
+                a["expired"] = True
+
+    def answer(self, args):
+        result = OrderedDict((("pnErrorResult", primenet.primenet_api.ERROR_OK), ("pnErrorDetail", "SUCCESS")))
+        t = args["t"]
+        if t == "ga":
+            aid = uuid.UUID(int=random.getrandbits(128)).hex.upper()
+            self.exponent += 1
+            while not primenet.isPrime(self.exponent):
+                self.exponent += 1
+            self.assignments[aid] = {"n": self.exponent, "issued": clock.now, "updated": clock.now,
+                                     "done": None, "expired": False, "at_risk": False}
+            result.update((("k", aid), ("w", primenet.primenet_api.PRIMENET_WORK_TYPE_FIRST_LL),
+                           ("n", self.exponent), ("sf", 76), ("p1", 1)))
+        elif t in ("ap", "ar"):
+            a = self.assignments.get(args["k"])
+            if a is None or (t == "ap" and a["expired"]):
+                result["pnErrorResult"] = primenet.primenet_api.ERROR_INVALID_ASSIGNMENT_KEY
+                result["pnErrorDetail"] = "Invalid assignment key"
+            elif t == "ap":
+                a["updated"] = clock.now
+                if clock.now + int(args["e"]) > a["issued"] + self.deadline:
+                    a["at_risk"] = True
+            else:
+                a["done"] = clock.now
+        elif t == "uc":
+            result.update((("u", args["u"]), ("un", args["u"]), ("cn", args.get("cn", ""))))
+        return result
+
+
+class Worker(object):
+    '''A simulated GIMPS program and its PrimeNet script in their own work directory'''
+
+    def __init__(self, num, directory, speed):
+        self.num = num
+        self.directory = directory
+        self.speed = speed
+        self.task = None  # (line, exponent, start, msec/iter)
+        self.idle_since = 0
+        self.idle = 0
+        self.progress_sent = {}
+        self.dead_tasks = OrderedDict()
+        os.makedirs(directory)
+
+    def activate(self):
+        '''Switches the PrimeNet script to this worker
+        Returns:
+        The configuration of the worker
+        '''
+        return primenet.simulate_worker(self.directory, self.progress_sent, self.dead_tasks)
+
+    def statfile(self, p):
+        return os.path.join(self.directory, "p{0}.stat".format(p))
+
+    def start(self, events):
+        '''Starts the first assignment in the workfile, like Mlucas'''
+        tasks = [task for task in primenet.read_workfile() if primenet.workpattern.search(task)]
+        if not tasks:
+            return
+        p = int(tasks[0].split(",")[1])
+        msec = self.speed(p)
+        self.task = (tasks[0], p, clock.now, msec)
+        self.idle += clock.now - self.idle_since
+        heapq.heappush(events, (clock.now + p * msec / 1000, next(counter), "finish", self))
+
+    def write_stat(self):
+        if self.task is None:
+            return
+        _, p, start, msec = self.task
+        iteration = min(int((clock.now - start) * 1000 / msec), p - 2)
+        fftlen = -(-int(primenet.fft_words(p)) // 1024)
+        with open(self.statfile(p), "w") as f:
+            f.write("M{0}: using FFT length {1}K = {2} 8-byte floats.\n".format(p, fftlen, fftlen * 1024))
+            f.write("M{0} Iter# = {1} [{2:5.2f}% complete] clocks = 00:00:00.000 [ {3:.4f} msec/iter] Res64: 0000000000000000.\n".format(
+                p, iteration, 100 * iteration / p, msec))
+
+    def finish(self, events):
+        line, p, _, _ = self.task
+        aid = primenet.workpattern.search(line).group(2)
+        with open(primenet.resultsfile, "a") as f:
+            f.write(json.dumps({"status": "C", "exponent": p, "worktype": "LL", "res64": "0000000000000000",
+                                "fft-length": -(-int(primenet.fft_words(p)) // 1024) * 1024, "shift-count": 0,
+                                "error-code": "00000000", "program": {"name": "Mlucas", "version": "20.1"},
+                                "aid": aid}) + "\n")
+        tasks = primenet.readonly_list_file(primenet.workfile)
+        if line in tasks:
+            tasks.remove(line)
+            with open(primenet.workfile, "w") as f:
+                f.writelines(task + "\n" for task in tasks)
+        os.remove(self.statfile(p))
+        self.task = None
+        self.idle_since = clock.now
+        self.start(events)
+
+
+counter = itertools.count()
+
+
+def table_speed(filename):
+    '''The ms/iter of the smallest FFT length that can test the exponent, from a “<device> fft.txt” table'''
+    with open(filename) as f:
+        _, rows = parse_fft(f.read())
+    rows = sorted(rows.values())
+
+    def speed(p):
+        return next((ms for maxexp, ms in rows if maxexp >= p), rows[-1][1] * p / rows[-1][0])
+    return speed
+
+
+def stat_speed(filenames):
+    '''The ms/iter from recorded Mlucas .stat files, scaled to the exponent like --plan'''
+    speeds = []
+    for filename in filenames:
+        res = re.match(r'^p(\d+)\.stat$', os.path.basename(filename))
+        if not res:
+            sys.stderr.write("Error: “{0}” is not a “p<exponent>.stat” file\n".format(filename))
+            sys.exit(1)
+        if not os.path.isfile(filename):
+            sys.stderr.write("Error: “{0}” does not exist\n".format(filename))
+            sys.exit(1)
+        _, msec_per_iter, fftlen = primenet.parse_stat_file(int(res.group(1)), os.path.dirname(os.path.abspath(filename)))
+        if msec_per_iter is None:
+            sys.stderr.write("Error: “{0}” does not have the speed\n".format(filename))
+            sys.exit(1)
+        speeds.append((msec_per_iter, fftlen or primenet.fft_words(int(res.group(1)))))
+    worktype = primenet.primenet_api.PRIMENET_WP_PRP_FIRST
+
+    def speed(p):
+        msec_per_iter, fftlen = random.choice(speeds)
+        days, _ = primenet.estimate_test(p, worktype, msec_per_iter, fftlen)
+        return days * DAY * 1000 / p / (1 + primenet.PRP_ERROR_RATE)
+    return speed
+
+
+def simulate(options, timeout, num_cache, days_work, outages, speed, directory):
+    '''Runs the fleet with one configuration
+    Returns:
+    A dictionary of the results
+    '''
+    rng = random.Random(options.seed)
+    random.seed(options.seed)
+    start = clock.now = time.time()
+    end = start + options.days * DAY
+    server = Server(options.exponent, [(start + s, start + e) for s, e in outages],
+                    options.expire * DAY, options.deadline * DAY)
+    # The PrimeNet script runs with these options in simulated time against the simulated server
+    values = primenet.parser.get_default_values()
+    values.debug = options.debug
+    values.timeout = timeout
+    values.num_cache = num_cache
+    values.days_work = days_work
+    primenet.simulate(values, server, clock, SimDatetime)
+    workers = []
+    events = []
+    for i in range(options.workers):
+        factor = 1 + rng.uniform(-options.jitter, options.jitter)
+        worker = Worker(i, os.path.join(directory, "worker{0}".format(i)),
+                        lambda p, factor=factor: speed(p) * factor)
+        worker.idle_since = start
+        config = worker.activate()
+        config.set("primenet", "guid", primenet.create_new_guid())
+        config.set("primenet", "username", "ANONYMOUS")
+        primenet.merge_config_and_options(config, values)
+        primenet.config_write(config)
+        workers.append(worker)
+        # The workers are not started at the same time
+        heapq.heappush(events, (start + rng.uniform(0, 60), next(counter), "cycle", worker))
+    devnull = open(os.devnull, "w")
+    while events and events[0][0] < end:
+        clock.now, _, kind, worker = heapq.heappop(events)
+        worker.activate()
+        with contextlib.ExitStack() as stack:
+            if not options.debug:
+                stack.enter_context(contextlib.redirect_stdout(devnull))
+                stack.enter_context(contextlib.redirect_stderr(devnull))
+            if kind == "finish":
+                worker.finish(events)
+            else:
+                worker.write_stat()
+                primenet.run_cycle()
+                if worker.task is None:
+                    worker.start(events)
+                heapq.heappush(events, (clock.now + timeout, next(counter), "cycle", worker))
+    devnull.close()
+    clock.now = end
+    server.expire_assignments()
+    for worker in workers:
+        if worker.task is None:
+            worker.idle += end - worker.idle_since
+    assignments = list(server.assignments.values())
+    done = [a for a in assignments if a["done"] is not None]
+    return {"idle": sum(worker.idle for worker in workers) * options.cores / 3600,
+            "requests": sum(server.requests.values()) / options.days, "ga": server.requests["ga"] / options.days,
+            "ap": server.requests["ap"] / options.days, "ar": server.requests["ar"] / options.days,
+            "assignments": len(assignments), "done": len(done),
+            "expired": sum(1 for a in assignments if a["expired"]), "at_risk": sum(1 for a in assignments if a["at_risk"]),
+            "days": sum(a["done"] - a["issued"] for a in done) / len(done) / DAY if done else 0}
+
+
+def parse_outages(options, rng):
+    '''Returns the outages as (start, end) seconds from the start of the simulation'''
+    outages = []
+    for outage in options.outage:
+        res = re.match(r'^(\d+(?:\.\d+)?):(\d+(?:\.\d+)?)$', outage)
+        if not res:
+            sys.stderr.write("Error: The outage “{0}” is not DAY:HOURS\n".format(outage))
+            sys.exit(1)
+        outages.append((float(res.group(1)) * DAY, float(res.group(1)) * DAY + float(res.group(2)) * 3600))
+    for _ in range(options.outages):
+        day = rng.uniform(0, options.days) * DAY
+        outages.append((day, day + options.outage_hours * 3600))
+    return sorted(outages)
+
+
+def int_list(option, opt, value, parser):
+    setattr(parser.values, option.dest, [int(x) for x in value.split(",")])
+
+
+def main():
+    parser = optparse.OptionParser(description="Simulates a fleet of workers running the PrimeNet script against a simulated PrimeNet server, for each combination of the --timeout, --num_cache and --days_work values, and reports the idle core-hours, requests per day and expiry risk.")
+    parser.add_option("--days", dest="days", type="float", default=180, help="Simulated days, Default: %default days")
+    parser.add_option("--workers", dest="workers", type="int", default=4, help="Number of workers, Default: %default")
+    parser.add_option("--cores", dest="cores", type="int", default=1,
+                      help="CPU cores (or GPUs) of each worker, for the idle core-hours, Default: %default")
+    parser.add_option("-t", "--timeout", dest="timeout", type="string", action="callback", callback=int_list, default=[60 * 60 * 6],
+                      help="Comma separated values of the seconds to wait between network updates, Default: 21600")
+    parser.add_option("-n", "--num_cache", dest="num_cache", type="string", action="callback", callback=int_list, default=[0],
+                      help="Comma separated values of the number of assignments to cache, Default: 0")
+    parser.add_option("-L", "--days_work", dest="days_work", type="string", action="callback", callback=int_list, default=[3],
+                      help="Comma separated values of the days of work to queue, Default: 3")
+    parser.add_option("--fft_table", dest="fft_table", default=TABLE,
+                      help="CUDALucas “<device> fft.txt” table with the speed of the workers, Default: %default")
+    parser.add_option("--stat", dest="stat", action="append", default=[],
+                      help="Recorded Mlucas “p<exponent>.stat” file with the speed of the workers, instead of the table. Can be given multiple times.")
+    parser.add_option("--exponent", dest="exponent", type="int", default=primenet.PLAN_EXPONENTS[primenet.primenet_api.PRIMENET_WP_LL_FIRST],
+                      help="First exponent given by the server, Default: %default")
+    parser.add_option("--outage", dest="outage", action="append", default=[], metavar="DAY:HOURS",
+                      help="Server outage starting on the day for the hours. Can be given multiple times.")
+    parser.add_option("--outages", dest="outages", type="int", default=0, help="Number of random server outages, Default: %default")
+    parser.add_option("--outage_hours", dest="outage_hours", type="float", default=12,
+                      help="Hours of each random server outage, Default: %default hours")
+    parser.add_option("--expire", dest="expire", type="float", default=60,
+                      help="Days without a progress update after which the server expires an assignment, Default: %default days")
+    parser.add_option("--deadline", dest="deadline", type="float", default=DEADLINE,
+                      help="Days after which the server expires an assignment that has no result, Default: %default days")
+    parser.add_option("--jitter", dest="jitter", type="float", default=0.05,
+                      help="Maximum relative difference in the speed of the workers, Default: %default")
+    parser.add_option("--seed", dest="seed", type="int", default=1, help="Random seed, Default: %default")
+    parser.add_option("-d", "--debug", action="count", dest="debug", default=0, help="Display the output of the PrimeNet script")
+    options, args = parser.parse_args()
+    if args:
+        parser.error("Unexpected arguments")
+    if any(timeout <= 0 for timeout in options.timeout):
+        parser.error("The timeout must be greater than 0")
+
+    speed = stat_speed(options.stat) if options.stat else table_speed(options.fft_table)
+    outages = parse_outages(options, random.Random(options.seed))
+
+    print("{0:n} workers for {1:n} days, {2:n} outages ({3:.4n} hours)\n".format(
+        options.workers, options.days, len(outages), sum(end - start for start, end in outages) / 3600))
+    print("{0:>8} {1:>5} {2:>5} {3:>10} {4:>10} {5:>6} {6:>6} {7:>6} {8:>8} {9:>8} {10:>8} {11:>8}".format(
+        "timeout", "cache", "days", "idle h", "req/day", "ga", "ap", "ar", "done", "expired", "at risk", "days"))
+    for timeout, num_cache, days_work in itertools.product(options.timeout, options.num_cache, options.days_work):
+        directory = tempfile.mkdtemp(prefix="simulate")
+        try:
+            r = simulate(options, timeout, num_cache, days_work, outages, speed, directory)
+        finally:
+            shutil.rmtree(directory)
+        print("{0:8n} {1:5n} {2:5n} {3:10.1f} {4:10.1f} {5:6.1f} {6:6.1f} {7:6.1f} {8:8n} {9:8n} {10:8n} {11:8.1f}".format(
+            timeout, num_cache, days_work, r["idle"], r["requests"], r["ga"], r["ap"], r["ar"],
+            r["done"], r["expired"], r["at_risk"], r["days"]))
+        sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+# Teal Dulcet and Daniel Connelly
+# Tests of cudalucas_bench.py with the CUDALucas “-cufftbench” and “-threadbench” output files in fixtures
+# python3 -m unittest discover -s tests
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, ROOT)
+
+import cudalucas_bench
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "cudalucas")
+FFT_FILE = os.path.join(FIXTURES, "Tesla T4 fft.txt")
+THREADS_FILE = os.path.join(FIXTURES, "Tesla T4 threads.txt")
+
+
+class ParseTest(unittest.TestCase):
+    def test_parse_fft(self):
+        header, rows = cudalucas_bench.parse_fft(cudalucas_bench.read_file(FFT_FILE))
+        self.assertEqual(cudalucas_bench.device_name(header), "Tesla T4")
+        self.assertEqual(header[1], "Compatibility       7.5")
+        self.assertEqual(rows, {1024: (19535569, 1.6012), 1152: (21921901, 1.3001), 1200: (22812433, 1.3977)})
+
+    def test_parse_threads(self):
+        rows = cudalucas_bench.parse_threads(cudalucas_bench.read_file(THREADS_FILE))
+        self.assertEqual(rows, {1024: (64, 64, 1.02113), 1029: (32, 64, 1.61), 1120: (64, 128, 1.50001)})
+
+    def test_format(self):
+        # The tables are written in the same format that CUDALucas reads
+        header, rows = cudalucas_bench.parse_fft(cudalucas_bench.read_file(FFT_FILE))
+        self.assertEqual(cudalucas_bench.format_fft(header, rows), cudalucas_bench.read_file(FFT_FILE))
+        rows = cudalucas_bench.parse_threads(cudalucas_bench.read_file(THREADS_FILE))
+        self.assertEqual(cudalucas_bench.format_threads(rows), cudalucas_bench.read_file(THREADS_FILE))
+
+
+class MergeTest(unittest.TestCase):
+    def setUp(self):
+        self.tables = tempfile.mkdtemp()
+        for name in ("Tesla T4 fft.txt", "Tesla T4 threads.txt"):
+            shutil.copy(os.path.join(cudalucas_bench.TABLES, name), self.tables)
+        self.old_fft = cudalucas_bench.parse_fft(cudalucas_bench.read_file(
+            os.path.join(self.tables, "Tesla T4 fft.txt")))
+        self.old_threads = cudalucas_bench.parse_threads(cudalucas_bench.read_file(
+            os.path.join(self.tables, "Tesla T4 threads.txt")))
+
+    def tearDown(self):
+        shutil.rmtree(self.tables)
+
+    def check_merged(self):
+        header, rows = cudalucas_bench.parse_fft(cudalucas_bench.read_file(
+            os.path.join(self.tables, "Tesla T4 fft.txt")))
+        old_header, old_rows = self.old_fft
+        self.assertEqual(header, old_header)
+        # Faster, slower and new FFT lengths
+        self.assertEqual(rows[1024], (19535569, 1.6012))
+        self.assertEqual(rows[1152], old_rows[1152])
+        self.assertEqual(rows[1200], (22812433, 1.3977))
+        self.assertEqual(len(rows), len(old_rows) + 1)
+        rows = cudalucas_bench.parse_threads(cudalucas_bench.read_file(
+            os.path.join(self.tables, "Tesla T4 threads.txt")))
+        self.assertEqual(rows[1024], (64, 64, 1.02113))
+        self.assertEqual(rows[1029], self.old_threads[1029])
+        self.assertEqual(rows[1120], (64, 128, 1.50001))
+        self.assertEqual(len(rows), len(self.old_threads))
+
+    def test_merge_results(self):
+        self.assertEqual(cudalucas_bench.merge_results(FFT_FILE, THREADS_FILE, self.tables), "Tesla T4")
+        self.check_merged()
+
+    def test_no_bench(self):
+        subprocess.run([sys.executable, os.path.join(ROOT, "cudalucas_bench.py"), "--no-bench",
+                        "-o", self.tables, FFT_FILE, THREADS_FILE], check=True, stdout=subprocess.DEVNULL)
+        self.check_merged()
+
+    def test_new_device(self):
+        # Without an existing table, the results are copied
+        os.remove(os.path.join(self.tables, "Tesla T4 fft.txt"))
+        os.remove(os.path.join(self.tables, "Tesla T4 threads.txt"))
+        self.assertEqual(cudalucas_bench.merge_results(FFT_FILE, THREADS_FILE, self.tables), "Tesla T4")
+        self.assertEqual(cudalucas_bench.read_file(os.path.join(self.tables, "Tesla T4 fft.txt")),
+                         cudalucas_bench.read_file(FFT_FILE))
+        self.assertEqual(cudalucas_bench.read_file(os.path.join(self.tables, "Tesla T4 threads.txt")),
+                         cudalucas_bench.read_file(THREADS_FILE))
+
+
+if __name__ == "__main__":
+    unittest.main()
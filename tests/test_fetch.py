@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+# Teal Dulcet and Daniel Connelly
+# Tests of fetch.py against a local HTTP server
+# python3 -m unittest discover -s tests
+
+import os
+import sys
+import shutil
+import hashlib
+import tempfile
+import threading
+import unittest
+import functools
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import fetch
+
+DATA = b"GIMPS test file\n" * 1000
+SHA256 = hashlib.sha256(DATA).hexdigest()
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class FetchTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.served = os.path.join(self.tmp, "served")
+        self.work = os.path.join(self.tmp, "work")
+        self.cache = os.path.join(self.tmp, "cache")
+        os.makedirs(os.path.join(self.served, "mirror"))
+        os.makedirs(self.work)
+        with open(os.path.join(self.served, "file.bin"), "wb") as f:
+            f.write(DATA)
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), functools.partial(
+            QuietHandler, directory=self.served))
+        self.url = "http://127.0.0.1:{0}/".format(self.server.server_address[1])
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.cwd = os.getcwd()
+        os.chdir(self.work)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp)
+
+    def test_download(self):
+        self.assertTrue(fetch.fetch(self.url + "file.bin", SHA256, cache=self.cache))
+        self.assertTrue(fetch.check_file("file.bin", SHA256))
+        self.assertTrue(fetch.check_file(fetch.cache_path(self.cache, SHA256), SHA256))
+
+    def test_checksum_mismatch(self):
+        bad = hashlib.sha256(b"other").hexdigest()
+        self.assertFalse(fetch.fetch(self.url + "file.bin", bad, cache=self.cache, retries=1))
+        self.assertFalse(os.path.exists("file.bin"))
+        self.assertFalse(os.path.exists("file.bin.part"))
+        self.assertFalse(os.path.exists(fetch.cache_path(self.cache, bad)))
+
+    def test_mirror_fallback(self):
+        # The mirror does not have the file, so it is downloaded from the URL
+        self.assertTrue(fetch.fetch(self.url + "file.bin", SHA256,
+                                    mirror=self.url + "mirror", retries=1))
+        self.assertTrue(fetch.check_file("file.bin", SHA256))
+
+    def test_mirror_first(self):
+        shutil.move(os.path.join(self.served, "file.bin"), os.path.join(self.served, "mirror", "file.bin"))
+        self.assertTrue(fetch.fetch(self.url + "file.bin", SHA256,
+                                    mirror=self.url + "mirror", retries=1))
+        self.assertTrue(fetch.check_file("file.bin", SHA256))
+
+    def test_cache_hit(self):
+        os.makedirs(self.cache)
+        shutil.copyfile(os.path.join(self.served, "file.bin"), fetch.cache_path(self.cache, SHA256))
+        # Not on the server, so it can only come from the cache
+        os.remove(os.path.join(self.served, "file.bin"))
+        self.assertTrue(fetch.fetch(self.url + "file.bin", SHA256, cache=self.cache, retries=1))
+        self.assertTrue(fetch.check_file("file.bin", SHA256))
+
+    def test_already_downloaded(self):
+        # A file that is already downloaded is still added to the cache
+        shutil.copyfile(os.path.join(self.served, "file.bin"), "file.bin")
+        os.remove(os.path.join(self.served, "file.bin"))
+        self.assertTrue(fetch.fetch(self.url + "file.bin", SHA256, cache=self.cache, retries=1))
+        self.assertTrue(fetch.check_file(fetch.cache_path(self.cache, SHA256), SHA256))
+
+    def test_resume(self):
+        with open("file.bin.part", "wb") as f:
+            f.write(DATA[:1000])
+        self.assertTrue(fetch.fetch(self.url + "file.bin", SHA256, retries=1))
+        self.assertTrue(fetch.check_file("file.bin", SHA256))
+
+
+if __name__ == "__main__":
+    unittest.main()